@@ -0,0 +1,416 @@
+import os
+import json
+import math
+import time
+import uuid
+import asyncio
+import logging
+import httpx
+from typing import List, Dict, Any, Optional
+from fastapi import HTTPException
+from http_client import request as http_request, download_to_file, RETRY_STATUSES
+from media_cache import get_cached_media, media_cache_enabled
+from cache import PersistentCache
+from timeline import split_scene
+from ffmpeg_render import FFMPEG_BINARY, run_ffmpeg
+from quality import get_quality_profile
+from metrics import PEXELS_SEARCH_LATENCY, DOWNLOAD_LATENCY, DOWNLOAD_BYTES, timed, register_upstream
+
+logger = logging.getLogger("video_generator")
+
+CURRENT_DIR = os.path.abspath(os.path.dirname(__file__))
+MEDIA_DIR = os.path.abspath(os.path.join(CURRENT_DIR, "media_assets"))
+
+os.makedirs(os.path.join(MEDIA_DIR, "videos"), exist_ok=True)
+os.makedirs(os.path.join(MEDIA_DIR, "images"), exist_ok=True)
+
+# Base URL of the Pexels API, override to go through a proxy or a local stand-in
+PEXELS_API_BASE_URL = os.getenv("PEXELS_API_BASE_URL", "https://api.pexels.com").rstrip("/")
+register_upstream(PEXELS_API_BASE_URL, "pexels")
+
+# Maximum number of concurrent Pexels searches/downloads while resolving a video
+ASSET_CONCURRENCY = int(os.getenv("ASSET_CONCURRENCY", "6"))
+# Time limit for resolving a single asset (search + download)
+ASSET_TIMEOUT = float(os.getenv("ASSET_TIMEOUT", "120"))
+
+# Scenes up to this long only use stock video, longer ones also get an image
+VIDEO_ONLY_MAX_DURATION = 5.0
+
+# Only the part of a stock video a scene shows is fetched, plus this margin (0 fetches whole files)
+VIDEO_PREFIX_MARGIN = float(os.getenv("VIDEO_PREFIX_MARGIN", "1.0"))
+
+# Pexels search results are cached, the LLM keeps producing the same keywords
+PEXELS_SEARCH_CACHE_TTL = float(os.getenv("PEXELS_SEARCH_CACHE_TTL", str(7 * 24 * 3600)))
+PEXELS_SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("PEXELS_SEARCH_CACHE_MAX_ENTRIES", "50000"))
+search_cache = PersistentCache(
+    "pexels_search", ttl=PEXELS_SEARCH_CACHE_TTL, max_entries=PEXELS_SEARCH_CACHE_MAX_ENTRIES
+)
+
+async def make_pexels_request(url, params=None, max_retries=3):
+    """Make Pexels API request with retry logic"""
+    PEXELS_API_KEY = os.getenv("PEXELS_API_KEY")
+    if not PEXELS_API_KEY:
+        logger.error("PEXELS_API_KEY environment variable not set")
+        raise HTTPException(status_code=500, detail="PEXELS_API_KEY environment variable not set")
+
+    headers = {
+        "Authorization": PEXELS_API_KEY
+    }
+
+    try:
+        response = await http_request(
+            "GET", url, headers=headers, params=params,
+            retries=max_retries, backoff=2.0, retry_statuses=(401,) + RETRY_STATUSES
+        )
+        return response.json()
+    except (httpx.HTTPError, json.JSONDecodeError) as e:
+        logger.error(f"Pexels API request failed: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error communicating with Pexels API after {max_retries} attempts: {str(e)}"
+        )
+
+def search_cache_key(kind, query, orientation, size, per_page):
+    """Cache key of a Pexels search, queries differing only in case or spacing share an entry"""
+    normalized_query = " ".join(query.lower().split())
+    return json.dumps([kind, normalized_query, orientation, size, per_page])
+
+async def cached_pexels_search(kind, url, params, result_key):
+    """Run a Pexels search through the search cache, empty results are never cached"""
+    key = search_cache_key(kind, params["query"], params.get("orientation"), params.get("size"), params["per_page"])
+    # The search cache is SQLite, keep its calls off the event loop
+    result = await asyncio.to_thread(search_cache.get_json, key)
+    if result is not None:
+        logger.info(f"Pexels search cache hit for {kind}: {params['query']}")
+        return result
+
+    with timed(PEXELS_SEARCH_LATENCY, kind=kind):
+        result = await make_pexels_request(url, params)
+    if result.get(result_key):
+        await asyncio.to_thread(search_cache.set_json, key, result)
+    return result
+
+async def search_pexels_videos(query, per_page=1, orientation="landscape"):
+    """Search for videos on Pexels API"""
+    url = f"{PEXELS_API_BASE_URL}/videos/search"
+    params = {
+        "query": query,
+        "per_page": per_page,
+        "orientation": orientation,
+        "size": "medium"  # medium quality to save bandwidth
+    }
+
+    result = await cached_pexels_search("videos", url, params, "videos")
+    if not result.get("videos"):
+        raise HTTPException(status_code=404, detail=f"No videos found for query: {query}")
+
+    return result["videos"]
+
+async def search_pexels_photos(query, per_page=1, orientation="landscape"):
+    """Search for photos on Pexels API"""
+    url = f"{PEXELS_API_BASE_URL}/v1/search"
+    params = {
+        "query": query,
+        "per_page": per_page,
+        "orientation": orientation
+    }
+
+    result = await cached_pexels_search("photos", url, params, "photos")
+    if not result.get("photos"):
+        raise HTTPException(status_code=404, detail=f"No photos found for query: {query}")
+
+    return result["photos"]
+
+async def fetch_video_prefix(url, filepath, seconds):
+    """Remux the first seconds of a remote MP4 into filepath, returns the number of bytes written
+
+    ffmpeg reads the index and then only the start of the media data through
+    HTTP range requests, the rest of the file is never transferred.
+    """
+    await run_ffmpeg([
+        FFMPEG_BINARY, "-y", "-hide_banner", "-loglevel", "error",
+        "-rw_timeout", str(int(ASSET_TIMEOUT * 1000000)),
+        "-t", f"{seconds:.3f}", "-i", url,
+        "-map", "0:v:0", "-c", "copy",
+        "-movflags", "+faststart", "-f", "mp4", filepath
+    ])
+    return os.path.getsize(filepath)
+
+async def download_video_prefix(url, filepath, seconds):
+    """Fetch the first seconds of a video, or the whole file if the partial fetch fails"""
+    try:
+        return await fetch_video_prefix(url, filepath, seconds)
+    except (RuntimeError, OSError) as e:
+        logger.warning(f"Partial fetch of {url} failed, downloading the whole file: {str(e)}")
+        return await download_to_file(url, filepath)
+
+async def download_media_file(url, media_type, query, asset_id=None, seconds=None):
+    """Download media file (video or image) from URL
+
+    For videos, seconds limits the download to the start of the video.
+    Returns (path, cached). Cached files are shared between renders and must
+    not be deleted by the caller; uncached ones are temporary.
+    """
+    if media_type == "video":
+        extension = ".mp4"
+        subfolder = "videos"
+    else:  # image
+        extension = ".jpg"
+        subfolder = "images"
+
+    async def download(dest):
+        with timed(DOWNLOAD_LATENCY, media_type=media_type):
+            if seconds:
+                size = await download_video_prefix(url, dest, seconds)
+            else:
+                size = await download_to_file(url, dest)
+        DOWNLOAD_BYTES.labels(media_type=media_type).observe(size)
+        return size
+
+    # Media fragment URI, prefixes of different lengths are different cache entries
+    cache_url = f"{url}#t=0,{seconds}" if seconds else url
+
+    try:
+        if media_cache_enabled():
+            path = await get_cached_media(asset_id, cache_url, extension, download)
+            return path, True
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to download {media_type} file: {str(e)}"
+        )
+
+    # Create a safe filename from the query
+    safe_query = "".join([c if c.isalnum() else "_" for c in query])[:50]
+    timestamp = int(time.time())
+
+    # Unique suffix so concurrent downloads of the same query don't collide
+    filename = f"{safe_query}_{timestamp}_{uuid.uuid4().hex[:8]}{extension}"
+    filepath = os.path.join(MEDIA_DIR, subfolder, filename)
+
+    # Download the file
+    try:
+        await download(filepath)
+        return filepath, False
+    except BaseException as e:
+        # Don't leave partial downloads behind (including cancelled ones)
+        if os.path.exists(filepath):
+            os.remove(filepath)
+        if not isinstance(e, Exception):
+            raise
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to download {media_type} file: {str(e)}"
+        )
+
+def select_video_file(video_files, min_width=None):
+    """Pick the rendition to download from a Pexels video
+
+    With min_width, the smallest rendition at least that wide. Otherwise (or
+    if none is wide enough) prefer HD, then SD, then anything.
+    """
+    if min_width:
+        wide_enough = [file for file in video_files if (file.get("width") or 0) >= min_width]
+        if wide_enough:
+            return min(wide_enough, key=lambda file: file["width"])
+
+    for file in video_files:
+        if file["quality"] == "hd" and file["width"] >= 1280:
+            return file
+
+    for file in video_files:
+        if file["quality"] == "sd" and file["width"] >= 640:
+            return file
+
+    return video_files[0] if video_files else None
+
+def get_scene_queries(scene):
+    """Get the (video_query, image_query) pair for a scene"""
+    text = scene.get("text", "")
+    video_prompt = scene.get("videoPrompt", "")
+    # If videoPrompt is not available, use the separate video and image queries
+    if not video_prompt:
+        return scene.get("videoQuery", text), scene.get("imageQuery", text)
+    # Use the same prompt for both
+    return video_prompt, video_prompt
+
+def scene_needs_image(scene_duration):
+    """Scenes longer than VIDEO_ONLY_MAX_DURATION show a stock image after the video"""
+    return scene_duration > VIDEO_ONLY_MAX_DURATION
+
+def video_fetch_seconds(scene_duration):
+    """Seconds of stock video to fetch for a scene, None to fetch the whole file
+
+    Rounded up to whole seconds so scenes of similar length share cache entries.
+    """
+    if VIDEO_PREFIX_MARGIN <= 0:
+        return None
+    shown = split_scene(scene_duration)[0] if scene_needs_image(scene_duration) else scene_duration
+    return math.ceil(shown + VIDEO_PREFIX_MARGIN)
+
+async def _limited(semaphore, coro, what, scene_number):
+    """Run one network operation under the concurrency limit and the per-asset timeout"""
+    try:
+        await semaphore.acquire()
+    except BaseException:
+        coro.close()
+        raise
+    try:
+        try:
+            return await asyncio.wait_for(coro, timeout=ASSET_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error(f"Timed out during {what} for scene {scene_number}")
+            raise HTTPException(status_code=504, detail=f"Timed out during {what} for scene {scene_number}")
+    finally:
+        semaphore.release()
+
+async def resolve_video_asset(query, scene_number, semaphore, profile, seconds=None):
+    """Search Pexels for a stock video and download it (only its first seconds if given)"""
+    videos = await _limited(semaphore, search_pexels_videos(query), "video search", scene_number)
+    if not videos:
+        logger.error(f"No videos found for scene {scene_number}")
+        raise HTTPException(status_code=404, detail=f"No videos found for scene {scene_number}")
+
+    video_file = select_video_file(videos[0]["video_files"], profile["min_video_width"])
+    if not video_file:
+        logger.error(f"No usable video format found for scene {scene_number}")
+        raise HTTPException(status_code=404, detail=f"No usable video format found for scene {scene_number}")
+
+    pexels_id = videos[0].get("id")
+    path, cached = await _limited(
+        semaphore, download_media_file(video_file["link"], "video", query, asset_id=pexels_id, seconds=seconds),
+        "video download", scene_number
+    )
+    logger.info(f"Downloaded video for scene {scene_number} to: {path}")
+    return {"path": path, "url": video_file["link"], "pexels_id": pexels_id, "cached": cached, "seconds": seconds}
+
+async def resolve_image_asset(query, scene_number, semaphore, profile):
+    """Search Pexels for a stock photo and download it"""
+    photos = await _limited(semaphore, search_pexels_photos(query), "image search", scene_number)
+    if not photos:
+        logger.error(f"No images found for scene {scene_number}")
+        raise HTTPException(status_code=404, detail=f"No images found for scene {scene_number}")
+
+    image_url = photos[0]["src"].get(profile["photo_size"]) or photos[0]["src"]["original"]
+    pexels_id = photos[0].get("id")
+    path, cached = await _limited(
+        semaphore, download_media_file(image_url, "image", query, asset_id=pexels_id),
+        "image download", scene_number
+    )
+    logger.info(f"Downloaded image for scene {scene_number} to: {path}")
+    return {"path": path, "url": image_url, "pexels_id": pexels_id, "cached": cached}
+
+async def gather_or_cancel(coros):
+    """Run coroutines concurrently; if one fails, cancel and wait for the rest before re-raising"""
+    tasks = [asyncio.ensure_future(coro) for coro in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        # Let cancelled downloads remove their partial files before returning
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+async def resolve_scene(scene, semaphore, downloaded_files, profile):
+    """Resolve the stock video (and image, for longer scenes) of a single scene"""
+    scene_number = scene["sceneNumber"]
+    scene_duration = scene["endTime"] - scene["startTime"]
+    video_query, image_query = get_scene_queries(scene)
+
+    logger.info(f"Resolving assets for scene {scene_number} with duration {scene_duration:.2f}s")
+    logger.info(f"Image query: {image_query}")
+    logger.info(f"Video query: {video_query}")
+
+    async def track(coro):
+        asset = await coro
+        # Cached files outlive the render, only temporary downloads need cleanup
+        if not asset["cached"]:
+            downloaded_files.append(asset["path"])
+        return asset
+
+    try:
+        lookups = [track(resolve_video_asset(
+            video_query, scene_number, semaphore, profile, video_fetch_seconds(scene_duration)
+        ))]
+        if scene_needs_image(scene_duration):
+            lookups.append(track(resolve_image_asset(image_query, scene_number, semaphore, profile)))
+        assets = await gather_or_cancel(lookups)
+    except Exception as e:
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        logger.error(f"Error resolving assets for scene {scene_number}: {detail}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error processing scene {scene_number}: {detail}"
+        )
+
+    return {
+        "sceneNumber": scene_number,
+        "startTime": scene["startTime"],
+        "endTime": scene["endTime"],
+        "duration": scene_duration,
+        "text": scene.get("text", ""),
+        "videoQuery": video_query,
+        "imageQuery": image_query,
+        "video": assets[0],
+        "image": assets[1] if len(assets) > 1 else None
+    }
+
+async def resolve_scene_assets(timestamps: List[Dict[str, Any]], downloaded_files: Optional[List[str]] = None,
+                               quality: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Search and download the stock media for every scene concurrently
+
+    quality selects the renditions downloaded (see quality.QUALITY_PROFILES).
+    Returns the asset manifest, one entry per scene in timeline order. Every
+    temporary (uncached) download is appended to downloaded_files as soon as
+    it exists, so the caller can clean up even when another scene fails.
+    """
+    if downloaded_files is None:
+        downloaded_files = []
+    profile = get_quality_profile(quality)
+    semaphore = asyncio.Semaphore(ASSET_CONCURRENCY)
+    return await gather_or_cancel(
+        resolve_scene(scene, semaphore, downloaded_files, profile) for scene in timestamps
+    )
+
+async def prefetch_scene_assets(scenes: List[Dict[str, Any]], quality: Optional[str] = None) -> Dict[str, int]:
+    """Warm the caches for a script's scenes before their timing is known
+
+    Runs every scene's Pexels searches, which land in search_cache, and with
+    the media cache enabled also downloads the photos. Videos are left to the
+    render, how much of each to fetch depends on the scene durations. Failures
+    are only logged, the render resolves whatever is missing. Returns counts.
+    """
+    profile = get_quality_profile(quality)
+    semaphore = asyncio.Semaphore(ASSET_CONCURRENCY)
+    counts = {"searches": 0, "downloads": 0, "failed": 0}
+
+    async def prefetch_video(query, scene_number):
+        await _limited(semaphore, search_pexels_videos(query), "video search", scene_number)
+        counts["searches"] += 1
+
+    async def prefetch_image(query, scene_number):
+        if not media_cache_enabled():
+            await _limited(semaphore, search_pexels_photos(query), "image search", scene_number)
+            counts["searches"] += 1
+            return
+        await resolve_image_asset(query, scene_number, semaphore, profile)
+        counts["searches"] += 1
+        counts["downloads"] += 1
+
+    async def attempt(coro, scene_number):
+        try:
+            await coro
+        except Exception as e:
+            counts["failed"] += 1
+            detail = e.detail if isinstance(e, HTTPException) else str(e)
+            logger.warning(f"Prefetch for scene {scene_number} failed: {detail}")
+
+    lookups = []
+    for scene in scenes:
+        scene_number = scene.get("sceneNumber", 0)
+        video_query, image_query = get_scene_queries(scene)
+        lookups.append(attempt(prefetch_video(video_query, scene_number), scene_number))
+        lookups.append(attempt(prefetch_image(image_query, scene_number), scene_number))
+    await gather_or_cancel(lookups)
+    return counts
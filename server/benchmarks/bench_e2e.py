@@ -0,0 +1,395 @@
+"""Offline end-to-end benchmark, /subtopics to /generate_video
+
+Run from the server directory:
+
+    python benchmarks/bench_e2e.py [--lessons 3] [--output results.json]
+
+Starts local stand-ins for the AI API, Eleven Labs and Pexels (canned JSON,
+synthetic MP3, MP4 and JPEG served with configurable latency) and the API
+itself under uvicorn, pointed at them through the *_API_BASE_URL settings.
+Each lesson then goes through /subtopics, /script, /generate_voiceover and
+/generate_video like the client does. Every lesson uses a new concept and
+the server starts with empty caches, so all stages run cold.
+
+Per-stage timings, throughput and the peak RSS of the server (alone and with
+its render workers and ffmpeg children) are written as JSON, tagged with the
+current commit, to compare runs across commits. Warmup lessons are left out
+of everything but the upstream request counts.
+"""
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import socket
+import hashlib
+import argparse
+import platform
+import tempfile
+import threading
+import statistics
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+import httpx
+
+SERVER_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, SERVER_DIR)
+from ffmpeg_render import FFMPEG_BINARY  # noqa: E402
+
+STAGES = ["subtopics", "script", "voiceover", "video"]
+
+def make_media(directory, narration_seconds, clip_seconds):
+    """Synthetic narration MP3, stock MP4 and stock JPEG, made once per run"""
+    files = {
+        "narration.mp3": ["-f", "lavfi", "-i", f"sine=frequency=220:duration={narration_seconds}",
+                          "-c:a", "libmp3lame", "-b:a", "128k"],
+        "clip.mp4": ["-f", "lavfi", "-i", f"testsrc2=size=1280x720:rate=30:duration={clip_seconds}",
+                     "-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p", "-movflags", "+faststart"],
+        "photo.jpg": ["-f", "lavfi", "-i", "testsrc2=size=1920x1080", "-frames:v", "1", "-q:v", "3"]
+    }
+    for name, args in files.items():
+        subprocess.run(
+            [FFMPEG_BINARY, "-y", "-loglevel", "error", *args, os.path.join(directory, name)], check=True
+        )
+
+class FakeUpstreams(ThreadingHTTPServer):
+    """AI API, Eleven Labs and Pexels stand-ins on one port, under /aiml, /elevenlabs and /pexels"""
+    daemon_threads = True
+
+    def __init__(self, media_dir, latency, scenes):
+        super().__init__(("127.0.0.1", 0), FakeUpstreamHandler)
+        self.media_dir = media_dir
+        self.latency = latency
+        self.scenes = scenes
+        self.base_url = f"http://127.0.0.1:{self.server_port}"
+        self.requests = {service: 0 for service in latency}
+        self._lock = threading.Lock()
+
+    def count(self, service):
+        with self._lock:
+            self.requests[service] += 1
+        time.sleep(self.latency[service])
+
+class FakeUpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, body, content_type="application/json", status=200):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _media(self, name, content_type):
+        with open(os.path.join(self.server.media_dir, name), "rb") as f:
+            self._send(f.read(), content_type)
+
+    def do_POST(self):
+        path = urlsplit(self.path).path
+        if path == "/aiml/chat/completions":
+            self.server.count("aiml")
+            prompt = self._read_json()["messages"][-1]["content"]
+            return self._send({"choices": [{"message": {"content": json.dumps(self._completion(prompt))}}]})
+        if path.startswith("/elevenlabs/text-to-speech/"):
+            self.server.count("elevenlabs")
+            return self._media("narration.mp3", "audio/mpeg")
+        self._send({"error": "not found"}, status=404)
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query).get("query", [""])[0]
+        asset_id = int(hashlib.sha256(query.encode("utf-8")).hexdigest()[:8], 16)
+        media = f"{self.server.base_url}/media"
+        if parts.path == "/pexels/videos/search":
+            self.server.count("pexels")
+            files = [
+                {"quality": "hd", "width": 1280, "height": 720, "link": f"{media}/clip.mp4?id={asset_id}"},
+                {"quality": "sd", "width": 640, "height": 360, "link": f"{media}/clip.mp4?id={asset_id}"}
+            ]
+            return self._send({"videos": [{"id": asset_id, "video_files": files}]})
+        if parts.path == "/pexels/v1/search":
+            self.server.count("pexels")
+            link = f"{media}/photo.jpg?id={asset_id}"
+            sizes = ["original", "large2x", "large", "medium"]
+            return self._send({"photos": [{"id": asset_id, "src": {size: link for size in sizes}}]})
+        if parts.path == "/media/clip.mp4":
+            self.server.count("media")
+            return self._media("clip.mp4", "video/mp4")
+        if parts.path == "/media/photo.jpg":
+            self.server.count("media")
+            return self._media("photo.jpg", "image/jpeg")
+        self._send({"error": "not found"}, status=404)
+
+    do_HEAD = do_GET
+
+    def _completion(self, prompt):
+        """Canned subtopics or script, depending on which prompt was sent"""
+        if "key subtopics" in prompt:
+            concept = prompt.rsplit("The educational concept is:", 1)[-1].strip()
+            return {"subtopics": [{"title": f"{concept} part {i}"} for i in range(1, 4)]}
+        topic = re.search(r'teaches "([^"]*)"', prompt)
+        topic = topic.group(1) if topic else "topic"
+        return {
+            "educationalConcept": topic,
+            "conceptDescription": f"About {topic}",
+            "chosenFandom": "Star Wars",
+            "videoTitle": f"Star Wars teaches {topic}",
+            "narrator": "Narrator",
+            "scenes": [
+                {
+                    "sceneNumber": i,
+                    "videoQuery": f"{topic} scene {i} video",
+                    "imageQuery": f"{topic} scene {i} image",
+                    "narrationScript": f"Scene {i} of a lesson about {topic}."
+                }
+                for i in range(1, self.server.scenes + 1)
+            ]
+        }
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _children():
+    """pid -> list of child pids, from /proc"""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    return children
+
+def _rss(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+class RssSampler:
+    """Peak RSS of a process and of its whole process tree, sampled from /proc (Linux only)"""
+
+    def __init__(self, pid, interval=0.05):
+        self.pid = pid
+        self.interval = interval
+        self.peak_process = 0
+        self.peak_tree = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            children = _children()
+            pids, stack = [], [self.pid]
+            while stack:
+                pid = stack.pop()
+                pids.append(pid)
+                stack.extend(children.get(pid, []))
+            self.peak_process = max(self.peak_process, _rss(self.pid))
+            self.peak_tree = max(self.peak_tree, sum(_rss(pid) for pid in pids))
+
+    def start(self):
+        if os.path.isdir("/proc"):
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+def start_server(port, upstream_url, workdir, args):
+    env = dict(
+        os.environ,
+        API_KEY="benchmark", ELEVEN_API_KEY="benchmark", PEXELS_API_KEY="benchmark",
+        AIML_API_BASE_URL=f"{upstream_url}/aiml",
+        ELEVENLABS_API_BASE_URL=f"{upstream_url}/elevenlabs",
+        PEXELS_API_BASE_URL=f"{upstream_url}/pexels",
+        CACHE_DIR=os.path.join(workdir, "cache"),
+        MEDIA_CACHE_DIR=os.path.join(workdir, "media_cache"),
+        RENDER_JOBS_DB=os.path.join(workdir, "render_jobs.db"),
+        PROFILE_DIR=os.path.join(workdir, "profiles"),
+        RENDER_WORKERS=str(args.workers)
+    )
+    env.pop("PROMETHEUS_MULTIPROC_DIR", None)
+    # The working directory holds the voiceovers (generated_audio is relative to it)
+    with open(os.path.join(workdir, "server.log"), "wb") as log:
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", SERVER_DIR,
+             "--host", "127.0.0.1", "--port", str(port), "--log-level", "info"],
+            cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT
+        )
+    deadline = time.monotonic() + 120
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Server exited with {server.returncode}, see {workdir}/server.log")
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/", timeout=1).raise_for_status()
+            return server
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("Server did not start within 120s")
+
+def run_lesson(client, concept, args):
+    """One lesson through the four endpoints, returns stage timings and the video"""
+    timings = {}
+
+    def stage(name, method, path, **kwargs):
+        start = time.perf_counter()
+        response = client.request(method, path, **kwargs)
+        timings[name] = time.perf_counter() - start
+        if response.status_code != 200:
+            raise RuntimeError(f"{name} failed with {response.status_code}: {response.text[:300]}")
+        return response.json()
+
+    subtopics = stage("subtopics", "GET", "/subtopics", params={"concept": concept})
+    subtopic = subtopics["subtopics"][0]["title"]
+    script = stage("script", "POST", "/script", json={"concept_subtopic": subtopic, "fandom": "Star Wars"})
+    voiceover = stage("voiceover", "POST", "/generate_voiceover", json={"script": script})
+    video_request = {"voiceover_data": voiceover["voiceover_data"], "engine": args.engine, "quality": args.quality}
+    video = stage("video", "POST", "/generate_video", json={k: v for k, v in video_request.items() if v})
+    timings["total"] = sum(timings.values())
+    return timings, video
+
+def summarize(values):
+    return {
+        "mean": statistics.mean(values),
+        "median": statistics.median(values),
+        "min": min(values),
+        "max": max(values)
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=SERVER_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def remove_outputs(video):
+    """Delete the video (and its sidecar files) the server wrote next to the code"""
+    path = video.get("video_path")
+    if not path:
+        return
+    for candidate in (path, f"{path}.music.wav"):
+        if os.path.exists(candidate):
+            os.remove(candidate)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lessons", type=int, default=3, help="measured lessons, run one after another")
+    parser.add_argument("--warmup", type=int, default=1, help="lessons run first and left out of the results")
+    parser.add_argument("--scenes", type=int, default=3, help="scenes per script")
+    parser.add_argument("--engine", help="render engine (defaults to the server's RENDER_ENGINE)")
+    parser.add_argument("--quality", help="render quality (defaults to full)")
+    parser.add_argument("--workers", type=int, default=2, help="RENDER_WORKERS of the server")
+    parser.add_argument("--llm-latency", type=float, default=0.8, help="seconds per AI API call")
+    parser.add_argument("--tts-latency", type=float, default=0.4, help="seconds per Eleven Labs call")
+    parser.add_argument("--pexels-latency", type=float, default=0.2, help="seconds per Pexels search")
+    parser.add_argument("--media-latency", type=float, default=0.1, help="seconds before a media download starts")
+    parser.add_argument("--narration-seconds", type=float, default=4.0, help="length of each scene's narration")
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    parser.add_argument("--keep-workdir", action="store_true", help="keep caches, voiceovers and the server log")
+    args = parser.parse_args()
+
+    latency = {
+        "aiml": args.llm_latency, "elevenlabs": args.tts_latency,
+        "pexels": args.pexels_latency, "media": args.media_latency
+    }
+    workdir = tempfile.mkdtemp(prefix="edverse_bench_")
+    media_dir = os.path.join(workdir, "upstream_media")
+    os.makedirs(media_dir)
+    make_media(media_dir, args.narration_seconds, clip_seconds=10)
+
+    upstreams = FakeUpstreams(media_dir, latency, args.scenes)
+    threading.Thread(target=upstreams.serve_forever, daemon=True).start()
+    port = free_port()
+    started = time.perf_counter()
+    server = start_server(port, upstreams.base_url, workdir, args)
+    startup_seconds = time.perf_counter() - started
+    sampler = RssSampler(server.pid)
+    sampler.start()
+
+    lessons = []
+    run_id = f"{int(time.time())}"
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=1800) as client:
+            for i in range(args.warmup + args.lessons):
+                # A new concept every time, so no cache is ever hit
+                timings, video = run_lesson(client, f"benchmark concept {run_id} {i}", args)
+                remove_outputs(video)
+                if i < args.warmup:
+                    continue
+                lessons.append({
+                    "timings": timings,
+                    "video_seconds": video["video_data"].get("duration"),
+                    "cached": video["video_data"].get("cached", False)
+                })
+                print(f"lesson {len(lessons)}: " + ", ".join(
+                    f"{name} {seconds:.2f}s" for name, seconds in timings.items()
+                ), file=sys.stderr)
+    finally:
+        sampler.stop()
+        server.terminate()
+        server.wait(timeout=60)
+        upstreams.shutdown()
+        if not args.keep_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    wall = sum(lesson["timings"]["total"] for lesson in lessons)
+    render = sum(lesson["timings"]["video"] for lesson in lessons)
+    video_seconds = sum(lesson["video_seconds"] or 0 for lesson in lessons)
+    results = {
+        "benchmark": "e2e",
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "keep_workdir")},
+        "server_startup_seconds": startup_seconds,
+        "stages": {
+            name: summarize([lesson["timings"][name] for lesson in lessons]) for name in STAGES + ["total"]
+        } if lessons else {},
+        "throughput": {
+            "lessons_per_minute": 60 * len(lessons) / wall if wall else None,
+            "video_seconds_per_render_second": video_seconds / render if render else None
+        },
+        "peak_rss_bytes": {
+            "server": sampler.peak_process or None,
+            "server_and_children": sampler.peak_tree or None
+        },
+        "upstream_requests": upstreams.requests,
+        "lessons": lessons
+    }
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""Micro-benchmarks of the per-frame transforms of the MoviePy render, checked against a baseline
+
+Run from the server directory:
+
+    python benchmarks/bench_frames.py [--frames 30] [--update-baseline]
+
+Times the frame callbacks on synthetic frames of typical Pexels sizes, from
+640x360 renditions up to 6000x4000 photo originals:
+
+    standardize       standardize_clip_size (resize_frame) on a video frame
+    zoom              apply_image_effects with the default zoom engine
+    zoom_legacy       apply_image_effects with the legacy engine (scale_func)
+    composite         CompositeVideoClip of a video and an image segment,
+                      as render_with_moviepy builds the timeline
+
+For every case it reports frames per second (best of --repeat runs) and the
+bytes allocated per frame, the peak of new allocations while a frame is
+produced as seen by tracemalloc (numpy and OpenCV buffers included).
+
+Results are compared with benchmarks/frame_baseline.json. The script exits
+with status 1 when a case is slower than the baseline by more than
+--max-slowdown or allocates more than --max-alloc-growth extra per frame.
+Frame rates depend on the machine, refresh the baseline with
+--update-baseline when the benchmark moves to another one.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+from moviepy.editor import ImageClip, CompositeVideoClip
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from video import apply_image_effects, standardize_clip_size  # noqa: E402
+from bench_standardize import synthetic_clip  # noqa: E402
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "frame_baseline.json")
+
+# Pexels video renditions (sd, hd, full hd, 4k, portrait) and photo originals
+RESOLUTIONS = [(640, 360), (1280, 720), (1920, 1080), (3840, 2160), (1080, 1920), (6000, 4000)]
+WIDTH, HEIGHT = 1920, 1080
+# Clip length the frames are spread over, zoom progress depends on it
+DURATION = 5.0
+# Allocation changes below this many bytes per frame are noise (Python objects, MoviePy bookkeeping)
+ALLOC_SLACK_BYTES = 64 * 1024
+
+CASES = ["standardize", "zoom", "zoom_legacy", "composite"]
+
+def image_clip(width, height):
+    return ImageClip(synthetic_clip(width, height, DURATION).get_frame(0)).set_duration(DURATION)
+
+def build_case(case, width, height):
+    """The clip whose frames a case measures"""
+    if case == "standardize":
+        return standardize_clip_size(synthetic_clip(width, height, DURATION), WIDTH, HEIGHT)
+    if case == "zoom":
+        return apply_image_effects(image_clip(width, height), DURATION, WIDTH, HEIGHT).set_duration(DURATION)
+    if case == "zoom_legacy":
+        clip = apply_image_effects(image_clip(width, height), DURATION, WIDTH, HEIGHT, engine="legacy")
+        return clip.set_duration(DURATION)
+    if case == "composite":
+        half = DURATION / 2
+        video = standardize_clip_size(synthetic_clip(width, height, half), WIDTH, HEIGHT)
+        image = apply_image_effects(image_clip(width, height), half, WIDTH, HEIGHT).set_duration(half)
+        return CompositeVideoClip([video, image.set_start(half)], size=(WIDTH, HEIGHT)).set_duration(DURATION)
+    raise ValueError(f"Unknown case: {case}")
+
+def frame_times(frames):
+    return [DURATION * i / frames for i in range(frames)]
+
+def measure_fps(clip, frames, repeat, min_seconds):
+    """Best frame rate of repeat runs, each sweeping the clip until it lasted min_seconds"""
+    clip.get_frame(0)  # warm up (buffers, OpenCV kernels)
+    best = 0.0
+    for _ in range(repeat):
+        done = 0
+        start = time.perf_counter()
+        while True:
+            for t in frame_times(frames):
+                clip.get_frame(t)
+            done += frames
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_seconds:
+                break
+        best = max(best, done / elapsed)
+    return best
+
+def measure_alloc(clip, frames):
+    """Mean peak of new allocations while one frame is produced"""
+    clip.get_frame(0)
+    tracemalloc.start()
+    try:
+        total = 0
+        for t in frame_times(frames):
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            clip.get_frame(t)
+            total += tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+    return total / frames
+
+def run(args):
+    results = {}
+    for width, height in RESOLUTIONS:
+        for case in CASES:
+            if case == "standardize" and (width, height) == (WIDTH, HEIGHT):
+                continue  # Returned unchanged, nothing to measure
+            name = f"{case}/{width}x{height}"
+            fps = measure_fps(build_case(case, width, height), args.frames, args.repeat, args.min_seconds)
+            alloc = measure_alloc(build_case(case, width, height), args.alloc_frames)
+            results[name] = {"fps": fps, "alloc_bytes_per_frame": alloc}
+    return results
+
+def compare(results, baseline, args):
+    """Print the results next to the baseline, returns the regressed cases"""
+    failures = []
+    print(f"{'case':<26} {'fps':>9} {'base fps':>9} {'change':>8} {'MiB/frame':>10} {'base MiB':>9}")
+    for name, result in results.items():
+        base = baseline.get(name)
+        line = f"{name:<26} {result['fps']:>9.1f}"
+        alloc_mib = result["alloc_bytes_per_frame"] / 1024 ** 2
+        if base is None:
+            print(f"{line} {'-':>9} {'-':>8} {alloc_mib:>10.2f} {'-':>9}")
+            continue
+        change = result["fps"] / base["fps"] - 1
+        print(
+            f"{line} {base['fps']:>9.1f} {change:>+7.0%} {alloc_mib:>10.2f} "
+            f"{base['alloc_bytes_per_frame'] / 1024 ** 2:>9.2f}"
+        )
+        if result["fps"] < base["fps"] * (1 - args.max_slowdown):
+            failures.append(f"{name}: {result['fps']:.1f} fps, baseline {base['fps']:.1f} fps")
+        alloc_limit = base["alloc_bytes_per_frame"] * (1 + args.max_alloc_growth) + ALLOC_SLACK_BYTES
+        if result["alloc_bytes_per_frame"] > alloc_limit:
+            failures.append(
+                f"{name}: {alloc_mib:.2f} MiB allocated per frame, "
+                f"baseline {base['alloc_bytes_per_frame'] / 1024 ** 2:.2f} MiB"
+            )
+    return failures
+
+def machine():
+    return {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--frames", type=int, default=30, help="frames per sweep over the clip")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per case, the fastest counts")
+    parser.add_argument("--min-seconds", type=float, default=0.3, help="minimum length of a run")
+    parser.add_argument("--alloc-frames", type=int, default=5, help="frames traced for allocations")
+    parser.add_argument("--max-slowdown", type=float, default=0.25,
+                        help="fail when fps drops more than this fraction below the baseline")
+    parser.add_argument("--max-alloc-growth", type=float, default=0.10,
+                        help="fail when allocations per frame grow more than this fraction over the baseline")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="baseline JSON file")
+    parser.add_argument("--update-baseline", action="store_true", help="store these results as the baseline")
+    parser.add_argument("--output", help="also write the results as JSON here")
+    args = parser.parse_args()
+
+    results = run(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"machine": machine(), "results": results}, f, indent=2)
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({"machine": machine(), "frames": args.frames, "results": results}, f, indent=2)
+            f.write("\n")
+        compare(results, {}, args)
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        compare(results, {}, args)
+        print(f"No baseline at {args.baseline}, create one with --update-baseline")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get("machine") != machine():
+        print(f"Baseline was recorded on {baseline.get('machine')}, frame rates may not be comparable")
+
+    failures = compare(results, baseline["results"], args)
+    if failures:
+        print("\nRegressions:")
+        for failure in failures:
+            print(f"  {failure}")
+        return 1
+    print("\nNo regressions")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
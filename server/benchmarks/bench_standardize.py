@@ -0,0 +1,72 @@
+"""Benchmark standardize_clip_size before and after geometry caching
+
+Run from the server directory:
+
+    python benchmarks/bench_standardize.py [--frames 120]
+
+"before" is the previous implementation (geometry and a fresh 1920x1080
+canvas computed for every frame), "after" is video.standardize_clip_size.
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import cv2
+from moviepy.editor import VideoClip
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from video import standardize_clip_size  # noqa: E402
+
+# Typical Pexels renditions (sd, hd, full hd, 4k, portrait)
+RESOLUTIONS = [(640, 360), (1280, 720), (1920, 1080), (3840, 2160), (1080, 1920)]
+
+def legacy_standardize_clip_size(clip, width=1920, height=1080):
+    """standardize_clip_size as it was before geometry caching"""
+    def resize_frame(get_frame, t):
+        frame = get_frame(t)
+        h, w = frame.shape[:2]
+        result = np.zeros((height, width, 3), dtype=frame.dtype)
+        aspect = w / h
+        target_aspect = width / height
+        if aspect > target_aspect:
+            new_w = width
+            new_h = int(width / aspect)
+            resized = cv2.resize(frame, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+            y_offset = (height - new_h) // 2
+            result[y_offset:y_offset+new_h, 0:width] = resized
+        else:
+            new_h = height
+            new_w = int(height * aspect)
+            resized = cv2.resize(frame, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+            x_offset = (width - new_w) // 2
+            result[0:height, x_offset:x_offset+new_w] = resized
+        return result
+    return clip.fl(resize_frame)
+
+def synthetic_clip(width, height, duration):
+    """A clip returning a fixed random frame, so only the transform is measured"""
+    frame = np.random.default_rng(0).integers(0, 255, (height, width, 3), dtype=np.uint8)
+    return VideoClip(lambda t: frame, duration=duration)
+
+def measure_fps(clip, frames):
+    clip.get_frame(0)  # warm up (buffers, OpenCV kernels)
+    start = time.perf_counter()
+    for i in range(frames):
+        clip.get_frame(i / frames)
+    return frames / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--frames", type=int, default=120, help="frames rendered per measurement")
+    args = parser.parse_args()
+
+    print(f"{'source':>12} {'before fps':>12} {'after fps':>12} {'speedup':>9}")
+    for width, height in RESOLUTIONS:
+        source = synthetic_clip(width, height, duration=1.0)
+        before = measure_fps(legacy_standardize_clip_size(source), args.frames)
+        after = measure_fps(standardize_clip_size(source), args.frames)
+        print(f"{width:>6}x{height:<5} {before:>12.1f} {after:>12.1f} {after / before:>8.1f}x")
+
+if __name__ == "__main__":
+    main()
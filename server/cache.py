@@ -0,0 +1,179 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+from contextlib import closing
+from metrics import CACHE_LOOKUPS
+
+logger = logging.getLogger("cache")
+
+CURRENT_DIR = os.path.abspath(os.path.dirname(__file__))
+CACHE_DIR = os.getenv("CACHE_DIR", os.path.join(CURRENT_DIR, "cache"))
+
+os.makedirs(CACHE_DIR, exist_ok=True)
+
+class PersistentCache:
+    """Key/value cache stored in SQLite, shared by every worker process on the host
+
+    Entries can expire after a TTL, and the least recently used entries are
+    evicted once max_entries or max_bytes is exceeded. Hit/miss counters are
+    kept in the database so stats cover all workers.
+
+    on_evict is called with {key: value} of the entries a set() expired,
+    evicted or replaced, for caches whose values point at files.
+    """
+
+    def __init__(self, name, ttl=None, max_entries=None, max_bytes=None, on_evict=None):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self.path = os.path.join(CACHE_DIR, f"{name}.db")
+        with closing(self._connect()) as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    value BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL,
+                    expires_at REAL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)")
+            conn.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            conn.execute("INSERT OR IGNORE INTO stats (name, value) VALUES ('hits', 0), ('misses', 0)")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def get(self, key):
+        """Return the cached bytes for key, or None on a miss"""
+        now = time.time()
+        try:
+            with closing(self._connect()) as conn:
+                row = conn.execute(
+                    "SELECT value, expires_at FROM entries WHERE key = ?", (key,)
+                ).fetchone()
+                hit = row is not None and (row[1] is None or row[1] > now)
+                if hit:
+                    conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (now, key))
+                conn.execute(
+                    "UPDATE stats SET value = value + 1 WHERE name = ?", ("hits" if hit else "misses",)
+                )
+        except sqlite3.Error as e:
+            # A broken cache must never break the request
+            logger.warning(f"Cache {self.name} read failed: {str(e)}")
+            return None
+        CACHE_LOOKUPS.labels(cache=self.name, result="hit" if hit else "miss").inc()
+        return row[0] if hit else None
+
+    def set(self, key, value, ttl=None):
+        """Store bytes under key, ttl overrides the cache's default TTL"""
+        now = time.time()
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = now + ttl if ttl else None
+        evicted = {}
+        try:
+            with closing(self._connect()) as conn:
+                if self.on_evict:
+                    row = conn.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+                    if row is not None and bytes(row[0]) != value:
+                        evicted[key] = row[0]
+                conn.execute(
+                    """INSERT OR REPLACE INTO entries (key, value, size, created_at, last_access, expires_at)
+                       VALUES (?, ?, ?, ?, ?, ?)""",
+                    (key, sqlite3.Binary(value), len(value), now, now, expires_at)
+                )
+                evicted.update(self._evict(conn, now))
+        except sqlite3.Error as e:
+            logger.warning(f"Cache {self.name} write failed: {str(e)}")
+        if evicted and self.on_evict:
+            try:
+                self.on_evict(evicted)
+            except Exception as e:
+                logger.warning(f"Cache {self.name} eviction callback failed: {str(e)}")
+
+    def get_json(self, key):
+        value = self.get(key)
+        return json.loads(value) if value is not None else None
+
+    def set_json(self, key, value, ttl=None):
+        self.set(key, json.dumps(value).encode("utf-8"), ttl=ttl)
+
+    def delete(self, key):
+        with closing(self._connect()) as conn:
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def keys(self):
+        """Keys of the entries that haven't expired"""
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT key FROM entries WHERE expires_at IS NULL OR expires_at > ?", (time.time(),)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def references(self, text):
+        """Whether any entry that hasn't expired contains text in its value"""
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                """SELECT 1 FROM entries WHERE (expires_at IS NULL OR expires_at > ?)
+                   AND instr(value, CAST(? AS BLOB)) > 0 LIMIT 1""",
+                (time.time(), text)
+            ).fetchone()
+        return row is not None
+
+    def _remove(self, conn, keys):
+        """Delete entries, returns their {key: value} when there is an on_evict callback"""
+        removed = {}
+        if self.on_evict:
+            for key in keys:
+                row = conn.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    removed[key] = row[0]
+        conn.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key in keys])
+        return removed
+
+    def _evict(self, conn, now):
+        """Delete expired entries, then least recently used ones over the limits; returns what on_evict gets"""
+        expired = conn.execute(
+            "SELECT key FROM entries WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,)
+        ).fetchall()
+        evicted = self._remove(conn, [row[0] for row in expired])
+        if self.max_entries:
+            excess = conn.execute(
+                "SELECT key FROM entries ORDER BY last_access DESC LIMIT -1 OFFSET ?", (self.max_entries,)
+            ).fetchall()
+            evicted.update(self._remove(conn, [row[0] for row in excess]))
+        if self.max_bytes:
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            if total > self.max_bytes:
+                # Walk from least recently used until enough bytes are freed
+                excess = total - self.max_bytes
+                keys = []
+                for key, size in conn.execute("SELECT key, size FROM entries ORDER BY last_access"):
+                    keys.append(key)
+                    excess -= size
+                    if excess <= 0:
+                        break
+                evicted.update(self._remove(conn, keys))
+        return evicted
+
+    def stats(self):
+        """Hit rate and size of the cache across all workers"""
+        with closing(self._connect()) as conn:
+            counters = dict(conn.execute("SELECT name, value FROM stats").fetchall())
+            entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        lookups = counters.get("hits", 0) + counters.get("misses", 0)
+        return {
+            "hits": counters.get("hits", 0),
+            "misses": counters.get("misses", 0),
+            "hit_rate": counters.get("hits", 0) / lookups if lookups else 0.0,
+            "entries": entries,
+            "bytes": size
+        }
@@ -0,0 +1,169 @@
+import os
+import asyncio
+import logging
+from PIL import Image
+from moviepy.config import get_setting
+from timeline import ZOOM_START, letterbox_geometry
+
+logger = logging.getLogger("video_generator")
+
+# Same binary MoviePy uses (imageio-ffmpeg's unless FFMPEG_BINARY is set)
+FFMPEG_BINARY = get_setting("FFMPEG_BINARY")
+# A render taking longer than this is killed
+FFMPEG_RENDER_TIMEOUT = float(os.getenv("FFMPEG_RENDER_TIMEOUT", "1800"))
+
+def _even(value):
+    return max(2, int(value) // 2 * 2)
+
+def _video_filter(index, segment, width, height, fps):
+    """Filter chain fitting a (looped) stock video into the frame"""
+    return (
+        f"[{index}:v]fps={fps},trim=duration={segment['duration']:.3f},setpts=PTS-STARTPTS,"
+        f"scale={width}:{height}:force_original_aspect_ratio=decrease,"
+        f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2:color=black,setsar=1,format=yuv420p"
+    )
+
+def _image_filter(index, segment, width, height, fps):
+    """Filter chain for the zoom out effect, ZOOM_START to 1.0x over the segment
+
+    Like the MoviePy engine the image is downsampled once to ZOOM_START times
+    its letterboxed size, zoompan then crops and scales that base per frame.
+    """
+    with Image.open(segment["path"]) as image:
+        w, h = image.size
+    fit_w, fit_h, _, _ = letterbox_geometry(w, h, width, height)
+    fit_w, fit_h = _even(fit_w), _even(fit_h)
+    base_w, base_h = _even(fit_w * ZOOM_START + 1), _even(fit_h * ZOOM_START + 1)
+    frames = max(1, round(segment["duration"] * fps))
+    zoom = f"{ZOOM_START}-{ZOOM_START - 1.0:.3f}*on/{frames}"
+    return (
+        f"[{index}:v]scale={base_w}:{base_h}:flags=area,format=yuv420p,"
+        f"zoompan=z='{zoom}':d=1:x='iw/2-(iw/zoom/2)':y='ih/2-(ih/zoom/2)':s={fit_w}x{fit_h}:fps={fps},"
+        f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2:color=black,setsar=1,"
+        f"trim=duration={segment['duration']:.3f},setpts=PTS-STARTPTS"
+    )
+
+def build_ffmpeg_command(segments, audio_path, output_path, total_duration, bg_music_path=None,
+                         width=1920, height=1080, fps=30, preset="ultrafast", crf=23, output_args=None):
+    """Compile a render timeline into a single ffmpeg command line
+
+    Every segment becomes one input and one filter chain, the chains are
+    concatenated and the voiceover is mixed with the background music.
+    The segment starts must be relative to the start of the output.
+    output_args replaces the MP4 output, e.g. with an HLS one.
+    """
+    inputs = []
+    filters = []
+    labels = []
+    input_count = 0
+
+    for segment in segments:
+        label = f"[v{len(labels)}]"
+        duration = f"{segment['duration']:.3f}"
+        if segment["kind"] == "video":
+            # Short clips are looped by the demuxer, long ones only read up to the duration
+            inputs += ["-stream_loop", "-1", "-t", duration, "-i", segment["path"]]
+            filters.append(_video_filter(input_count, segment, width, height, fps) + label)
+        elif segment["kind"] == "image":
+            inputs += ["-loop", "1", "-framerate", str(fps), "-t", duration, "-i", segment["path"]]
+            filters.append(_image_filter(input_count, segment, width, height, fps) + label)
+        else:
+            filters.append(f"color=c=black:s={width}x{height}:r={fps}:d={duration},setsar=1,format=yuv420p" + label)
+        if segment["kind"] != "blank":
+            input_count += 1
+        labels.append(label)
+
+    # Hold the last frame if rounding left the video a frame short, -t trims the rest
+    filters.append(
+        "".join(labels) + f"concat=n={len(labels)}:v=1:a=0,tpad=stop_mode=clone:stop_duration=1[vout]"
+    )
+
+    if audio_path is None:
+        # Video only, the audio is muxed in separately
+        audio_inputs, audio_args = [], ["-an"]
+    else:
+        audio_inputs, audio_filters = audio_mix(input_count, audio_path, total_duration, bg_music_path)
+        filters += audio_filters
+        audio_args = ["-map", "[aout]", "-c:a", "aac", "-b:a", "192k"]
+
+    if output_args is None:
+        output_args = ["-movflags", "+faststart", "-f", "mp4", output_path]
+
+    return [
+        FFMPEG_BINARY, "-y", "-hide_banner", "-loglevel", "error",
+        *inputs, *audio_inputs,
+        "-filter_complex", ";".join(filters),
+        "-map", "[vout]",
+        *video_codec_args(fps, preset, crf),
+        *audio_args,
+        "-t", f"{total_duration:.3f}",
+        *output_args
+    ]
+
+def build_mux_command(concat_list, audio_path, output_path, total_duration, bg_music_path=None):
+    """Join pre-encoded video segments without re-encoding and mux in the mixed audio
+
+    concat_list is an ffmpeg concat demuxer file listing the segments in order.
+    """
+    audio_inputs, audio_filters = audio_mix(1, audio_path, total_duration, bg_music_path)
+    return [
+        FFMPEG_BINARY, "-y", "-hide_banner", "-loglevel", "error",
+        "-f", "concat", "-safe", "0", "-i", concat_list,
+        *audio_inputs,
+        "-filter_complex", ";".join(audio_filters),
+        "-map", "0:v", "-map", "[aout]",
+        "-c:v", "copy",
+        "-c:a", "aac", "-b:a", "192k",
+        "-t", f"{total_duration:.3f}",
+        "-movflags", "+faststart",
+        "-f", "mp4", output_path
+    ]
+
+def video_codec_args(fps=30, preset="ultrafast", crf=23):
+    """Encoder settings shared by every engine, segments can only be stream-copied together if they match"""
+    return ["-c:v", "libx264", "-preset", preset, "-crf", str(crf), "-pix_fmt", "yuv420p", "-r", str(fps)]
+
+def audio_mix(audio_index, audio_path, total_duration, bg_music_path=None):
+    """Inputs and filters mixing the voiceover with the background music into [aout]
+
+    audio_index is the input number the voiceover will get. The music is a bed
+    from the music library, already as long as the video and leveled.
+    """
+    inputs = ["-i", audio_path]
+    fade_out_start = max(0.0, total_duration - 2.0)
+    voice = f"[{audio_index}:a]afade=t=in:st=0:d=1,afade=t=out:st={fade_out_start:.3f}:d=2"
+    if not bg_music_path:
+        return inputs, [voice + "[aout]"]
+
+    inputs += ["-i", bg_music_path]
+    return inputs, [
+        voice + "[voice]",
+        f"[voice][{audio_index + 1}:a]amix=inputs=2:duration=first:dropout_transition=0:normalize=0[aout]"
+    ]
+
+async def run_ffmpeg(command):
+    """Run an ffmpeg command line, raising RuntimeError with its stderr on failure"""
+    process = await asyncio.create_subprocess_exec(
+        *command, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        _, stderr = await asyncio.wait_for(process.communicate(), timeout=FFMPEG_RENDER_TIMEOUT)
+    except BaseException:
+        # Timed out or cancelled, don't leave ffmpeg running
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+
+    if process.returncode != 0:
+        message = stderr.decode("utf-8", "replace").strip()[-2000:]
+        raise RuntimeError(f"ffmpeg exited with status {process.returncode}: {message}")
+
+async def render_with_ffmpeg(segments, audio_path, output_path, total_duration, bg_music_path=None, **options):
+    """Render the timeline to output_path without passing any frame through Python
+
+    With audio_path None only the video stream is written.
+    """
+    command = build_ffmpeg_command(segments, audio_path, output_path, total_duration, bg_music_path, **options)
+    logger.info(f"Rendering {len(segments)} segments with ffmpeg to {output_path}")
+    await run_ffmpeg(command)
@@ -0,0 +1,207 @@
+import os
+import re
+import stat
+import uuid
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import quote
+import anyio
+from starlette.responses import Response
+
+# Chunk size when the server can't send the file itself
+CHUNK_SIZE = 256 * 1024
+# A request asking for more ranges than this (after merging) gets the whole file
+MAX_RANGES = 16
+
+_RANGE_SPEC = re.compile(r"^\s*(\d*)\s*-\s*(\d*)\s*$")
+
+def safe_filename(filename):
+    """The filename if it names a file directly inside a directory, otherwise None"""
+    if not filename or filename in (".", "..") or filename != os.path.basename(filename) or "\x00" in filename:
+        return None
+    return filename
+
+def make_etag(file_stat):
+    """Strong validator of a file; generated files are only ever replaced, never rewritten in place"""
+    return f'"{file_stat.st_ino:x}-{file_stat.st_size:x}-{file_stat.st_mtime_ns:x}"'
+
+def _etags(header):
+    return [tag.strip() for tag in header.split(",") if tag.strip()]
+
+def _if_none_match(header, etag):
+    """Weak comparison, as If-None-Match uses"""
+    tags = _etags(header)
+    return "*" in tags or etag in (tag[2:] if tag.startswith("W/") else tag for tag in tags)
+
+def _if_range_matches(header, etag, file_stat):
+    """Strong comparison of an If-Range validator (an ETag or an HTTP date)"""
+    header = header.strip()
+    if header.startswith('"') or header.startswith("W/"):
+        return header == etag
+    try:
+        return int(parsedate_to_datetime(header).timestamp()) == int(file_stat.st_mtime)
+    except (TypeError, ValueError):
+        return False
+
+def parse_range(header, size):
+    """Parse a Range header against a file of size bytes
+
+    Returns a sorted list of merged (start, end) inclusive ranges, None when
+    the header should be ignored (malformed, not bytes, or too many ranges)
+    and an empty list when no range is satisfiable.
+    """
+    unit, _, specs = header.partition("=")
+    if unit.strip().lower() != "bytes" or not specs.strip():
+        return None
+
+    ranges = []
+    for spec in specs.split(","):
+        match = _RANGE_SPEC.match(spec)
+        if not match or match.groups() == ("", ""):
+            return None
+        first, last = match.groups()
+        if first == "":
+            # Suffix range, the last N bytes
+            length = int(last)
+            if length == 0:
+                continue
+            ranges.append((max(0, size - length), size - 1))
+            continue
+        start = int(first)
+        end = int(last) if last else size - 1
+        if last and end < start:
+            return None
+        if start >= size:
+            continue
+        ranges.append((start, min(end, size - 1)))
+
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    if len(merged) > MAX_RANGES:
+        return None
+    return merged
+
+class RangeFileResponse(Response):
+    """Send whole files or byte ranges of them
+
+    Uses the server's zero-copy send when it offers the ASGI
+    http.response.zerocopysend extension, otherwise reads with pread in a
+    worker thread.
+    """
+
+    def __init__(self, path, file_stat, status_code, headers, ranges, boundary=None, media_type=None,
+                 send_body=True):
+        super().__init__(status_code=status_code, headers=headers)
+        self.path = path
+        self.file_stat = file_stat
+        self.ranges = ranges
+        self.boundary = boundary
+        self.part_media_type = media_type
+        self.send_body = send_body
+
+    def _parts(self):
+        """(prefix bytes, start, end) for every range to send, then the closing delimiter"""
+        if self.boundary is None:
+            return [(b"", start, end) for start, end in self.ranges], b""
+        parts = []
+        for start, end in self.ranges:
+            head = (
+                f"\r\n--{self.boundary}\r\nContent-Type: {self.part_media_type}\r\n"
+                f"Content-Range: bytes {start}-{end}/{self.file_stat.st_size}\r\n\r\n"
+            )
+            parts.append((head.encode("latin-1"), start, end))
+        return parts, f"\r\n--{self.boundary}--\r\n".encode("latin-1")
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if not self.send_body:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        parts, closing = self._parts()
+        zerocopy = "http.response.zerocopysend" in scope.get("extensions", {})
+        fd = await anyio.to_thread.run_sync(os.open, self.path, os.O_RDONLY)
+        try:
+            for prefix, start, end in parts:
+                if prefix:
+                    await send({"type": "http.response.body", "body": prefix, "more_body": True})
+                if zerocopy:
+                    await send({
+                        "type": "http.response.zerocopysend", "file": fd,
+                        "offset": start, "count": end - start + 1, "more_body": True
+                    })
+                    continue
+                position = start
+                while position <= end:
+                    chunk = await anyio.to_thread.run_sync(os.pread, fd, min(CHUNK_SIZE, end - position + 1), position)
+                    if not chunk:
+                        # Truncated underneath us, end the response rather than spin
+                        raise OSError(f"{self.path} shrank while being sent")
+                    position += len(chunk)
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": closing, "more_body": False})
+        finally:
+            os.close(fd)
+
+def file_response(path, request_headers, method="GET", media_type="application/octet-stream", filename=None,
+                  cache_control="public, max-age=3600"):
+    """Serve a file with byte ranges (206, multipart/byteranges, 416) and conditional requests (304)
+
+    request_headers is the incoming request's headers. Raises
+    FileNotFoundError if path isn't a regular file.
+    """
+    file_stat = os.stat(path)
+    if not stat.S_ISREG(file_stat.st_mode):
+        raise FileNotFoundError(path)
+    size = file_stat.st_size
+    etag = make_etag(file_stat)
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Last-Modified": formatdate(file_stat.st_mtime, usegmt=True),
+        "Cache-Control": cache_control
+    }
+    if filename:
+        headers["Content-Disposition"] = f"attachment; filename*=utf-8''{quote(filename)}"
+
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match is not None and _if_none_match(if_none_match, etag):
+        del headers["Accept-Ranges"]
+        return Response(status_code=304, headers=headers)
+
+    send_body = method != "HEAD"
+    ranges = None
+    range_header = request_headers.get("range")
+    if range_header is not None and method in ("GET", "HEAD"):
+        if_range = request_headers.get("if-range")
+        if if_range is None or _if_range_matches(if_range, etag, file_stat):
+            ranges = parse_range(range_header, size)
+
+    if ranges is None or size == 0:
+        headers["Content-Type"] = media_type
+        headers["Content-Length"] = str(size)
+        return RangeFileResponse(path, file_stat, 200, headers, [(0, size - 1)] if size else [], send_body=send_body)
+
+    if not ranges:
+        headers["Content-Range"] = f"bytes */{size}"
+        return Response(status_code=416, headers=headers)
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers["Content-Type"] = media_type
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
+        return RangeFileResponse(path, file_stat, 206, headers, ranges, send_body=send_body)
+
+    boundary = uuid.uuid4().hex
+    response = RangeFileResponse(
+        path, file_stat, 206, headers, ranges, boundary=boundary, media_type=media_type, send_body=send_body
+    )
+    parts, closing = response._parts()
+    length = sum(len(prefix) + end - start + 1 for prefix, start, end in parts) + len(closing)
+    response.headers["Content-Type"] = f"multipart/byteranges; boundary={boundary}"
+    response.headers["Content-Length"] = str(length)
+    return response
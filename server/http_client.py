@@ -0,0 +1,129 @@
+import os
+import random
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
+import httpx
+from metrics import UPSTREAM_ERRORS, upstream_service
+
+logger = logging.getLogger("http_client")
+
+# Connection pool settings shared by every upstream (AI API, Eleven Labs, Pexels)
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+HTTP_MAX_PER_HOST = int(os.getenv("HTTP_MAX_PER_HOST", "16"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "120"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+
+# Status codes that are worth retrying
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+MAX_BACKOFF = 30.0
+
+# One client and set of per-host limits per event loop. Render workers run
+# each job in its own loop, so clients can't be shared across loops.
+_loop_state = {}
+
+def _get_state():
+    loop = asyncio.get_running_loop()
+    state = _loop_state.get(loop)
+    if state is None or state["client"].is_closed:
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE
+            ),
+            timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            follow_redirects=True
+        )
+        state = {"client": client, "hosts": {}}
+        _loop_state[loop] = state
+    return state
+
+def get_client() -> httpx.AsyncClient:
+    """Get the shared keep-alive client for the running event loop"""
+    return _get_state()["client"]
+
+@asynccontextmanager
+async def _host_slot(url):
+    """Limit the number of concurrent requests to a single host"""
+    hosts = _get_state()["hosts"]
+    host = urlsplit(url).netloc
+    semaphore = hosts.get(host)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(HTTP_MAX_PER_HOST)
+        hosts[host] = semaphore
+    async with semaphore:
+        yield
+
+def _retry_delay(attempt, backoff, response=None):
+    """Exponential backoff with jitter, honouring Retry-After when present"""
+    if response is not None:
+        retry_after = response.headers.get("retry-after")
+        if retry_after:
+            try:
+                return min(float(retry_after), MAX_BACKOFF)
+            except ValueError:
+                pass
+    delay = backoff * (2 ** attempt)
+    return min(delay + random.uniform(0, delay / 2), MAX_BACKOFF)
+
+async def request(method, url, retries=3, backoff=1.0, retry_statuses=RETRY_STATUSES, **kwargs) -> httpx.Response:
+    """Make an HTTP request through the shared pool with async retry/backoff
+
+    Raises httpx.HTTPError once all attempts are used up.
+    """
+    client = get_client()
+    for attempt in range(retries):
+        last_attempt = attempt == retries - 1
+        try:
+            async with _host_slot(url):
+                response = await client.request(method, url, **kwargs)
+        except httpx.TransportError as e:
+            UPSTREAM_ERRORS.labels(service=upstream_service(url), reason="transport").inc()
+            if last_attempt:
+                raise
+            delay = _retry_delay(attempt, backoff)
+            logger.warning(f"{method} {url} failed: {str(e)}, retrying in {delay:.1f}s (Attempt {attempt + 1}/{retries})")
+            await asyncio.sleep(delay)
+            continue
+
+        if response.is_error:
+            UPSTREAM_ERRORS.labels(service=upstream_service(url), reason=str(response.status_code)).inc()
+        if response.status_code in retry_statuses and not last_attempt:
+            delay = _retry_delay(attempt, backoff, response)
+            logger.warning(f"{method} {url} returned {response.status_code}, retrying in {delay:.1f}s (Attempt {attempt + 1}/{retries})")
+            await asyncio.sleep(delay)
+            continue
+
+        response.raise_for_status()
+        return response
+
+async def download_to_file(url, filepath, retries=3, backoff=1.0, chunk_size=65536, **kwargs) -> int:
+    """Stream a response body to a file through the shared pool, returns the number of bytes written"""
+    client = get_client()
+    for attempt in range(retries):
+        try:
+            async with _host_slot(url):
+                async with client.stream("GET", url, **kwargs) as response:
+                    response.raise_for_status()
+                    written = 0
+                    with open(filepath, "wb") as f:
+                        async for chunk in response.aiter_bytes(chunk_size):
+                            f.write(chunk)
+                            written += len(chunk)
+                    return written
+        except httpx.HTTPError as e:
+            reason = str(e.response.status_code) if isinstance(e, httpx.HTTPStatusError) else "transport"
+            UPSTREAM_ERRORS.labels(service=upstream_service(url), reason=reason).inc()
+            if attempt == retries - 1:
+                raise
+            delay = _retry_delay(attempt, backoff)
+            logger.warning(f"Download of {url} failed: {str(e)}, retrying in {delay:.1f}s (Attempt {attempt + 1}/{retries})")
+            await asyncio.sleep(delay)
+
+async def close_client():
+    """Close the shared client of the running event loop"""
+    state = _loop_state.pop(asyncio.get_running_loop(), None)
+    if state is not None:
+        await state["client"].aclose()
@@ -0,0 +1,383 @@
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import asyncio
+import logging
+import multiprocessing
+from contextlib import closing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Any, Optional
+from fastapi import HTTPException
+from quality import get_quality_profile
+from profiling import current_profile_id, enable_profiling
+
+logger = logging.getLogger("render_jobs")
+
+CURRENT_DIR = os.path.abspath(os.path.dirname(__file__))
+JOBS_DB_PATH = os.getenv("RENDER_JOBS_DB", os.path.join(CURRENT_DIR, "render_jobs.db"))
+
+# Number of worker processes used for rendering
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", "2"))
+# A running job whose owner has not sent a heartbeat for this long is requeued
+JOB_LEASE_SECONDS = float(os.getenv("RENDER_JOB_LEASE_SECONDS", "60"))
+# Jobs are marked failed after this many interrupted attempts
+JOB_MAX_ATTEMPTS = int(os.getenv("RENDER_JOB_MAX_ATTEMPTS", "3"))
+DISPATCH_INTERVAL = 1.0
+
+# Dispatcher state for this server process
+_owner_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+_pool = None
+_dispatcher_task = None
+_in_flight = {}
+
+def _connect():
+    """Open a connection to the job store"""
+    conn = sqlite3.connect(JOBS_DB_PATH, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+def init_job_store():
+    """Create the jobs table if it doesn't exist"""
+    with closing(_connect()) as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                owner TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL,
+                heartbeat_at REAL,
+                preview TEXT
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at)")
+        # Job stores created before draft renders existed
+        columns = [row["name"] for row in conn.execute("PRAGMA table_info(jobs)")]
+        if "preview" not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN preview TEXT")
+
+def _row_to_job(row):
+    """Convert a jobs row to the public job representation"""
+    payload = json.loads(row["payload"])
+    result = json.loads(row["result"]) if row["result"] else None
+    return {
+        "job_id": row["id"],
+        "status": row["status"],
+        "quality": payload.get("quality") or "full",
+        # HLS stream of the render while it runs, see stream_render. Once done,
+        # the one the render actually wrote (none for a cached or fallback render)
+        "stream_id": result.get("video_data", {}).get("stream_id") if result else payload.get("stream_id"),
+        "attempts": row["attempts"],
+        "created_at": row["created_at"],
+        "started_at": row["started_at"],
+        "finished_at": row["finished_at"],
+        "error": row["error"],
+        "result": result,
+        # Result of the draft render of a promoted job
+        "preview": json.loads(row["preview"]) if row["preview"] else None
+    }
+
+def create_job(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Persist a new render job in the queued state"""
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    with closing(_connect()) as conn:
+        conn.execute(
+            "INSERT INTO jobs (id, status, payload, created_at, updated_at) VALUES (?, 'queued', ?, ?, ?)",
+            (job_id, json.dumps(payload), now, now)
+        )
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    logger.info(f"Queued render job {job_id}")
+    return _row_to_job(row)
+
+def get_job(job_id: str) -> Optional[Dict[str, Any]]:
+    """Look up a job by id, returns None if it doesn't exist"""
+    with closing(_connect()) as conn:
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return _row_to_job(row) if row else None
+
+def job_references(text: str, finished_since: float) -> bool:
+    """Whether a queued or running job, or one finished after finished_since, mentions text
+
+    Looks in the payload, result and draft preview, e.g. for a video path.
+    """
+    with closing(_connect()) as conn:
+        row = conn.execute(
+            """SELECT 1 FROM jobs
+               WHERE (status IN ('queued', 'running') OR finished_at >= ?)
+               AND (instr(payload, ?) > 0 OR instr(COALESCE(result, ''), ?) > 0
+                    OR instr(COALESCE(preview, ''), ?) > 0)
+               LIMIT 1""",
+            (finished_since, text, text, text)
+        ).fetchone()
+    return row is not None
+
+def promote_job(job_id: str) -> Dict[str, Any]:
+    """Queue a full quality render of a draft job, keeping the draft result as its preview
+
+    A draft that is still queued is simply upgraded in place.
+    """
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            raise HTTPException(status_code=404, detail=f"Render job {job_id} not found")
+        payload = json.loads(row["payload"])
+        if (payload.get("quality") or "full") != "draft":
+            raise HTTPException(status_code=409, detail=f"Render job {job_id} is already full quality")
+        if row["status"] == "running":
+            raise HTTPException(status_code=409, detail=f"Render job {job_id} is still rendering its draft")
+
+        payload["quality"] = "full"
+        now = time.time()
+        conn.execute(
+            """UPDATE jobs SET status = 'queued', payload = ?, preview = ?, result = NULL, error = NULL,
+               attempts = 0, owner = NULL, started_at = NULL, finished_at = NULL, heartbeat_at = NULL,
+               updated_at = ? WHERE id = ?""",
+            (json.dumps(payload), row["result"] if row["status"] == "done" else None, now, job_id)
+        )
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    logger.info(f"Promoted render job {job_id} to full quality")
+    return get_job(job_id)
+
+def _claim_next_job():
+    """Atomically move the oldest queued job to running and return it"""
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(
+            "SELECT * FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1"
+        ).fetchone()
+        if not row:
+            conn.execute("COMMIT")
+            return None
+        now = time.time()
+        conn.execute(
+            """UPDATE jobs SET status = 'running', owner = ?, attempts = attempts + 1,
+               started_at = ?, heartbeat_at = ?, updated_at = ? WHERE id = ?""",
+            (_owner_id, now, now, now, row["id"])
+        )
+        conn.execute("COMMIT")
+        return row["id"], json.loads(row["payload"])
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+def _heartbeat(job_ids):
+    """Extend the lease of jobs this process is rendering"""
+    if not job_ids:
+        return
+    now = time.time()
+    with closing(_connect()) as conn:
+        conn.executemany(
+            "UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND owner = ? AND status = 'running'",
+            [(now, job_id, _owner_id) for job_id in job_ids]
+        )
+
+def _requeue_stale_jobs():
+    """Recover running jobs whose owner stopped sending heartbeats (e.g. after a restart)"""
+    now = time.time()
+    cutoff = now - JOB_LEASE_SECONDS
+    with closing(_connect()) as conn:
+        failed = conn.execute(
+            """UPDATE jobs SET status = 'failed', error = 'Render was interrupted too many times',
+               finished_at = ?, updated_at = ?
+               WHERE status = 'running' AND heartbeat_at < ? AND attempts >= ?""",
+            (now, now, cutoff, JOB_MAX_ATTEMPTS)
+        ).rowcount
+        requeued = conn.execute(
+            """UPDATE jobs SET status = 'queued', owner = NULL, updated_at = ?
+               WHERE status = 'running' AND heartbeat_at < ?""",
+            (now, cutoff)
+        ).rowcount
+    if failed or requeued:
+        logger.warning(f"Recovered stale render jobs: {requeued} requeued, {failed} failed")
+
+def _finish_job(job_id, result=None, error=None):
+    """Record the outcome of a job rendered by this process"""
+    now = time.time()
+    with closing(_connect()) as conn:
+        conn.execute(
+            """UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ?, updated_at = ?
+               WHERE id = ? AND owner = ?""",
+            ("failed" if error else "done", json.dumps(result) if result is not None else None,
+             error, now, now, job_id, _owner_id)
+        )
+
+def _release_job(job_id):
+    """Put a job back in the queue without finishing it"""
+    now = time.time()
+    with closing(_connect()) as conn:
+        conn.execute(
+            "UPDATE jobs SET status = 'queued', owner = NULL, updated_at = ? WHERE id = ? AND owner = ?",
+            (now, job_id, _owner_id)
+        )
+
+def _requeue_crashed_job(job_id):
+    """Retry a job whose worker died, or fail it once it used up its attempts
+
+    A render that keeps crashing its worker would otherwise break the pool,
+    and the other renders in it, forever.
+    """
+    now = time.time()
+    with closing(_connect()) as conn:
+        failed = conn.execute(
+            """UPDATE jobs SET status = 'failed', error = 'Render worker crashed too many times',
+               finished_at = ?, updated_at = ?
+               WHERE id = ? AND owner = ? AND attempts >= ?""",
+            (now, now, job_id, _owner_id, JOB_MAX_ATTEMPTS)
+        ).rowcount
+        if not failed:
+            conn.execute(
+                "UPDATE jobs SET status = 'queued', owner = NULL, updated_at = ? WHERE id = ? AND owner = ?",
+                (now, job_id, _owner_id)
+            )
+    if failed:
+        logger.error(f"Render job {job_id} failed after crashing its worker {JOB_MAX_ATTEMPTS} times")
+
+def run_render_job(payload):
+    """Render a video inside a worker process
+
+    Returns a plain dict so the outcome pickles cleanly back to the dispatcher.
+    """
+    from video import VideoRequest, generate_video
+    from http_client import close_client
+
+    async def render():
+        if payload.get("profile_id"):
+            enable_profiling(payload["profile_id"])
+        try:
+            return await generate_video(VideoRequest(**payload))
+        finally:
+            await close_client()
+
+    try:
+        result = asyncio.run(render())
+        return {"ok": True, "result": result}
+    except HTTPException as e:
+        return {"ok": False, "error": str(e.detail), "status_code": e.status_code}
+    except Exception as e:
+        return {"ok": False, "error": str(e), "status_code": 500}
+
+def _create_pool():
+    # Spawn keeps the workers independent of the uvicorn event loop and its threads
+    return ProcessPoolExecutor(
+        max_workers=RENDER_WORKERS,
+        mp_context=multiprocessing.get_context("spawn")
+    )
+
+async def _run_job(job_id, payload):
+    """Hand a claimed job to the process pool and store its outcome"""
+    global _pool
+    loop = asyncio.get_running_loop()
+    try:
+        outcome = await loop.run_in_executor(_pool, run_render_job, payload)
+        if outcome["ok"]:
+            logger.info(f"Render job {job_id} finished")
+            await asyncio.to_thread(_finish_job, job_id, result=outcome["result"])
+        else:
+            logger.error(f"Render job {job_id} failed: {outcome['error']}")
+            await asyncio.to_thread(_finish_job, job_id, error=outcome["error"])
+    except BrokenProcessPool:
+        # A worker died (e.g. OOM); the job is retried until it runs out of attempts
+        logger.error(f"Render worker crashed while running job {job_id}, recreating pool")
+        if _pool is not None and getattr(_pool, "_broken", False):
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = _create_pool()
+        await asyncio.to_thread(_requeue_crashed_job, job_id)
+    except asyncio.CancelledError:
+        await asyncio.to_thread(_release_job, job_id)
+        raise
+    except Exception as e:
+        logger.error(f"Unexpected error running render job {job_id}: {str(e)}")
+        await asyncio.to_thread(_finish_job, job_id, error=str(e))
+    finally:
+        _in_flight.pop(job_id, None)
+
+async def _dispatch_loop():
+    """Claim queued jobs while there are free workers and keep leases alive"""
+    while True:
+        try:
+            await asyncio.to_thread(_requeue_stale_jobs)
+            while len(_in_flight) < RENDER_WORKERS:
+                claimed = await asyncio.to_thread(_claim_next_job)
+                if not claimed:
+                    break
+                job_id, payload = claimed
+                logger.info(f"Starting render job {job_id}")
+                _in_flight[job_id] = asyncio.create_task(_run_job(job_id, payload))
+            await asyncio.to_thread(_heartbeat, list(_in_flight))
+        except Exception as e:
+            logger.error(f"Render job dispatcher error: {str(e)}")
+        await asyncio.sleep(DISPATCH_INTERVAL)
+
+def start_render_workers():
+    """Start the worker pool and the dispatcher for this server process"""
+    global _pool, _dispatcher_task
+    if _dispatcher_task is not None:
+        return
+    init_job_store()
+    _pool = _create_pool()
+    _dispatcher_task = asyncio.get_running_loop().create_task(_dispatch_loop())
+    logger.info(f"Started {RENDER_WORKERS} render workers ({_owner_id})")
+
+async def stop_render_workers():
+    """Stop dispatching and put unfinished jobs back in the queue"""
+    global _pool, _dispatcher_task
+    if _dispatcher_task is not None:
+        _dispatcher_task.cancel()
+        _dispatcher_task = None
+    for task in list(_in_flight.values()):
+        task.cancel()
+    if _in_flight:
+        await asyncio.gather(*_in_flight.values(), return_exceptions=True)
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+def submit_render_job(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Validate and queue a render request"""
+    voiceover_data = payload.get("voiceover_data")
+    if not voiceover_data or "timestamps" not in voiceover_data:
+        raise HTTPException(status_code=400, detail="Valid voiceover data with timestamps is required")
+    # Reject unknown quality tiers now rather than when the job runs
+    get_quality_profile(payload.get("quality"))
+    if payload.get("stream") and not payload.get("stream_id"):
+        from video import find_cached_render
+        # A cached render returns the existing video, it never opens a stream
+        if find_cached_render(payload) is None:
+            # Known up front so the client can open the stream while the job is queued
+            payload = dict(payload, stream_id=uuid.uuid4().hex)
+    if not payload.get("profile_id") and current_profile_id():
+        # The submitting request is being profiled, profile its render too
+        payload = dict(payload, profile_id=current_profile_id())
+    return create_job(payload)
+
+async def wait_for_job(job_id: str, poll_interval: float = 1.0) -> Dict[str, Any]:
+    """Wait without blocking the event loop until a job is done or failed"""
+    while True:
+        job = await asyncio.to_thread(get_job, job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail=f"Render job {job_id} not found")
+        if job["status"] in ("done", "failed"):
+            return job
+        await asyncio.sleep(poll_interval)
@@ -1,34 +1,118 @@
 import os
+import time
+import asyncio
 from fastapi import FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
-from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.datastructures import Headers, MutableHeaders, QueryParams
+from starlette.routing import Match
 
 
 
 # Import functionality from modules
 from utils import validate_api_keys
+from http_client import close_client
 from subtopics import get_educational_subtopics
 from script import ScriptRequest, generate_educational_script
-from voiceover import VoiceoverRequest, generate_voiceover, download_audio
+from voiceover import VoiceoverRequest, generate_voiceover, download_audio, tts_cache
 from video import VideoRequest, generate_video, download_video
+from jobs import start_render_workers, stop_render_workers, submit_render_job, get_job, wait_for_job, promote_job
+from assets import search_cache
+from utils import llm_cache
+from media_cache import media_cache_stats
+from music_library import build_music_library, BACKGROUND_MUSIC
+from pipeline import PipelineRequest, run_pipeline
+from stream_render import serve_stream_file
+from render_cache import render_cache
+from metrics import REQUESTS_IN_FLIGHT, REQUEST_LATENCY, metrics_response_body
+from profiling import wants_profile, request_id_from, enable_profiling
 
 # Initialize FastAPI app
 app = FastAPI(title="Educational Subtopics API")
 
+# The middlewares below are plain ASGI. BaseHTTPMiddleware ends its responses
+# with an extra empty body message, which lets uvicorn arm the keep-alive
+# timeout while the client's next request on the connection is already
+# running, so a render taking over 5s was cut off without a response.
+
 # Define a custom middleware to ensure CORS headers are present on every response
-class CORSHeaderMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        # Process the request and get the response
-        response = await call_next(request)
-        
-        # Add CORS headers to every response
-        response.headers["Access-Control-Allow-Origin"] = "https://edverse-mu.vercel.app"
-        response.headers["Access-Control-Allow-Credentials"] = "true"
-        response.headers["Access-Control-Allow-Methods"] = "GET, POST, PUT, DELETE, OPTIONS"
-        response.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization, X-Requested-With"
+class CORSHeaderMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        async def send_with_cors(message):
+            if message["type"] == "http.response.start":
+                # Add CORS headers to every response
+                headers = MutableHeaders(scope=message)
+                headers["Access-Control-Allow-Origin"] = "https://edverse-mu.vercel.app"
+                headers["Access-Control-Allow-Credentials"] = "true"
+                headers["Access-Control-Allow-Methods"] = "GET, POST, PUT, DELETE, OPTIONS"
+                headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization, X-Requested-With"
+            await send(message)
+
+        await self.app(scope, receive, send_with_cors)
+
+# Track in-flight requests and latency per route template, so ids in paths don't explode the label set
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        endpoint = "unmatched"
+        for route in scope["app"].routes:
+            if route.matches(scope)[0] == Match.FULL:
+                endpoint = route.path
+                break
         
-        return response
+        in_flight = REQUESTS_IN_FLIGHT.labels(endpoint=endpoint)
+        in_flight.inc()
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            in_flight.dec()
+            REQUEST_LATENCY.labels(endpoint=endpoint, method=scope["method"], status=str(status)).observe(
+                time.perf_counter() - started
+            )
+
+app.add_middleware(MetricsMiddleware)
+
+# Opt-in profiling (X-Profile: 1, ?profile=1 or PROFILE_SAMPLE_RATE), see profiling.py
+class ProfilingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = Headers(scope=scope)
+        if not wants_profile(headers, QueryParams(scope["query_string"])):
+            return await self.app(scope, receive, send)
+        request_id = request_id_from(headers)
+        enable_profiling(request_id)
+
+        async def send_with_profile_id(message):
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message)["X-Profile-Id"] = request_id
+            await send(message)
+
+        await self.app(scope, receive, send_with_profile_id)
+
+app.add_middleware(ProfilingMiddleware)
 
 # Add our custom CORS middleware first
 app.add_middleware(CORSHeaderMiddleware)
@@ -49,13 +133,29 @@ try:
 except Exception as e:
     print(f"WARNING: {str(e)}")
 
+@app.on_event("startup")
+async def startup_event():
+    # Renders run in worker processes so they never block the event loop
+    start_render_workers()
+    if BACKGROUND_MUSIC:
+        # Decode and level the background music once, in the background so startup isn't held up
+        asyncio.get_running_loop().run_in_executor(None, build_music_library)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await stop_render_workers()
+    await close_client()
+
 @app.get("/")
 def read_root():
     return {"message": "Welcome to the Educational Subtopics API. Use /subtopics endpoint with a concept parameter."}
 
 @app.get("/subtopics")
-async def subtopics_endpoint(concept: str = Query(..., description="The concept to get educational subtopics for")):
-    return await get_educational_subtopics(concept)
+async def subtopics_endpoint(
+    concept: str = Query(..., description="The concept to get educational subtopics for"),
+    bypass_cache: bool = Query(False, description="Skip the LLM cache and generate fresh subtopics")
+):
+    return await get_educational_subtopics(concept, bypass_cache=bypass_cache)
 
 @app.post("/script")
 async def script_endpoint(request: ScriptRequest):
@@ -68,7 +168,12 @@ async def voiceover_endpoint(request: VoiceoverRequest):
 @app.post("/generate_video")
 async def video_endpoint(request: VideoRequest):
     try:
-        response = await generate_video(request)
+        # Render through the job queue and wait for it without blocking other clients
+        job = await asyncio.to_thread(submit_render_job, request.model_dump())
+        job = await wait_for_job(job["job_id"])
+        if job["status"] == "failed":
+            raise Exception(job["error"])
+        response = job["result"]
         
         # Convert any response to a JSONResponse
         if not isinstance(response, dict):
@@ -79,17 +184,70 @@ async def video_endpoint(request: VideoRequest):
         print(f"Error in generate_video: {str(e)}")
         return JSONResponse(
             status_code=500,
-            content={"error": str(e)}
+            content={"error": str(e.detail) if isinstance(e, HTTPException) else str(e)}
         )
 
-@app.get("/download_video/{filename}")
-async def download_video_endpoint(filename: str):
+@app.post("/pipeline")
+async def pipeline_endpoint(request: PipelineRequest):
+    # Subtopics, script, voiceover and video in one round trip
+    return await run_pipeline(request)
+
+@app.post("/video_jobs")
+async def create_video_job_endpoint(request: VideoRequest):
+    # The job store is SQLite, keep its calls (and busy waits) off the event loop
+    job = await asyncio.to_thread(submit_render_job, request.model_dump())
+    return JSONResponse(status_code=202, content=job)
+
+@app.get("/video_jobs/{job_id}")
+async def video_job_status_endpoint(job_id: str):
+    job = await asyncio.to_thread(get_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Render job {job_id} not found")
+    return job
+
+@app.get("/video_jobs/{job_id}/result")
+async def video_job_result_endpoint(job_id: str):
+    job = await asyncio.to_thread(get_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Render job {job_id} not found")
+    if job["status"] == "failed":
+        return JSONResponse(status_code=500, content={"error": job["error"], "job_id": job_id})
+    if job["status"] != "done":
+        return JSONResponse(status_code=202, content={"job_id": job_id, "status": job["status"]})
+    return job["result"]
+
+@app.post("/video_jobs/{job_id}/promote")
+async def promote_video_job_endpoint(job_id: str):
+    job = await asyncio.to_thread(promote_job, job_id)
+    return JSONResponse(status_code=202, content=job)
+
+@app.get("/cache_stats")
+async def cache_stats_endpoint():
+    return {
+        "llm_responses": llm_cache.stats(),
+        "tts_fragments": tts_cache.stats(),
+        "pexels_search": search_cache.stats(),
+        "media": media_cache_stats(),
+        "renders": render_cache.stats()
+    }
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    # Prometheus exposition, covers the render worker processes too
+    body, content_type = metrics_response_body()
+    return Response(content=body, media_type=content_type)
+
+@app.api_route("/download_video/{filename}", methods=["GET", "HEAD"])
+async def download_video_endpoint(filename: str, request: Request):
     print(f"Request to download video file: {filename}")
     try:
         # Get the response from the download_video function
-        response = await download_video(filename)
+        response = await download_video(filename, request.headers, request.method)
         print(f"Video file {filename} successfully streamed")
         return response
+    except HTTPException:
+        # 202 while rendering, 404 for unknown files
+        raise
     except Exception as e:
         print(f"Error streaming video file {filename}: {str(e)}")
         return JSONResponse(
@@ -97,6 +255,15 @@ async def download_video_endpoint(filename: str):
             content={"error": f"Error streaming video: {str(e)}"}
         )
 
+@app.api_route("/download_audio/{filename}", methods=["GET", "HEAD"])
+async def download_audio_endpoint(filename: str, request: Request):
+    return await download_audio(filename, request.headers, request.method)
+
+@app.get("/video_streams/{stream_id}/{filename}")
+async def video_stream_endpoint(stream_id: str, filename: str):
+    # HLS playlist (index.m3u8) and segments of a render started with stream=true
+    return await serve_stream_file(stream_id, filename)
+
 # Handle all exceptions globally
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
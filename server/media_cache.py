@@ -0,0 +1,164 @@
+import os
+import time
+import uuid
+import fcntl
+import asyncio
+import hashlib
+import logging
+from metrics import CACHE_LOOKUPS
+
+logger = logging.getLogger("video_generator")
+
+CURRENT_DIR = os.path.abspath(os.path.dirname(__file__))
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR", os.path.join(CURRENT_DIR, "media_assets", "cache"))
+# Total size the cache may grow to before least recently used files are evicted (0 disables the cache)
+MEDIA_CACHE_MAX_BYTES = int(os.getenv("MEDIA_CACHE_MAX_BYTES", str(5 * 1024 ** 3)))
+# Files used more recently than this are never evicted, a render may still be reading them
+MEDIA_CACHE_EVICTION_GRACE = float(os.getenv("MEDIA_CACHE_EVICTION_GRACE", "3600"))
+
+LOCK_DIR = os.path.join(MEDIA_CACHE_DIR, "locks")
+TMP_SUFFIX = ".part"
+
+os.makedirs(LOCK_DIR, exist_ok=True)
+
+# Downloads in progress in this process, so concurrent scenes share one fetch
+_pending = {}
+
+def media_cache_enabled():
+    return MEDIA_CACHE_MAX_BYTES > 0
+
+def media_cache_key(asset_id, url):
+    """Content address of a Pexels rendition: hash of the asset id and rendition URL"""
+    return hashlib.sha256(f"{asset_id}\n{url}".encode("utf-8")).hexdigest()
+
+def media_cache_path(key, extension):
+    return os.path.join(MEDIA_CACHE_DIR, key[:2], key + extension)
+
+def _touch(path):
+    """Mark a cache entry as recently used, returns False if it no longer exists"""
+    try:
+        os.utime(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+def _lock_path(key):
+    return os.path.join(LOCK_DIR, key + ".lock")
+
+def _lock_file(key):
+    """Take the cross-process lock for a key (blocking)"""
+    fd = os.open(_lock_path(key), os.O_RDWR | os.O_CREAT, 0o644)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    return fd
+
+def _unlock_file(fd):
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    os.close(fd)
+
+async def _fetch(key, path, download):
+    # Another worker may be downloading the same asset, wait for it instead of fetching twice
+    lock = asyncio.ensure_future(asyncio.to_thread(_lock_file, key))
+    try:
+        fd = await asyncio.shield(lock)
+    except asyncio.CancelledError:
+        # Release the lock once the waiting thread gets it
+        lock.add_done_callback(lambda f: f.cancelled() or f.exception() or _unlock_file(f.result()))
+        raise
+    try:
+        if _touch(path):
+            logger.info(f"Media cache hit (after wait): {path}")
+            return path
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex[:8]}{TMP_SUFFIX}"
+        try:
+            size = await download(tmp_path)
+            # Atomic rename, readers only ever see complete files
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        logger.info(f"Media cache stored {size} bytes: {path}")
+    finally:
+        _unlock_file(fd)
+
+    await asyncio.to_thread(evict_media_cache)
+    return path
+
+async def get_cached_media(asset_id, url, extension, download):
+    """Return the local path of a media file, downloading it on a cache miss
+
+    download is a coroutine function taking the destination path and returning
+    the number of bytes written.
+    """
+    key = media_cache_key(asset_id, url)
+    path = media_cache_path(key, extension)
+    if _touch(path):
+        logger.info(f"Media cache hit: {path}")
+        CACHE_LOOKUPS.labels(cache="media", result="hit").inc()
+        return path
+    CACHE_LOOKUPS.labels(cache="media", result="miss").inc()
+
+    pending = _pending.get(key)
+    if pending is None:
+        pending = asyncio.ensure_future(_fetch(key, path, download))
+        _pending[key] = pending
+        pending.add_done_callback(lambda _: _pending.pop(key, None))
+    return await asyncio.shield(pending)
+
+def _cache_entries():
+    """List (last_used, size, path) of every complete file in the cache"""
+    entries = []
+    for shard in os.scandir(MEDIA_CACHE_DIR):
+        if not shard.is_dir() or shard.path == LOCK_DIR:
+            continue
+        for entry in os.scandir(shard.path):
+            if entry.name.endswith(TMP_SUFFIX):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    return entries
+
+def evict_media_cache(max_bytes=None):
+    """Remove least recently used files until the cache fits in its byte budget"""
+    if max_bytes is None:
+        max_bytes = MEDIA_CACHE_MAX_BYTES
+    entries = _cache_entries()
+    total = sum(size for _, size, _ in entries)
+    if total <= max_bytes:
+        return 0
+
+    grace_cutoff = time.time() - MEDIA_CACHE_EVICTION_GRACE
+    evicted = 0
+    for last_used, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if last_used > grace_cutoff:
+            break
+        try:
+            os.remove(path)
+            total -= size
+            evicted += 1
+        except FileNotFoundError:
+            pass
+        key = os.path.splitext(os.path.basename(path))[0]
+        try:
+            os.remove(_lock_path(key))
+        except FileNotFoundError:
+            pass
+    if evicted:
+        logger.info(f"Media cache evicted {evicted} files, {total} bytes remaining")
+    if total > max_bytes:
+        logger.warning(f"Media cache is over budget ({total} > {max_bytes} bytes) with files still in use")
+    return evicted
+
+def media_cache_stats():
+    entries = _cache_entries()
+    return {
+        "files": len(entries),
+        "bytes": sum(size for _, size, _ in entries),
+        "max_bytes": MEDIA_CACHE_MAX_BYTES
+    }
@@ -0,0 +1,105 @@
+import os
+import time
+import atexit
+import shutil
+import tempfile
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+# Renders run in worker processes, so metrics are always collected in
+# prometheus_client's multiprocess mode. The directory has to be known before
+# prometheus_client is imported; spawned workers inherit it through the
+# environment. Set PROMETHEUS_MULTIPROC_DIR to share one directory between
+# several server processes (e.g. gunicorn workers), and empty it on deploy.
+if not os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+    _metrics_dir = tempfile.mkdtemp(prefix="edverse_metrics_")
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = _metrics_dir
+    _owner_pid = os.getpid()
+    # Only the process that created the directory removes it
+    atexit.register(lambda: os.getpid() == _owner_pid and shutil.rmtree(_metrics_dir, ignore_errors=True))
+else:
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+from prometheus_client import (
+    CollectorRegistry, Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest, multiprocess
+)
+
+# Buckets for calls that take from a few milliseconds to minutes
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+BYTES_BUCKETS = tuple(1024 * 4 ** i for i in range(11))  # 1 KiB to 1 GiB
+FPS_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 45, 60, 90, 120, 240, 480)
+
+LLM_LATENCY = Histogram(
+    "edverse_llm_request_seconds", "AI API chat completion latency", ["task"], buckets=SECONDS_BUCKETS
+)
+TTS_LATENCY = Histogram(
+    "edverse_tts_scene_seconds", "Time to get one scene's narration audio", ["source"], buckets=SECONDS_BUCKETS
+)
+PEXELS_SEARCH_LATENCY = Histogram(
+    "edverse_pexels_search_seconds", "Pexels search latency", ["kind"], buckets=SECONDS_BUCKETS
+)
+DOWNLOAD_LATENCY = Histogram(
+    "edverse_media_download_seconds", "Stock media download time", ["media_type"], buckets=SECONDS_BUCKETS
+)
+DOWNLOAD_BYTES = Histogram(
+    "edverse_media_download_bytes", "Size of downloaded stock media", ["media_type"], buckets=BYTES_BUCKETS
+)
+CLIP_DECODE_LATENCY = Histogram(
+    "edverse_clip_decode_seconds", "Time to open and prepare one timeline segment for MoviePy",
+    ["kind"], buckets=SECONDS_BUCKETS
+)
+ENCODE_DURATION = Histogram(
+    "edverse_render_encode_seconds", "Wall time of the encode of a video", ["engine", "quality"],
+    buckets=SECONDS_BUCKETS
+)
+RENDER_FPS = Histogram(
+    "edverse_render_frames_per_second", "Frames encoded per second of wall time", ["engine", "quality"],
+    buckets=FPS_BUCKETS
+)
+CACHE_LOOKUPS = Counter(
+    "edverse_cache_lookups_total", "Cache lookups by cache and result", ["cache", "result"]
+)
+UPSTREAM_ERRORS = Counter(
+    "edverse_upstream_errors_total", "Failed upstream HTTP attempts, including retried ones", ["service", "reason"]
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "edverse_http_requests_in_flight", "Requests being handled per endpoint", ["endpoint"],
+    multiprocess_mode="livesum"
+)
+REQUEST_LATENCY = Histogram(
+    "edverse_http_request_seconds", "Request handling time per endpoint", ["endpoint", "method", "status"],
+    buckets=SECONDS_BUCKETS
+)
+
+# Upstream hosts by service, anything else is "other"
+UPSTREAM_SERVICES = {
+    "api.aimlapi.com": "aiml",
+    "api.elevenlabs.io": "elevenlabs",
+    "api.pexels.com": "pexels",
+    "videos.pexels.com": "pexels",
+    "images.pexels.com": "pexels",
+    "player.vimeo.com": "pexels"
+}
+
+def register_upstream(base_url, service):
+    """Attribute calls to a configured base URL (host and port) to service"""
+    UPSTREAM_SERVICES[urlsplit(base_url).netloc] = service
+
+def upstream_service(url):
+    parts = urlsplit(url)
+    return UPSTREAM_SERVICES.get(parts.netloc) or UPSTREAM_SERVICES.get(parts.hostname or "", "other")
+
+@contextmanager
+def timed(histogram, **labels):
+    """Observe the duration of the block in histogram, also when it raises"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.labels(**labels).observe(time.perf_counter() - start)
+
+def metrics_response_body():
+    """The exposition of every process's metrics, returns (body, content type)"""
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,255 @@
+import os
+import json
+import time
+import wave
+import random
+import hashlib
+import logging
+import subprocess
+import numpy as np
+from moviepy.config import get_setting
+from cache import CACHE_DIR
+
+logger = logging.getLogger("video_generator")
+
+CURRENT_DIR = os.path.abspath(os.path.dirname(__file__))
+MUSIC_DIR = os.path.abspath(os.path.join(CURRENT_DIR, "bg_music"))
+MUSIC_CACHE_DIR = os.path.join(CACHE_DIR, "music")
+INDEX_PATH = os.path.join(MUSIC_CACHE_DIR, "index.json")
+
+# Mix background music under the voiceover, off unless enabled
+BACKGROUND_MUSIC = os.getenv("BACKGROUND_MUSIC", "0") == "1"
+# Music is normalized to this RMS level, which sits it under the voiceover
+MUSIC_LEVEL_DBFS = float(os.getenv("MUSIC_LEVEL_DBFS", "-26"))
+# The bed is turned down further when needed to stay this far below the voiceover's speech level
+MUSIC_BELOW_VOICE_DB = float(os.getenv("MUSIC_BELOW_VOICE_DB", "14"))
+SAMPLE_RATE = 44100
+CHANNELS = 2
+# Quieter than this counts as silence when placing loop points
+SILENCE_DBFS = -50.0
+# Fade applied on both sides of a loop seam so it doesn't click
+LOOP_FADE_SECONDS = 0.05
+# Partly written tracks older than this were left behind by a worker that died
+TMP_MAX_AGE_SECONDS = 3600
+
+os.makedirs(MUSIC_CACHE_DIR, exist_ok=True)
+
+def music_folder_for_fandom(fandom):
+    """Name of the bg_music subfolder for a fandom"""
+    fandom = fandom.lower() if fandom else ""
+    if "harry potter" in fandom or "wizarding" in fandom:
+        return "Harry Potter"
+    if "star wars" in fandom:
+        return "Star Wars"
+    if "marvel" in fandom or "avengers" in fandom or "iron man" in fandom:
+        return "Marvel Avengers"
+    # Default to Harry Potter if fandom not recognized
+    return "Harry Potter"
+
+def _track_key(source_path):
+    """Cache key of a source file, changes when the file or the normalization target changes"""
+    stat = os.stat(source_path)
+    data = f"{os.path.abspath(source_path)}\n{stat.st_mtime_ns}\n{stat.st_size}\n{MUSIC_LEVEL_DBFS}"
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:24]
+
+def _decode(source_path):
+    """Decode a music file to int16 PCM frames of shape (n, CHANNELS)"""
+    result = subprocess.run(
+        [get_setting("FFMPEG_BINARY"), "-v", "error", "-i", source_path,
+         "-f", "s16le", "-ac", str(CHANNELS), "-ar", str(SAMPLE_RATE), "-"],
+        capture_output=True, check=True
+    )
+    return np.frombuffer(result.stdout, dtype=np.int16).reshape(-1, CHANNELS)
+
+def _dbfs(samples):
+    rms = np.sqrt(np.mean(np.square(samples, dtype=np.float64))) if len(samples) else 0.0
+    return 20 * np.log10(rms) if rms > 0 else -np.inf
+
+def voice_level_dbfs(audio_path, window_seconds=0.05):
+    """RMS level of the speech in a voiceover, the pauses between scenes left out
+
+    None if the file is silent.
+    """
+    samples = _decode(audio_path).astype(np.float32) / 32768.0
+    window = int(window_seconds * SAMPLE_RATE)
+    count = len(samples) // window
+    if count == 0:
+        return None
+    power = np.mean(np.square(samples[:count * window].reshape(count, -1), dtype=np.float64), axis=1)
+    speech = power[power > 10 ** (SILENCE_DBFS / 10)]
+    if len(speech) == 0:
+        return None
+    return float(10 * np.log10(np.mean(speech)))
+
+def bed_gain_db(voice_dbfs):
+    """Gain of the bed so it sits MUSIC_BELOW_VOICE_DB under the voice, never turned up"""
+    if voice_dbfs is None:
+        return 0.0
+    return min(0.0, voice_dbfs - MUSIC_BELOW_VOICE_DB - MUSIC_LEVEL_DBFS)
+
+def _loop_points(pcm, full_scale=1.0):
+    """(loop_start, loop_end) frames, the music between the leading and trailing silence"""
+    threshold = full_scale * 10 ** (SILENCE_DBFS / 20)
+    loud = np.flatnonzero(np.abs(pcm).max(axis=1) > threshold)
+    if len(loud) == 0:
+        return 0, len(pcm)
+    return int(loud[0]), int(loud[-1]) + 1
+
+def index_track(folder, filename, known=None):
+    """Decode, normalize and cache one music file, returns its index entry
+
+    known maps keys to entries of a previous index, those are reused as is.
+    """
+    source_path = os.path.join(MUSIC_DIR, folder, filename)
+    key = _track_key(source_path)
+    pcm_path = os.path.join(MUSIC_CACHE_DIR, f"{key}.npy")
+    if known and key in known and os.path.exists(pcm_path):
+        return known[key]
+    entry = {"folder": folder, "file": filename, "key": key, "pcm_path": pcm_path}
+
+    if os.path.exists(pcm_path):
+        pcm = np.load(pcm_path, mmap_mode="r")
+    else:
+        samples = _decode(source_path).astype(np.float32) / 32768.0
+        loop_start, loop_end = _loop_points(samples)
+        # Normalize the loudness of the music itself, not of its silent edges
+        gain = 10 ** ((MUSIC_LEVEL_DBFS - _dbfs(samples[loop_start:loop_end])) / 20)
+        peak = np.abs(samples).max()
+        if peak * gain > 0.99:
+            gain = 0.99 / peak
+        pcm = np.round(samples * gain * 32767).astype(np.int16)
+        tmp_path = f"{pcm_path}.{os.getpid()}.tmp.npy"
+        np.save(tmp_path, pcm)
+        os.replace(tmp_path, pcm_path)
+        logger.info(f"Indexed background music {folder}/{filename}, gain {20 * np.log10(gain):.1f} dB")
+
+    loop_start, loop_end = _loop_points(pcm, 32768)
+    entry.update(
+        frames=len(pcm),
+        duration=len(pcm) / SAMPLE_RATE,
+        loop_start=loop_start,
+        loop_end=loop_end
+    )
+    return entry
+
+def build_music_library():
+    """Index every file in bg_music, reusing cached tracks whose source didn't change"""
+    tracks = []
+    known = {track["key"]: track for track in load_music_index()}
+    if os.path.isdir(MUSIC_DIR):
+        for folder in sorted(os.listdir(MUSIC_DIR)):
+            folder_path = os.path.join(MUSIC_DIR, folder)
+            if not os.path.isdir(folder_path):
+                continue
+            for filename in sorted(os.listdir(folder_path)):
+                if not filename.endswith(".mp3"):
+                    continue
+                try:
+                    tracks.append(index_track(folder, filename, known))
+                except Exception as e:
+                    logger.error(f"Failed to index background music {folder}/{filename}: {str(e)}")
+
+    # Drop cached tracks that no longer belong to any source file
+    keep = {os.path.basename(track["pcm_path"]) for track in tracks}
+    for name in os.listdir(MUSIC_CACHE_DIR):
+        path = os.path.join(MUSIC_CACHE_DIR, name)
+        if not name.endswith(".npy") or name in keep:
+            continue
+        try:
+            if name.endswith(".tmp.npy") and os.path.getmtime(path) > time.time() - TMP_MAX_AGE_SECONDS:
+                # Another worker is still writing this track
+                continue
+            os.remove(path)
+        except FileNotFoundError:
+            # Renamed into place or removed by another worker in the meantime
+            pass
+
+    tmp_path = f"{INDEX_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"sample_rate": SAMPLE_RATE, "channels": CHANNELS, "tracks": tracks}, f)
+    os.replace(tmp_path, INDEX_PATH)
+    logger.info(f"Music library indexed: {len(tracks)} tracks")
+    return tracks
+
+def load_music_index():
+    """Tracks of the on-disk index, empty until the library has been built"""
+    try:
+        with open(INDEX_PATH) as f:
+            return json.load(f)["tracks"]
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        return []
+
+def choose_track(fandom):
+    """Pick a random indexed track for a fandom, indexing one on demand if the library isn't built yet"""
+    folder = music_folder_for_fandom(fandom)
+    tracks = [
+        track for track in load_music_index()
+        if track["folder"] == folder and os.path.exists(track["pcm_path"])
+    ]
+    if tracks:
+        return random.choice(tracks)
+
+    folder_path = os.path.join(MUSIC_DIR, folder)
+    if not os.path.isdir(folder_path):
+        logger.warning(f"Music folder not found: {folder_path}")
+        return None
+    music_files = [f for f in os.listdir(folder_path) if f.endswith(".mp3")]
+    if not music_files:
+        logger.warning(f"No music files found in {folder_path}")
+        return None
+    return index_track(folder, random.choice(music_files))
+
+def music_bed(track, duration):
+    """int16 samples of exactly duration seconds: the track, then its loop region repeated"""
+    pcm = np.load(track["pcm_path"], mmap_mode="r")
+    total = round(duration * SAMPLE_RATE)
+    bed = np.empty((total, CHANNELS), dtype=np.int16)
+    loop_start, loop_end = track["loop_start"], track["loop_end"]
+    if loop_end - loop_start < SAMPLE_RATE:
+        # Too short to loop musically, repeat the whole file
+        loop_start, loop_end = 0, len(pcm)
+
+    fade = int(LOOP_FADE_SECONDS * SAMPLE_RATE)
+    ramp = np.linspace(0.0, 1.0, fade, dtype=np.float32)[:, None]
+    position, source_start, source_end = 0, 0, loop_end
+    while position < total:
+        count = min(source_end - source_start, total - position)
+        bed[position:position + count] = pcm[source_start:source_start + count]
+        if position > 0:
+            # Fade in after the seam
+            head = bed[position:position + min(fade, count)]
+            head[...] = head * ramp[:len(head)]
+        position += count
+        if position < total:
+            # Fade out before the seam
+            tail = bed[position - min(fade, count):position]
+            tail[...] = tail * ramp[::-1][-len(tail):]
+        source_start, source_end = loop_start, loop_end
+    return bed
+
+def write_music_bed(fandom, duration, output_path, voice_path=None):
+    """Write the background music for a video as a WAV of exactly duration seconds
+
+    The bed is at MUSIC_LEVEL_DBFS, or lower when the voiceover at voice_path
+    is quiet enough that the music would otherwise come within
+    MUSIC_BELOW_VOICE_DB of it. Returns output_path, or None if there is no
+    music for the fandom.
+    """
+    track = choose_track(fandom)
+    if track is None:
+        return None
+    bed = music_bed(track, duration)
+    voice_dbfs = voice_level_dbfs(voice_path) if voice_path else None
+    gain_db = bed_gain_db(voice_dbfs)
+    if gain_db < 0:
+        bed = np.round(bed * 10 ** (gain_db / 20)).astype(np.int16)
+    logger.info(
+        f"Selected background music: {track['file']}, at {MUSIC_LEVEL_DBFS + gain_db:.1f} dBFS"
+        + (f" under a voiceover at {voice_dbfs:.1f} dBFS" if voice_dbfs is not None else "")
+    )
+    with wave.open(output_path, "wb") as wav:
+        wav.setnchannels(CHANNELS)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes(bed.tobytes())
+    return output_path
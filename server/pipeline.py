@@ -0,0 +1,114 @@
+import asyncio
+import time
+import logging
+from contextlib import asynccontextmanager
+from typing import Optional
+from fastapi import HTTPException
+from pydantic import BaseModel
+from subtopics import get_educational_subtopics
+from script import ScriptRequest, generate_educational_script
+from voiceover import VoiceoverRequest, generate_voiceover
+from assets import prefetch_scene_assets, gather_or_cancel
+from jobs import submit_render_job, wait_for_job
+from quality import get_quality_profile
+
+logger = logging.getLogger("video_generator")
+
+class PipelineRequest(BaseModel):
+    concept: str
+    fandom: str
+    subtopic: Optional[str] = None  # Skips the subtopics stage when given
+    subtopic_index: int = 0  # Which generated subtopic to teach otherwise
+    voice_id: Optional[str] = None
+    engine: Optional[str] = None
+    segmented: Optional[bool] = None
+    quality: Optional[str] = None
+    bypass_cache: bool = False
+
+class StageTimer:
+    """Wall clock timings of the pipeline stages, relative to the start of the pipeline"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+
+    @asynccontextmanager
+    async def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.stages[name] = {
+                "start": round(start - self.started, 3),
+                "end": round(end - self.started, 3),
+                "seconds": round(end - start, 3)
+            }
+            logger.info(f"Pipeline stage {name} took {end - start:.2f}s")
+
+    def report(self):
+        return {"stages": self.stages, "total_seconds": round(time.perf_counter() - self.started, 3)}
+
+async def run_pipeline(request: PipelineRequest):
+    """Turn a concept into a rendered video in one request
+
+    Runs subtopics -> script -> voiceover -> video on the server. The stock
+    media searches only need the script, so they run while the voiceover is
+    being synthesized and the render finds them cached.
+    """
+    if not request.concept:
+        raise HTTPException(status_code=400, detail="Concept Parameter is required")
+    if not request.fandom:
+        raise HTTPException(status_code=400, detail="Fandom Parameter is required")
+    # Fail before any paid API call rather than when the render job runs
+    get_quality_profile(request.quality)
+
+    timer = StageTimer()
+
+    subtopic = request.subtopic
+    subtopics = None
+    if not subtopic:
+        async with timer.stage("subtopics"):
+            subtopics = await get_educational_subtopics(request.concept, bypass_cache=request.bypass_cache)
+        titles = [item.get("title") for item in subtopics.get("subtopics", []) if item.get("title")]
+        if not titles:
+            raise HTTPException(status_code=500, detail="No subtopics were generated")
+        subtopic = titles[min(max(request.subtopic_index, 0), len(titles) - 1)]
+
+    async with timer.stage("script"):
+        script = await generate_educational_script(ScriptRequest(
+            concept_subtopic=subtopic, fandom=request.fandom, bypass_cache=request.bypass_cache
+        ))
+
+    async def voiceover():
+        async with timer.stage("voiceover"):
+            voice = {"voice_id": request.voice_id} if request.voice_id else {}
+            return await generate_voiceover(VoiceoverRequest(script=script, **voice))
+
+    async def prefetch():
+        async with timer.stage("prefetch"):
+            return await prefetch_scene_assets(script.get("scenes", []), request.quality)
+
+    voiceover_result, prefetched = await gather_or_cancel([voiceover(), prefetch()])
+
+    async with timer.stage("video"):
+        job = await asyncio.to_thread(submit_render_job, {
+            "voiceover_data": voiceover_result["voiceover_data"],
+            "engine": request.engine,
+            "segmented": request.segmented,
+            "quality": request.quality
+        })
+        job = await wait_for_job(job["job_id"])
+    if job["status"] == "failed":
+        raise HTTPException(status_code=500, detail=f"Render job {job['job_id']} failed: {job['error']}")
+
+    return {
+        "subtopic": subtopic,
+        "subtopics": subtopics,
+        "script": script,
+        "voiceover": voiceover_result,
+        "video": job["result"],
+        "job_id": job["job_id"],
+        "prefetched": prefetched,
+        "timings": timer.report()
+    }
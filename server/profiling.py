@@ -0,0 +1,158 @@
+import os
+import re
+import sys
+import time
+import uuid
+import random
+import pstats
+import cProfile
+import logging
+import functools
+import threading
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+
+logger = logging.getLogger("video_generator")
+
+CURRENT_DIR = os.path.abspath(os.path.dirname(__file__))
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(CURRENT_DIR, "profiles"))
+# Fraction of requests profiled without asking, on top of X-Profile / ?profile=1
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+# Stack samples per second for the flamegraph dump
+PROFILE_SAMPLE_HZ = float(os.getenv("PROFILE_SAMPLE_HZ", "200"))
+# Oldest profiles are removed beyond this many files
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "500"))
+
+REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+os.makedirs(PROFILE_DIR, exist_ok=True)
+
+# Request id of the profiled request the current task belongs to
+_profile_id = contextvars.ContextVar("profile_id", default=None)
+# Set inside a capture, nested profiled calls are covered by the outer one
+_capturing = contextvars.ContextVar("profile_capturing", default=False)
+# cProfile allows one active profiler per thread, concurrent profiled requests on the same thread are skipped
+_busy_threads = set()
+_busy_lock = threading.Lock()
+
+def wants_profile(headers, query_params):
+    """Whether a request asked to be profiled (X-Profile header or ?profile=), or was sampled"""
+    flag = headers.get("x-profile") or query_params.get("profile")
+    if flag is not None:
+        return flag.lower() in ("1", "true", "yes")
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+def request_id_from(headers):
+    """The client's X-Request-ID when it is safe to use in a file name, otherwise a new id"""
+    request_id = headers.get("x-request-id")
+    return request_id if request_id and REQUEST_ID_PATTERN.match(request_id) else uuid.uuid4().hex
+
+def enable_profiling(request_id):
+    """Profile the profiled() calls made from the current context, tagged with request_id"""
+    return _profile_id.set(request_id)
+
+def current_profile_id():
+    return _profile_id.get()
+
+class StackSampler:
+    """Samples one thread's Python stack at a fixed rate, as folded stacks for flamegraph.pl / speedscope"""
+
+    def __init__(self, thread_id, hz=PROFILE_SAMPLE_HZ):
+        self.thread_id = thread_id
+        self.interval = 1.0 / hz
+        self.counts = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.counts[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.counts.most_common():
+                f.write(f"{stack} {count}\n")
+
+def _prune_profiles():
+    files = [os.path.join(PROFILE_DIR, name) for name in os.listdir(PROFILE_DIR)]
+    if len(files) <= PROFILE_MAX_FILES:
+        return
+    files.sort(key=os.path.getmtime)
+    for path in files[:len(files) - PROFILE_MAX_FILES]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+@contextmanager
+def capture(name, request_id):
+    """Profile the block with cProfile and the stack sampler
+
+    Writes <request_id>_<ms>_<name>.prof (pstats call graph, e.g. for snakeviz
+    or gprof2dot) and a .folded file of folded stacks next to it in
+    PROFILE_DIR, <ms> being the start time so one request's captures sort in
+    order.
+    Everything running on the thread is included, so on the server's event
+    loop other requests' work shows up too.
+    """
+    thread_id = threading.get_ident()
+    with _busy_lock:
+        busy = thread_id in _busy_threads
+        _busy_threads.add(thread_id)
+    if busy:
+        logger.warning(f"Not profiling {name} for {request_id}, another profile is running on this thread")
+        yield
+        return
+
+    base = os.path.join(PROFILE_DIR, f"{request_id}_{int(time.time() * 1000)}_{name}")
+    profiler = cProfile.Profile()
+    sampler = StackSampler(thread_id)
+    started = time.perf_counter()
+    sampler.start()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        sampler.stop()
+        with _busy_lock:
+            _busy_threads.discard(thread_id)
+        try:
+            pstats.Stats(profiler).dump_stats(f"{base}.prof")
+            sampler.write(f"{base}.folded")
+            _prune_profiles()
+            logger.info(f"Profiled {name} for {request_id} ({time.perf_counter() - started:.2f}s): {base}.prof")
+        except OSError as e:
+            logger.error(f"Failed to write profile {base}: {str(e)}")
+
+def profiled(name):
+    """Decorator profiling an async function when its request asked for it"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            request_id = _profile_id.get()
+            if request_id is None or _capturing.get():
+                return await func(*args, **kwargs)
+            token = _capturing.set(True)
+            try:
+                with capture(name, request_id):
+                    return await func(*args, **kwargs)
+            finally:
+                _capturing.reset(token)
+        return wrapper
+    return decorator
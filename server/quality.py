@@ -0,0 +1,43 @@
+from fastapi import HTTPException
+
+# Render settings for each quality tier. "draft" is a quick low resolution
+# preview for checking pacing and scene choices, "full" the final render.
+QUALITY_PROFILES = {
+    "full": {
+        "width": 1920,
+        "height": 1080,
+        "fps": 30,
+        "preset": "ultrafast",
+        "crf": 23,
+        # Pexels renditions: the smallest video at least this wide (None prefers HD), and the photo size
+        "min_video_width": None,
+        "photo_size": "original"
+    },
+    "draft": {
+        "width": 640,
+        "height": 360,
+        "fps": 15,
+        "preset": "ultrafast",
+        "crf": 30,
+        "min_video_width": 640,
+        "photo_size": "large"
+    }
+}
+
+DEFAULT_QUALITY = "full"
+
+# Keys of a profile the render engines take as keyword arguments
+ENCODER_OPTIONS = ("width", "height", "fps", "preset", "crf")
+
+def get_quality_profile(quality=None):
+    """Look up a quality profile by name, raises a 400 for unknown names"""
+    quality = quality or DEFAULT_QUALITY
+    if quality not in QUALITY_PROFILES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown quality: {quality}, expected one of {', '.join(QUALITY_PROFILES)}"
+        )
+    return QUALITY_PROFILES[quality]
+
+def encoder_options(profile):
+    return {key: profile[key] for key in ENCODER_OPTIONS}
@@ -0,0 +1,118 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+from cache import PersistentCache
+from assets import get_scene_queries
+from music_library import music_folder_for_fandom, BACKGROUND_MUSIC, MUSIC_LEVEL_DBFS, MUSIC_BELOW_VOICE_DB
+
+logger = logging.getLogger("video_generator")
+
+# Finished renders are cached, an identical request returns the existing video.
+# Expired and evicted entries take their video with them, so the cached videos
+# use at most about RENDER_CACHE_MAX_ENTRIES times the size of a video on disk.
+# Renders that never entered the cache (bypass_cache, RENDER_CACHE=0) are not
+# managed here.
+RENDER_CACHE_ENABLED = os.getenv("RENDER_CACHE", "1") == "1"
+RENDER_CACHE_TTL = float(os.getenv("RENDER_CACHE_TTL", str(7 * 24 * 3600)))  # 0 means entries never expire
+RENDER_CACHE_MAX_ENTRIES = int(os.getenv("RENDER_CACHE_MAX_ENTRIES", "1000"))
+# A video a job returned this recently is kept for its client, deleted on a later eviction
+RENDER_CACHE_DELETE_GRACE = float(os.getenv("RENDER_CACHE_DELETE_GRACE", "3600"))
+
+# Bump when a render change makes older videos stale
+RENDER_CACHE_VERSION = 1
+
+def _video_in_use(path):
+    """Whether a live cache entry or a recent job still points at a video"""
+    from jobs import job_references
+    text = json.dumps(path)
+    return render_cache.references(text) or job_references(text, time.time() - RENDER_CACHE_DELETE_GRACE)
+
+def delete_evicted_videos(evicted):
+    """on_evict of the render cache: delete the videos of removed entries nothing else uses
+
+    Videos still in use are remembered and retried on the next eviction.
+    """
+    paths = {json.loads(value)["video_path"] for value in evicted.values()}
+    paths.update(pending_deletes.keys())
+    for path in paths:
+        try:
+            if _video_in_use(path):
+                pending_deletes.set(path, b"")
+                continue
+            os.remove(path)
+            logger.info(f"Deleted evicted render {path}")
+        except FileNotFoundError:
+            pass
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f"Could not delete evicted render {path}: {str(e)}")
+            pending_deletes.set(path, b"")
+            continue
+        pending_deletes.delete(path)
+
+render_cache = PersistentCache(
+    "renders", ttl=RENDER_CACHE_TTL or None, max_entries=RENDER_CACHE_MAX_ENTRIES, on_evict=delete_evicted_videos
+)
+# Evicted videos that were still in use when their entry went away
+pending_deletes = PersistentCache("render_pending_deletes")
+
+def file_digest(path):
+    """sha256 of a file's content"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _normalize_query(query):
+    return " ".join((query or "").lower().split())
+
+def normalize_timeline(timestamps):
+    """The parts of the scene timestamps that change the video, in a stable form
+
+    Narration text only matters through the audio, which is hashed separately.
+    """
+    scenes = []
+    for scene in sorted(timestamps, key=lambda x: x.get("startTime", 0)):
+        video_query, image_query = get_scene_queries(scene)
+        scenes.append([
+            round(float(scene.get("startTime", 0)), 3),
+            round(float(scene.get("endTime", 0)), 3),
+            _normalize_query(video_query),
+            _normalize_query(image_query)
+        ])
+    return scenes
+
+def render_cache_key(audio_path, timestamps, fandom, settings):
+    """Key of a render: the audio content, the normalized timeline, the music and the render settings"""
+    data = {
+        "version": RENDER_CACHE_VERSION,
+        "audio": file_digest(audio_path),
+        "timeline": normalize_timeline(timestamps),
+        "music": [music_folder_for_fandom(fandom), MUSIC_LEVEL_DBFS, MUSIC_BELOW_VOICE_DB] if BACKGROUND_MUSIC else None,
+        "settings": settings
+    }
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+def get_cached_render(key):
+    """The response of an earlier identical render whose video still exists, or None"""
+    if not RENDER_CACHE_ENABLED:
+        return None
+    cached = render_cache.get_json(key)
+    if cached is None:
+        return None
+    path = cached["video_path"]
+    if not os.path.exists(path) or os.path.getsize(path) != cached.get("video_size"):
+        # The video was removed or replaced since
+        render_cache.delete(key)
+        return None
+    logger.info(f"Render cache hit, reusing {path}")
+    return cached["response"]
+
+def store_render(key, response):
+    if not RENDER_CACHE_ENABLED:
+        return
+    path = response["video_path"]
+    render_cache.set_json(key, {"video_path": path, "video_size": os.path.getsize(path), "response": response})
@@ -6,6 +6,7 @@ from utils import make_ai_api_request, extract_json_from_ai_response
 class ScriptRequest(BaseModel):
     concept_subtopic: str
     fandom: str
+    bypass_cache: bool = False  # Skip the LLM cache and generate a fresh script
 
 async def generate_educational_script(request: ScriptRequest):
     """Generate an educational script using a concept and fandom"""
@@ -77,7 +78,12 @@ async def generate_educational_script(request: ScriptRequest):
     
     try:
         print("Making AI API request for script generation...")
-        content = make_ai_api_request(prompt, system_message=system_message)
+        content = await make_ai_api_request(
+            prompt,
+            system_message=system_message,
+            cache_inputs={"task": "script", "concept_subtopic": request.concept_subtopic, "fandom": request.fandom},
+            bypass_cache=request.bypass_cache
+        )
         
         # Add debugging to see the raw response
         print(f"AI API Response received, length: {len(content)}")
@@ -0,0 +1,130 @@
+import os
+import shutil
+import asyncio
+import tempfile
+import logging
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from fastapi import HTTPException
+from assets import gather_or_cancel
+from ffmpeg_render import render_with_ffmpeg, build_mux_command, run_ffmpeg
+
+logger = logging.getLogger("video_generator")
+
+# Scenes rendered at the same time, by default one per core
+SEGMENT_WORKERS = int(os.getenv("SEGMENT_WORKERS", str(os.cpu_count() or 1)))
+
+def split_scenes(segments, total_duration, fps=30):
+    """Group a render timeline into scenes that can be encoded independently
+
+    Scene boundaries are snapped to the frame grid so the concatenated video
+    stays in sync with the audio. Returns a list of {sceneNumber, start,
+    duration, segments} with segment starts relative to their scene.
+    """
+    groups = []
+    for segment in segments:
+        if groups and segment["sceneNumber"] is not None and groups[-1][0]["sceneNumber"] == segment["sceneNumber"]:
+            groups[-1].append(segment)
+        else:
+            groups.append([segment])
+
+    scenes = []
+    for index, group in enumerate(groups):
+        start = group[0]["start"]
+        end = groups[index + 1][0]["start"] if index + 1 < len(groups) else total_duration
+        first_frame, end_frame = round(start * fps), round(min(end, total_duration) * fps)
+        if end_frame <= first_frame:
+            # Shorter than a frame (or past the end of the audio), nothing to show
+            continue
+        scenes.append({
+            "sceneNumber": group[0]["sceneNumber"],
+            "start": first_frame / fps,
+            "duration": (end_frame - first_frame) / fps,
+            "segments": [dict(segment, start=segment["start"] - start) for segment in group]
+        })
+    return scenes
+
+def render_scene_with_moviepy(segments, duration, output_path, width=1920, height=1080, fps=30,
+                              preset="ultrafast", crf=23):
+    """Process pool entry point: encode the video stream of one scene with MoviePy"""
+    # Imported here, video imports this module
+    from moviepy.editor import CompositeVideoClip
+    from video import build_scene_clips
+
+    try:
+        clips = build_scene_clips(segments, width, height)
+    except HTTPException as e:
+        # HTTPException can't be pickled back to the parent
+        raise RuntimeError(e.detail)
+
+    scene = CompositeVideoClip(clips, size=(width, height)).set_duration(duration)
+    try:
+        scene.write_videofile(
+            output_path,
+            codec="libx264",
+            audio=False,
+            fps=fps,
+            threads=2,
+            preset=preset,
+            ffmpeg_params=["-crf", str(crf)],
+            logger=None,
+            verbose=False
+        )
+    finally:
+        scene.close()
+        for clip in clips:
+            clip.close()
+
+async def _render_scenes_with_moviepy(scenes, paths, workers, options):
+    loop = asyncio.get_running_loop()
+    # Spawn, like the render job pool, so workers don't inherit the parent's threads
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        await asyncio.gather(*(
+            loop.run_in_executor(
+                pool, functools.partial(render_scene_with_moviepy, scene["segments"], scene["duration"], path, **options)
+            )
+            for scene, path in zip(scenes, paths)
+        ))
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+async def _render_scenes_with_ffmpeg(scenes, paths, workers, options):
+    # Every ffmpeg is already its own process, only limit how many run at once
+    semaphore = asyncio.Semaphore(workers)
+
+    async def render(scene, path):
+        async with semaphore:
+            await render_with_ffmpeg(scene["segments"], None, path, scene["duration"], **options)
+
+    await gather_or_cancel(render(scene, path) for scene, path in zip(scenes, paths))
+
+async def render_segmented(segments, audio_path, output_path, total_duration, bg_music_path=None,
+                           engine="moviepy", **options):
+    """Render every scene as its own video segment in parallel, then join them
+
+    The segments share the same encoder settings (options, as taken by
+    render_with_ffmpeg), so they are concatenated with a stream copy; the
+    mixed audio is muxed in by that same final pass.
+    """
+    scenes = split_scenes(segments, total_duration, options.get("fps", 30))
+    workers = max(1, min(SEGMENT_WORKERS, len(scenes)))
+    workdir = tempfile.mkdtemp(prefix="segments_", dir=os.path.dirname(output_path))
+    try:
+        paths = [os.path.join(workdir, f"scene_{index:03d}.mp4") for index in range(len(scenes))]
+        logger.info(f"Rendering {len(scenes)} scenes with {workers} {engine} workers")
+
+        if engine == "ffmpeg":
+            await _render_scenes_with_ffmpeg(scenes, paths, workers, options)
+        else:
+            await _render_scenes_with_moviepy(scenes, paths, workers, options)
+
+        concat_list = os.path.join(workdir, "segments.txt")
+        with open(concat_list, "w") as f:
+            for path in paths:
+                f.write(f"file '{path}'\n")
+
+        await run_ffmpeg(build_mux_command(concat_list, audio_path, output_path, total_duration, bg_music_path))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,110 @@
+import os
+import re
+import time
+import shutil
+import logging
+from fastapi import HTTPException
+from fastapi.responses import FileResponse
+from ffmpeg_render import FFMPEG_BINARY, build_ffmpeg_command, run_ffmpeg
+
+logger = logging.getLogger("video_generator")
+
+CURRENT_DIR = os.path.abspath(os.path.dirname(__file__))
+STREAM_DIR = os.path.abspath(os.path.join(CURRENT_DIR, "generated_videos", "streams"))
+
+# Length of an HLS segment, the first one is playable after about this much video
+HLS_SEGMENT_SECONDS = float(os.getenv("HLS_SEGMENT_SECONDS", "2"))
+# Streams are removed this long after they were started, the finished MP4 stays
+STREAM_RETENTION_SECONDS = float(os.getenv("STREAM_RETENTION_SECONDS", str(24 * 3600)))
+
+PLAYLIST_NAME = "index.m3u8"
+INIT_NAME = "init.mp4"
+# Names clients may request from a stream directory
+STREAM_FILE_PATTERN = re.compile(r"^(index\.m3u8|init\.mp4|segment_\d{5}\.m4s)$")
+STREAM_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+os.makedirs(STREAM_DIR, exist_ok=True)
+
+def stream_path(stream_id, filename=PLAYLIST_NAME):
+    """Path of a file of a stream, None if the id or name isn't one a stream can have"""
+    if not STREAM_ID_PATTERN.match(stream_id or "") or not STREAM_FILE_PATTERN.match(filename or ""):
+        return None
+    return os.path.join(STREAM_DIR, stream_id, filename)
+
+def prune_streams(max_age=None):
+    """Remove stream directories older than STREAM_RETENTION_SECONDS"""
+    max_age = STREAM_RETENTION_SECONDS if max_age is None else max_age
+    cutoff = time.time() - max_age
+    for name in os.listdir(STREAM_DIR):
+        path = os.path.join(STREAM_DIR, name)
+        try:
+            if os.path.isdir(path) and os.path.getmtime(path) < cutoff:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            # Removed by another worker in the meantime
+            pass
+
+def hls_output_args(directory):
+    """ffmpeg output options writing an event playlist of fMP4 segments into directory
+
+    Segments and the playlist are written to temporary names and renamed, so
+    a client never sees a partial file. Keyframes are forced on the segment
+    grid so every segment starts with one.
+    """
+    return [
+        "-force_key_frames", f"expr:gte(t,n_forced*{HLS_SEGMENT_SECONDS})",
+        "-f", "hls",
+        "-hls_time", str(HLS_SEGMENT_SECONDS),
+        "-hls_playlist_type", "event",
+        "-hls_segment_type", "fmp4",
+        "-hls_fmp4_init_filename", INIT_NAME,
+        "-hls_segment_filename", os.path.join(directory, "segment_%05d.m4s"),
+        "-hls_flags", "temp_file+independent_segments",
+        os.path.join(directory, PLAYLIST_NAME)
+    ]
+
+async def render_stream(stream_id, segments, audio_path, output_path, total_duration, bg_music_path=None,
+                        **options):
+    """Render the timeline as a growing HLS stream, then remux it to the MP4 at output_path
+
+    The stream's playlist gets a segment every HLS_SEGMENT_SECONDS of video
+    as the render progresses and is closed (#EXT-X-ENDLIST) when it is done.
+    """
+    prune_streams()
+    directory = os.path.join(STREAM_DIR, stream_id)
+    # A promoted job renders again under the same id
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+
+    command = build_ffmpeg_command(
+        segments, audio_path, output_path, total_duration, bg_music_path,
+        output_args=hls_output_args(directory), **options
+    )
+    logger.info(f"Streaming {len(segments)} segments with ffmpeg to {directory}")
+    await run_ffmpeg(command)
+
+    # Same encoded stream, only the container changes
+    await run_ffmpeg([
+        FFMPEG_BINARY, "-y", "-hide_banner", "-loglevel", "error",
+        "-i", os.path.join(directory, PLAYLIST_NAME),
+        "-c", "copy", "-movflags", "+faststart",
+        "-f", "mp4", output_path
+    ])
+
+async def serve_stream_file(stream_id, filename):
+    """Serve the playlist or a segment of a stream
+
+    The playlist changes while the render runs and must not be cached;
+    segments never change once they are listed.
+    """
+    path = stream_path(stream_id, filename)
+    if path is None:
+        raise HTTPException(status_code=404, detail=f"Stream file {filename} not found")
+    if not os.path.exists(path):
+        if filename == PLAYLIST_NAME and os.path.isdir(os.path.dirname(path)):
+            raise HTTPException(status_code=202, detail="Stream is starting. Please try again in a few seconds.")
+        raise HTTPException(status_code=404, detail=f"Stream file {filename} not found")
+
+    if filename == PLAYLIST_NAME:
+        return FileResponse(path, media_type="application/vnd.apple.mpegurl", headers={"Cache-Control": "no-cache"})
+    return FileResponse(path, media_type="video/mp4", headers={"Cache-Control": "public, max-age=3600"})
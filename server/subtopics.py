@@ -2,7 +2,7 @@ from fastapi import HTTPException
 import json
 from utils import make_ai_api_request, extract_json_from_ai_response
 
-async def get_educational_subtopics(concept: str):
+async def get_educational_subtopics(concept: str, bypass_cache: bool = False):
     """Generate educational subtopics for a given concept"""
     if not concept:
         raise HTTPException(status_code=400, detail="Concept Parameter is required")
@@ -15,7 +15,9 @@ async def get_educational_subtopics(concept: str):
 
     try:
         # Get the AI response
-        content = make_ai_api_request(prompt)
+        content = await make_ai_api_request(
+            prompt, cache_inputs={"task": "subtopics", "concept": concept}, bypass_cache=bypass_cache
+        )
         
         # Try to parse JSON directly first
         try:
@@ -0,0 +1,13 @@
+"""Shared test setup, run the tests from the server directory with python -m pytest tests"""
+import os
+import sys
+import tempfile
+
+# Modules create their stores when imported, keep them out of the working tree
+_state_dir = tempfile.mkdtemp(prefix="edverse_tests_")
+os.environ.setdefault("CACHE_DIR", os.path.join(_state_dir, "cache"))
+os.environ.setdefault("MEDIA_CACHE_DIR", os.path.join(_state_dir, "media_cache"))
+os.environ.setdefault("RENDER_JOBS_DB", os.path.join(_state_dir, "render_jobs.db"))
+os.environ.setdefault("PROFILE_DIR", os.path.join(_state_dir, "profiles"))
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
@@ -0,0 +1,128 @@
+from email.utils import formatdate
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+import file_serving
+from file_serving import parse_range, file_response
+
+SIZE = 1000
+CONTENT = bytes(i % 251 for i in range(SIZE))
+
+@pytest.fixture
+def video_path(tmp_path):
+    path = tmp_path / "video.mp4"
+    path.write_bytes(CONTENT)
+    return path
+
+@pytest.fixture
+def client(video_path):
+    app = FastAPI()
+
+    @app.api_route("/video", methods=["GET", "HEAD"])
+    async def serve(request: Request):
+        return file_response(str(video_path), request.headers, method=request.method, media_type="video/mp4")
+
+    return TestClient(app)
+
+def test_single_range():
+    assert parse_range("bytes=0-99", SIZE) == [(0, 99)]
+
+def test_open_ended_range_runs_to_the_end():
+    assert parse_range("bytes=900-", SIZE) == [(900, 999)]
+
+def test_end_past_the_file_is_clamped():
+    assert parse_range("bytes=900-5000", SIZE) == [(900, 999)]
+
+def test_suffix_range():
+    assert parse_range("bytes=-100", SIZE) == [(900, 999)]
+
+def test_suffix_longer_than_the_file():
+    assert parse_range("bytes=-5000", SIZE) == [(0, 999)]
+
+def test_overlapping_and_adjacent_ranges_are_merged():
+    assert parse_range("bytes=500-599, 0-99, 50-149, 150-199, -10", SIZE) == [(0, 199), (500, 599), (990, 999)]
+
+def test_too_many_ranges_are_ignored():
+    specs = ",".join(f"{i * 10}-{i * 10 + 4}" for i in range(file_serving.MAX_RANGES + 1))
+    assert parse_range(f"bytes={specs}", SIZE) is None
+
+def test_ranges_within_the_limit_after_merging():
+    specs = ",".join(f"{i}-{i}" for i in range(file_serving.MAX_RANGES * 4))
+    assert parse_range(f"bytes={specs}", SIZE) == [(0, file_serving.MAX_RANGES * 4 - 1)]
+
+def test_unsatisfiable_ranges():
+    assert parse_range("bytes=2000-", SIZE) == []
+    assert parse_range("bytes=1000-1999, -0", SIZE) == []
+
+@pytest.mark.parametrize("header", ["bytes=", "bytes=-", "bytes=abc", "bytes=500-100", "items=0-99", "0-99"])
+def test_malformed_headers_are_ignored(header):
+    assert parse_range(header, SIZE) is None
+
+def test_whole_file(client):
+    response = client.get("/video")
+    assert response.status_code == 200
+    assert response.content == CONTENT
+    assert response.headers["accept-ranges"] == "bytes"
+    assert response.headers["content-length"] == str(SIZE)
+
+def test_partial_content(client):
+    response = client.get("/video", headers={"Range": "bytes=-100"})
+    assert response.status_code == 206
+    assert response.headers["content-range"] == f"bytes 900-999/{SIZE}"
+    assert response.content == CONTENT[900:]
+
+def test_multipart_ranges(client):
+    response = client.get("/video", headers={"Range": "bytes=0-9,500-509"})
+    assert response.status_code == 206
+    content_type = response.headers["content-type"]
+    assert content_type.startswith("multipart/byteranges; boundary=")
+    assert int(response.headers["content-length"]) == len(response.content)
+
+    boundary = content_type.split("boundary=")[1].encode()
+    parts = response.content.split(b"--" + boundary)
+    assert parts[-1] == b"--\r\n"
+    assert parts[1].endswith(b"\r\n\r\n" + CONTENT[0:10] + b"\r\n")
+    assert b"Content-Range: bytes 500-509/1000" in parts[2]
+    assert parts[2].endswith(b"\r\n\r\n" + CONTENT[500:510] + b"\r\n")
+
+def test_unsatisfiable_range(client):
+    response = client.get("/video", headers={"Range": "bytes=2000-"})
+    assert response.status_code == 416
+    assert response.headers["content-range"] == f"bytes */{SIZE}"
+
+def test_if_range_with_current_etag(client):
+    etag = client.get("/video").headers["etag"]
+    response = client.get("/video", headers={"Range": "bytes=0-9", "If-Range": etag})
+    assert response.status_code == 206
+    assert response.content == CONTENT[:10]
+
+def test_if_range_mismatch_sends_the_whole_file(client):
+    response = client.get("/video", headers={"Range": "bytes=0-9", "If-Range": '"stale"'})
+    assert response.status_code == 200
+    assert response.content == CONTENT
+
+def test_if_range_with_an_old_date_sends_the_whole_file(client):
+    response = client.get("/video", headers={"Range": "bytes=0-9", "If-Range": formatdate(0, usegmt=True)})
+    assert response.status_code == 200
+    assert response.content == CONTENT
+
+def test_if_none_match_not_modified(client):
+    etag = client.get("/video").headers["etag"]
+    for header in (etag, f"W/{etag}", f'"other", {etag}', "*"):
+        response = client.get("/video", headers={"If-None-Match": header, "Range": "bytes=0-9"})
+        assert response.status_code == 304
+        assert response.content == b""
+        assert response.headers["etag"] == etag
+
+def test_if_none_match_changed_file(client, video_path):
+    etag = client.get("/video").headers["etag"]
+    video_path.write_bytes(CONTENT[::-1] + b"x")
+    response = client.get("/video", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+
+def test_head_sends_headers_only(client):
+    response = client.head("/video", headers={"Range": "bytes=0-9"})
+    assert response.status_code == 206
+    assert response.headers["content-length"] == "10"
+    assert response.content == b""
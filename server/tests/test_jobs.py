@@ -0,0 +1,156 @@
+import os
+import time
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
+import pytest
+from fastapi import HTTPException
+import jobs
+
+PAYLOAD = {"voiceover_data": {"timestamps": [], "audio_path": "voiceover.wav"}}
+
+@pytest.fixture(autouse=True)
+def job_store(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, "JOBS_DB_PATH", str(tmp_path / "render_jobs.db"))
+    monkeypatch.setattr(jobs, "_owner_id", "worker-a")
+    jobs.init_job_store()
+
+def expire_lease(job_id):
+    """Make a running job look like its owner stopped sending heartbeats"""
+    with closing(jobs._connect()) as conn:
+        conn.execute(
+            "UPDATE jobs SET heartbeat_at = ? WHERE id = ?",
+            (time.time() - jobs.JOB_LEASE_SECONDS - 1, job_id)
+        )
+
+def test_submit_rejects_missing_timestamps():
+    with pytest.raises(HTTPException) as error:
+        jobs.submit_render_job({"voiceover_data": {}})
+    assert error.value.status_code == 400
+
+def test_submit_rejects_unknown_quality():
+    with pytest.raises(HTTPException):
+        jobs.submit_render_job(dict(PAYLOAD, quality="ultra"))
+
+def test_claims_oldest_queued_job_first():
+    first = jobs.create_job(PAYLOAD)
+    jobs.create_job(PAYLOAD)
+    job_id, payload = jobs._claim_next_job()
+    assert job_id == first["job_id"]
+    assert payload == PAYLOAD
+
+def test_job_is_claimed_once():
+    job = jobs.create_job(PAYLOAD)
+    assert jobs._claim_next_job()[0] == job["job_id"]
+    assert jobs._claim_next_job() is None
+
+    claimed = jobs.get_job(job["job_id"])
+    assert claimed["status"] == "running"
+    assert claimed["attempts"] == 1
+
+def test_live_lease_is_not_requeued():
+    job = jobs.create_job(PAYLOAD)
+    jobs._claim_next_job()
+    jobs._requeue_stale_jobs()
+    assert jobs.get_job(job["job_id"])["status"] == "running"
+
+def test_expired_lease_is_requeued_and_claimed_again():
+    job = jobs.create_job(PAYLOAD)
+    jobs._claim_next_job()
+    expire_lease(job["job_id"])
+    jobs._requeue_stale_jobs()
+    assert jobs.get_job(job["job_id"])["status"] == "queued"
+
+    assert jobs._claim_next_job()[0] == job["job_id"]
+    assert jobs.get_job(job["job_id"])["attempts"] == 2
+
+def test_heartbeat_extends_the_lease():
+    job = jobs.create_job(PAYLOAD)
+    jobs._claim_next_job()
+    expire_lease(job["job_id"])
+    jobs._heartbeat([job["job_id"]])
+    jobs._requeue_stale_jobs()
+    assert jobs.get_job(job["job_id"])["status"] == "running"
+
+def test_previous_owner_cannot_finish_a_requeued_job(monkeypatch):
+    job = jobs.create_job(PAYLOAD)
+    jobs._claim_next_job()
+    expire_lease(job["job_id"])
+    jobs._requeue_stale_jobs()
+    monkeypatch.setattr(jobs, "_owner_id", "worker-b")
+    jobs._claim_next_job()
+
+    monkeypatch.setattr(jobs, "_owner_id", "worker-a")
+    jobs._finish_job(job["job_id"], result={"video_path": "stale.mp4"})
+    assert jobs.get_job(job["job_id"])["status"] == "running"
+
+    monkeypatch.setattr(jobs, "_owner_id", "worker-b")
+    jobs._finish_job(job["job_id"], result={"video_path": "video.mp4"})
+    finished = jobs.get_job(job["job_id"])
+    assert finished["status"] == "done"
+    assert finished["result"] == {"video_path": "video.mp4"}
+
+def test_job_fails_after_max_attempts(monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_MAX_ATTEMPTS", 2)
+    job = jobs.create_job(PAYLOAD)
+    for attempt in (1, 2):
+        assert jobs._claim_next_job()[0] == job["job_id"]
+        expire_lease(job["job_id"])
+        jobs._requeue_stale_jobs()
+
+    failed = jobs.get_job(job["job_id"])
+    assert failed["status"] == "failed"
+    assert failed["attempts"] == 2
+    assert "interrupted" in failed["error"]
+    assert jobs._claim_next_job() is None
+
+def _crash_worker(payload):
+    # Dies like an OOM kill or a segfault would
+    os._exit(1)
+
+def _fork_pool():
+    return ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("fork"))
+
+def test_job_that_keeps_crashing_its_worker_fails(monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_MAX_ATTEMPTS", 2)
+    monkeypatch.setattr(jobs, "run_render_job", _crash_worker)
+    monkeypatch.setattr(jobs, "_create_pool", _fork_pool)
+    monkeypatch.setattr(jobs, "_pool", _fork_pool())
+    job = jobs.create_job(PAYLOAD)
+    try:
+        asyncio.run(jobs._run_job(*jobs._claim_next_job()))
+        assert jobs.get_job(job["job_id"])["status"] == "queued"
+        asyncio.run(jobs._run_job(*jobs._claim_next_job()))
+    finally:
+        jobs._pool.shutdown(wait=True)
+
+    failed = jobs.get_job(job["job_id"])
+    assert failed["status"] == "failed"
+    assert failed["attempts"] == 2
+    assert "crashed" in failed["error"]
+    assert jobs._claim_next_job() is None
+
+def test_released_job_goes_back_to_the_queue():
+    job = jobs.create_job(PAYLOAD)
+    jobs._claim_next_job()
+    jobs._release_job(job["job_id"])
+    assert jobs.get_job(job["job_id"])["status"] == "queued"
+
+def test_stream_job_gets_a_stream_id(monkeypatch):
+    import video
+    monkeypatch.setattr(video, "find_cached_render", lambda payload: None)
+    job = jobs.submit_render_job(dict(PAYLOAD, stream=True))
+    assert job["stream_id"]
+
+def test_cached_stream_job_gets_no_stream_id(monkeypatch):
+    import video
+    monkeypatch.setattr(video, "find_cached_render", lambda payload: {"video_path": "video.mp4"})
+    job = jobs.submit_render_job(dict(PAYLOAD, stream=True))
+    assert job["stream_id"] is None
+
+def test_finished_job_reports_the_stream_it_wrote():
+    job = jobs.create_job(dict(PAYLOAD, stream=True, stream_id="a" * 32))
+    jobs._claim_next_job()
+    jobs._finish_job(job["job_id"], result={"video_path": "video.mp4", "video_data": {"stream_id": None}})
+    assert jobs.get_job(job["job_id"])["stream_id"] is None
@@ -0,0 +1,18 @@
+from utils import llm_cache_key
+
+TEMPLATE = 'Create a script that teaches "{concept}". The concept is: {concept}'
+
+def key(concept, template=TEMPLATE):
+    return llm_cache_key("gpt-4o-mini", None, 4096, {"task": "script", "concept": concept}, template.format(concept=concept))
+
+def test_inputs_differing_in_case_or_spacing_share_a_key():
+    assert key("Photosynthesis") == key("  photosynthesis ")
+    assert key("Newton's Laws") == key("newton's   laws")
+
+def test_different_inputs_get_different_keys():
+    assert key("photosynthesis") != key("gravity")
+
+def test_editing_the_prompt_template_changes_the_key():
+    edited = TEMPLATE + " Keep it under a minute."
+    assert key("photosynthesis") != key("photosynthesis", edited)
+    assert key("gravity") != key("gravity", edited)
@@ -0,0 +1,83 @@
+import time
+import socket
+import asyncio
+import threading
+import httpx
+import pytest
+import uvicorn
+from fastapi import FastAPI, Request
+import main
+
+KEEP_ALIVE_SECONDS = 1
+ATTEMPTS = 8
+
+def build_app():
+    """A slow route behind the middlewares of the API, in the same order"""
+    app = FastAPI()
+
+    @app.get("/slow")
+    async def slow(request: Request, seconds: float = 0):
+        await asyncio.sleep(seconds)
+        return {"slept": seconds, "client_port": request.client.port}
+
+    app.add_middleware(main.MetricsMiddleware)
+    app.add_middleware(main.ProfilingMiddleware)
+    app.add_middleware(main.CORSHeaderMiddleware)
+    return app
+
+@pytest.fixture
+def server_url():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    config = uvicorn.Config(build_app(), timeout_keep_alive=KEEP_ALIVE_SECONDS, log_level="warning")
+    server = uvicorn.Server(config)
+    thread = threading.Thread(target=server.run, kwargs={"sockets": [sock]}, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    yield f"http://127.0.0.1:{sock.getsockname()[1]}"
+    server.should_exit = True
+    thread.join(timeout=5)
+
+def test_request_longer_than_keep_alive_on_a_reused_connection(server_url):
+    # The client sends its next request as soon as it has the previous body,
+    # which races the end of the previous response, so try a few times
+    slow = KEEP_ALIVE_SECONDS * 1.2
+    with httpx.Client(base_url=server_url, timeout=10, limits=httpx.Limits(max_connections=1)) as client:
+        first = client.get("/slow")
+        for _ in range(ATTEMPTS):
+            response = client.get("/slow", params={"seconds": slow})
+
+            assert response.status_code == 200
+            assert response.json()["slept"] == slow
+            # Still the first connection
+            assert response.json()["client_port"] == first.json()["client_port"]
+            assert response.headers["access-control-allow-origin"] == "https://edverse-mu.vercel.app"
+            assert response.headers["access-control-allow-credentials"] == "true"
+
+def test_response_ends_with_its_last_body_message():
+    """An empty body message after the content is what let uvicorn re-arm the keep-alive timeout"""
+    messages = []
+    requests = [{"type": "http.request", "body": b"", "more_body": False}]
+
+    async def receive():
+        if requests:
+            return requests.pop()
+        # The client stays connected until the response is over
+        while not any(m["type"] == "http.response.body" and not m.get("more_body") for m in messages):
+            await asyncio.sleep(0.01)
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+        "path": "/slow", "raw_path": b"/slow", "root_path": "", "query_string": b"", "headers": [],
+        "client": ("127.0.0.1", 50000), "server": ("127.0.0.1", 8000)
+    }
+    asyncio.run(build_app()(scope, receive, send))
+
+    assert [message["type"] for message in messages] == ["http.response.start", "http.response.body"]
+    assert messages[1]["body"] and not messages[1].get("more_body", False)
+
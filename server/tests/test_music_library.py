@@ -0,0 +1,31 @@
+import os
+import time
+import pytest
+import music_library
+
+@pytest.fixture(autouse=True)
+def library(tmp_path, monkeypatch):
+    cache_dir = tmp_path / "music"
+    cache_dir.mkdir()
+    monkeypatch.setattr(music_library, "MUSIC_DIR", str(tmp_path / "bg_music"))
+    monkeypatch.setattr(music_library, "MUSIC_CACHE_DIR", str(cache_dir))
+    monkeypatch.setattr(music_library, "INDEX_PATH", str(cache_dir / "index.json"))
+    return cache_dir
+
+def test_build_drops_tracks_without_a_source(library):
+    (library / "removed.npy").write_bytes(b"pcm")
+    assert music_library.build_music_library() == []
+    assert not (library / "removed.npy").exists()
+
+def test_build_keeps_tracks_another_worker_is_writing(library):
+    (library / "track.npy.1234.tmp.npy").write_bytes(b"pcm")
+    music_library.build_music_library()
+    assert (library / "track.npy.1234.tmp.npy").exists()
+
+def test_build_drops_tracks_left_behind_by_a_dead_worker(library):
+    path = library / "track.npy.1234.tmp.npy"
+    path.write_bytes(b"pcm")
+    old = time.time() - music_library.TMP_MAX_AGE_SECONDS - 1
+    os.utime(path, (old, old))
+    music_library.build_music_library()
+    assert not path.exists()
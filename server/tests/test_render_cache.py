@@ -0,0 +1,72 @@
+import time
+import pytest
+import cache
+import jobs
+import render_cache
+
+@pytest.fixture(autouse=True)
+def stores(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(jobs, "JOBS_DB_PATH", str(tmp_path / "render_jobs.db"))
+    jobs.init_job_store()
+    monkeypatch.setattr(render_cache, "render_cache", cache.PersistentCache(
+        "renders", max_entries=2, on_evict=render_cache.delete_evicted_videos
+    ))
+    monkeypatch.setattr(render_cache, "pending_deletes", cache.PersistentCache("render_pending_deletes"))
+
+def render(tmp_path, name, key=None):
+    path = tmp_path / f"{name}.mp4"
+    path.write_bytes(b"video")
+    render_cache.store_render(key or name, {"video_path": str(path), "video_data": {"video_filename": path.name}})
+    time.sleep(0.01)  # Distinct last_access for the LRU order
+    return path
+
+def test_evicted_video_is_deleted(tmp_path):
+    first = render(tmp_path, "first")
+    second = render(tmp_path, "second")
+    third = render(tmp_path, "third")
+    assert not first.exists()
+    assert second.exists() and third.exists()
+    assert render_cache.get_cached_render("first") is None
+
+def test_recently_used_entry_survives(tmp_path):
+    first = render(tmp_path, "first")
+    second = render(tmp_path, "second")
+    assert render_cache.get_cached_render("first") is not None
+    render(tmp_path, "third")
+    assert first.exists()
+    assert not second.exists()
+
+def test_expired_video_is_deleted(tmp_path):
+    render_cache.render_cache.ttl = 0.05
+    first = render(tmp_path, "first")
+    time.sleep(0.1)
+    render(tmp_path, "second")
+    assert not first.exists()
+
+def test_video_shared_with_a_live_entry_is_kept(tmp_path):
+    shared = render(tmp_path, "shared", key="first")
+    render(tmp_path, "shared", key="second")
+    render(tmp_path, "third")
+    assert shared.exists()
+    assert render_cache.get_cached_render("second") is not None
+
+def test_replaced_entry_deletes_its_old_video(tmp_path):
+    old = render(tmp_path, "old", key="first")
+    new = render(tmp_path, "new", key="first")
+    assert not old.exists()
+    assert new.exists()
+
+def test_video_a_job_just_returned_is_deleted_after_the_grace_period(tmp_path, monkeypatch):
+    first = render(tmp_path, "first")
+    job = jobs.create_job({"voiceover_data": {"timestamps": []}})
+    jobs._claim_next_job()
+    jobs._finish_job(job["job_id"], result={"video_path": str(first)})
+    render(tmp_path, "second")
+    render(tmp_path, "third")
+    assert first.exists()
+
+    monkeypatch.setattr(render_cache, "RENDER_CACHE_DELETE_GRACE", 0)
+    render(tmp_path, "fourth")
+    assert not first.exists()
+    assert render_cache.pending_deletes.keys() == []
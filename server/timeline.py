@@ -0,0 +1,94 @@
+import logging
+from typing import List, Dict, Any
+
+logger = logging.getLogger("video_generator")
+
+# Zoom out effect on images: start at ZOOM_START and end at 1.0x
+ZOOM_START = 1.2
+
+# Scenes with an image show this much stock video first
+SCENE_VIDEO_SECONDS = 4.0
+# An image is never shown for less than this
+MIN_IMAGE_SECONDS = 2.0
+# Nor is the video cut shorter than this
+MIN_VIDEO_SECONDS = 1.0
+
+def letterbox_geometry(w, h, width, height):
+    """Size and offset of a w x h frame fitted inside width x height, returns (new_w, new_h, x_offset, y_offset)"""
+    aspect = w / h
+    target_aspect = width / height
+
+    if aspect > target_aspect:
+        # Wider than target aspect ratio, center vertically
+        new_w = width
+        new_h = int(width / aspect)
+        return new_w, new_h, 0, (height - new_h) // 2
+
+    # Taller than target aspect ratio, center horizontally
+    new_h = height
+    new_w = int(height * aspect)
+    return new_w, new_h, (width - new_w) // 2, 0
+
+def split_scene(scene_duration):
+    """Split a video + image scene, returns (video_seconds, image_seconds)"""
+    video_time = SCENE_VIDEO_SECONDS
+    image_time = scene_duration - video_time
+
+    # Ensure image is shown for at least MIN_IMAGE_SECONDS
+    if image_time < MIN_IMAGE_SECONDS:
+        image_time = MIN_IMAGE_SECONDS
+        video_time = scene_duration - image_time
+
+        # Ensure video still has some minimal time
+        if video_time < MIN_VIDEO_SECONDS:
+            # If scene is too short, rebalance: 40% to video, 60% to image
+            video_time = max(MIN_VIDEO_SECONDS, scene_duration * 0.4)
+            image_time = scene_duration - video_time
+
+    return video_time, image_time
+
+def plan_timeline(manifest: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Turn a resolved asset manifest into the render timeline
+
+    Returns one segment per video or image shown, in order, each with
+    sceneNumber, kind ("video", "image" or "blank" for gaps between scenes),
+    path, start and duration. Render engines only consume this plan, so they
+    all cut scenes the same way.
+    """
+    segments = []
+    position = 0.0
+
+    for scene in sorted(manifest, key=lambda s: s["startTime"]):
+        scene_number = scene["sceneNumber"]
+        start_time = scene["startTime"]
+        scene_duration = scene["duration"]
+
+        if start_time - position > 0.01:
+            logger.warning(f"Warning: Gap detected between {position:.2f}s and {start_time:.2f}s")
+            segments.append({
+                "sceneNumber": None, "kind": "blank", "path": None,
+                "start": position, "duration": start_time - position
+            })
+
+        if scene["image"] is None:
+            # Short scenes only use stock video
+            segments.append({
+                "sceneNumber": scene_number, "kind": "video", "path": scene["video"]["path"],
+                "start": start_time, "duration": scene_duration
+            })
+        else:
+            video_time, image_time = split_scene(scene_duration)
+            if video_time != SCENE_VIDEO_SECONDS:
+                logger.info(f"Scene {scene_number}: Adjusted video time from {SCENE_VIDEO_SECONDS}s to {video_time:.2f}s to give image at least {image_time:.2f}s")
+            segments.append({
+                "sceneNumber": scene_number, "kind": "video", "path": scene["video"]["path"],
+                "start": start_time, "duration": video_time
+            })
+            segments.append({
+                "sceneNumber": scene_number, "kind": "image", "path": scene["image"]["path"],
+                "start": start_time + video_time, "duration": image_time
+            })
+
+        position = start_time + scene_duration
+
+    return segments
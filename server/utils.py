@@ -1,9 +1,15 @@
 import os
 import re
 import json
-import requests
+import asyncio
+import hashlib
+import httpx
 from fastapi import HTTPException
 from dotenv import load_dotenv
+from http_client import request as http_request
+from cache import PersistentCache
+from metrics import LLM_LATENCY, timed, register_upstream
+from profiling import profiled
 
 # Load environment variables
 load_dotenv(dotenv_path=".env")
@@ -11,6 +17,15 @@ API_KEY = os.getenv("API_KEY")
 ELEVEN_API_KEY = os.getenv("ELEVEN_API_KEY")
 PEXELS_API_KEY = os.getenv("PEXELS_API_KEY")
 
+# Base URL of the AI API, override to go through a proxy or a local stand-in
+AIML_API_BASE_URL = os.getenv("AIML_API_BASE_URL", "https://api.aimlapi.com/v1").rstrip("/")
+register_upstream(AIML_API_BASE_URL, "aiml")
+
+# LLM responses are cached so repeated lessons don't wait on the AI API again
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "0"))  # 0 means entries never expire
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "10000"))
+llm_cache = PersistentCache("llm_responses", ttl=LLM_CACHE_TTL or None, max_entries=LLM_CACHE_MAX_ENTRIES)
+
 def validate_api_keys():
     """Validate that necessary API keys are available"""
     if not API_KEY:
@@ -52,9 +67,57 @@ def extract_json_from_ai_response(content):
                 detail=f"Failed to extract JSON: {str(e)}. Raw content: {content[:200]}..."
             )
 
-def make_ai_api_request(prompt, system_message=None, model="gpt-4o-mini", max_tokens=4096):
-    """Make a request to AI API with proper error handling"""
-    url = "https://api.aimlapi.com/v1/chat/completions"
+def normalize_prompt_input(value):
+    """Normalize a user supplied prompt input so trivially different requests share a cache entry"""
+    if isinstance(value, str):
+        return " ".join(value.split()).lower()
+    return value
+
+def prompt_template_hash(prompt, cache_inputs):
+    """Hash of the prompt with the inputs taken back out, so editing the template changes every key
+
+    The inputs themselves are keyed normalized, hashing the rendered prompt
+    would split entries that only differ in case or spacing.
+    """
+    template = prompt
+    values = [(name, value) for name, value in cache_inputs.items() if isinstance(value, str) and value]
+    for name, value in sorted(values, key=lambda item: len(item[1]), reverse=True):
+        template = template.replace(value, f"{{{name}}}")
+    return hashlib.sha256(template.encode("utf-8")).hexdigest()
+
+def llm_cache_key(model, system_message, max_tokens, cache_inputs, prompt):
+    """Cache key of an AI API request: model, system message, prompt template and the normalized prompt inputs"""
+    normalized = {name: normalize_prompt_input(value) for name, value in cache_inputs.items()}
+    template = prompt_template_hash(prompt, cache_inputs)
+    key_data = json.dumps([model, system_message, max_tokens, template, normalized], sort_keys=True)
+    return hashlib.sha256(key_data.encode("utf-8")).hexdigest()
+
+def _contains_json(content):
+    try:
+        extract_json_from_ai_response(content)
+        return True
+    except Exception:
+        return False
+
+@profiled("llm")
+async def make_ai_api_request(prompt, system_message=None, model="gpt-4o-mini", max_tokens=4096, cache_inputs=None, bypass_cache=False):
+    """Make a request to AI API with proper error handling
+
+    When cache_inputs (the values the prompt was built from) is given, the
+    response is served from and stored in the LLM cache. bypass_cache skips
+    the lookup but still stores the fresh response.
+    """
+    cache_key = None
+    if cache_inputs is not None:
+        cache_key = llm_cache_key(model, system_message, max_tokens, cache_inputs, prompt)
+        if not bypass_cache:
+            # The LLM cache is SQLite, keep its calls off the event loop
+            cached = await asyncio.to_thread(llm_cache.get, cache_key)
+            if cached is not None:
+                print(f"LLM cache hit for {cache_inputs}")
+                return cached.decode("utf-8")
+    
+    url = f"{AIML_API_BASE_URL}/chat/completions"
     headers = {
         "Authorization": f"Bearer {API_KEY}",
         "Content-Type": "application/json"
@@ -72,17 +135,21 @@ def make_ai_api_request(prompt, system_message=None, model="gpt-4o-mini", max_to
     }
     
     try:
-        response = requests.post(url, headers=headers, data=json.dumps(payload))
-        response.raise_for_status()
+        with timed(LLM_LATENCY, task=(cache_inputs or {}).get("task", "other")):
+            response = await http_request("POST", url, headers=headers, json=payload)
         response_data = response.json()
         
         # Extract the content from the response
         if "choices" in response_data and len(response_data["choices"]) > 0:
-            return response_data["choices"][0]["message"]["content"]
+            content = response_data["choices"][0]["message"]["content"]
+            # Callers expect JSON, don't pin a malformed response in the cache
+            if cache_key and _contains_json(content):
+                await asyncio.to_thread(llm_cache.set, cache_key, content.encode("utf-8"))
+            return content
         else:
             raise HTTPException(status_code=500, detail="Unexpected response format from AI API")
     
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         raise HTTPException(status_code=500, detail=f"Error communicating with AI API: {str(e)}")
     except json.JSONDecodeError as e:
         raise HTTPException(status_code=500, detail=f"Error parsing AI response: {str(e)}") 
\ No newline at end of file
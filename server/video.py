@@ -1,18 +1,31 @@
 import os
-import requests
+import wave
+import uuid
 import tempfile
 import subprocess
 import time
 import json
-import random
 import traceback  # Add this for detailed error tracing
 import logging  # Add logging
 import shutil  # Add this for directory operations
 from typing import List, Dict, Any, Optional
 from fastapi import HTTPException
 from pydantic import BaseModel
-from fastapi.responses import FileResponse
-from moviepy.editor import VideoFileClip, ImageClip, AudioFileClip, CompositeVideoClip, concatenate_videoclips
+from assets import resolve_scene_assets
+from timeline import ZOOM_START, letterbox_geometry, plan_timeline
+from ffmpeg_render import render_with_ffmpeg
+from segmented_render import render_segmented
+from stream_render import render_stream, STREAM_ID_PATTERN
+from file_serving import file_response, safe_filename
+from render_cache import render_cache_key, get_cached_render, store_render
+from metrics import CLIP_DECODE_LATENCY, ENCODE_DURATION, RENDER_FPS
+from profiling import profiled
+from quality import get_quality_profile, encoder_options
+from music_library import write_music_bed, BACKGROUND_MUSIC
+from moviepy.editor import (
+    VideoFileClip, ImageClip, AudioFileClip, CompositeVideoClip, CompositeAudioClip,
+    concatenate_videoclips
+)
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, 
@@ -23,14 +36,10 @@ logger = logging.getLogger("video_generator")
 # Create directories if they don't exist
 CURRENT_DIR = os.path.abspath(os.path.dirname(__file__))
 VIDEO_DIR = os.path.abspath(os.path.join(CURRENT_DIR, "generated_videos"))
-MEDIA_DIR = os.path.abspath(os.path.join(CURRENT_DIR, "media_assets"))
 MUSIC_DIR = os.path.abspath(os.path.join(CURRENT_DIR, "bg_music"))  # Path to background music
 
 # Ensure all directories exist
 os.makedirs(VIDEO_DIR, exist_ok=True)
-os.makedirs(MEDIA_DIR, exist_ok=True)
-os.makedirs(os.path.join(MEDIA_DIR, "videos"), exist_ok=True)
-os.makedirs(os.path.join(MEDIA_DIR, "images"), exist_ok=True)
 
 # Check if MUSIC_DIR exists
 if not os.path.exists(MUSIC_DIR):
@@ -41,105 +50,87 @@ if not os.path.exists(MUSIC_DIR):
     for subfolder in ["Harry Potter", "Star Wars", "Marvel Avengers"]:
         os.makedirs(os.path.join(MUSIC_DIR, subfolder), exist_ok=True)
 
+# "precomputed" downsamples the image once, "legacy" resizes the full-resolution frame every frame
+ZOOM_ENGINE = os.getenv("ZOOM_ENGINE", "precomputed")
+
+# "moviepy" composites frames in Python, "ffmpeg" compiles the timeline into one ffmpeg filtergraph
+RENDER_ENGINES = ("moviepy", "ffmpeg")
+RENDER_ENGINE = os.getenv("RENDER_ENGINE", "moviepy")
+# Render scenes as separate segments on all cores and stream-copy them together
+RENDER_SEGMENTED = os.getenv("RENDER_SEGMENTED", "0") == "1"
+
 class VideoRequest(BaseModel):
     voiceover_data: Dict[str, Any]
+    engine: Optional[str] = None  # One of RENDER_ENGINES, defaults to RENDER_ENGINE
+    segmented: Optional[bool] = None  # Defaults to RENDER_SEGMENTED
+    quality: Optional[str] = None  # "full" or "draft" (fast low resolution preview), defaults to full
+    stream: Optional[bool] = None  # Also publish the video as HLS while it renders (ffmpeg engine only)
+    stream_id: Optional[str] = None  # Set by the job queue so the stream URL is known before the render starts
+    bypass_cache: bool = False  # Render again even if an identical video exists
+    profile_id: Optional[str] = None  # Request id to profile the render under, set by the job queue
 
-def make_pexels_request(url, params=None, max_retries=3):
-    """Make Pexels API request with retry logic"""
-    PEXELS_API_KEY = os.getenv("PEXELS_API_KEY")
-    if not PEXELS_API_KEY:
-        logger.error("PEXELS_API_KEY environment variable not set")
-        raise HTTPException(status_code=500, detail="PEXELS_API_KEY environment variable not set")
-    
-    headers = {
-        "Authorization": PEXELS_API_KEY
-    }
+def apply_image_effects(image_clip, duration, width=1920, height=1080, engine=None):
+    """Apply zoom out effect to image clip, the result is standardized to width x height"""
+    engine = engine or ZOOM_ENGINE
+    if engine == "precomputed":
+        return _precomputed_zoom(image_clip, duration, width, height)
+    if engine != "legacy":
+        raise ValueError(f"Unknown zoom engine: {engine}")
     
-    for attempt in range(max_retries):
-        try:
-            response = requests.get(url, headers=headers, params=params)
-            if response.status_code == 401 and attempt < max_retries - 1:
-                logger.warning(f"API key error, retrying in 2 seconds... (Attempt {attempt + 1}/{max_retries})")
-                print(f"API key error, retrying in 2 seconds... (Attempt {attempt + 1}/{max_retries})")
-                time.sleep(2)
-                continue
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Pexels API request failed: {str(e)}")
-            if attempt == max_retries - 1:
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"Error communicating with Pexels API after {max_retries} attempts: {str(e)}"
-                )
-            print(f"Request failed, retrying in 2 seconds... (Attempt {attempt + 1}/{max_retries})")
-            time.sleep(2)
+    return standardize_clip_size(_legacy_zoom(image_clip, duration), width, height)
 
-def search_pexels_videos(query, per_page=1, orientation="landscape"):
-    """Search for videos on Pexels API"""
-    url = "https://api.pexels.com/videos/search"
-    params = {
-        "query": query,
-        "per_page": per_page,
-        "orientation": orientation,
-        "size": "medium"  # medium quality to save bandwidth
-    }
-    
-    result = make_pexels_request(url, params)
-    if not result.get("videos"):
-        raise HTTPException(status_code=404, detail=f"No videos found for query: {query}")
-    
-    return result["videos"]
+def _precomputed_zoom(image_clip, duration, width, height):
+    """Zoom engine that scales the source once and renders each frame with a single crop-and-scale
 
-def search_pexels_photos(query, per_page=1, orientation="landscape"):
-    """Search for photos on Pexels API"""
-    url = "https://api.pexels.com/v1/search"
-    params = {
-        "query": query,
-        "per_page": per_page,
-        "orientation": orientation
-    }
-    
-    result = make_pexels_request(url, params)
-    if not result.get("photos"):
-        raise HTTPException(status_code=404, detail=f"No photos found for query: {query}")
+    The legacy path crops the center 1/scale of the source and then fits it
+    into the output. Here a source larger than the output is resampled once
+    to the fitted size plus the zoom margin, so every frame is one small
+    crop and resize into a reused output buffer. A smaller source is
+    cropped as it is, upsampling it first would only make every frame read
+    more pixels.
+    """
+    import cv2
+    import numpy as np
     
-    return result["photos"]
-
-def download_media_file(url, media_type, query):
-    """Download media file (video or image) from URL"""
-    # Create a safe filename from the query
-    safe_query = "".join([c if c.isalnum() else "_" for c in query])[:50]
-    timestamp = int(time.time())
+    # Image clips are static, every frame starts from the same source
+    frame = image_clip.get_frame(0)
+    h, w = frame.shape[:2]
+    fit_w, fit_h, x_offset, y_offset = letterbox_geometry(w, h, width, height)
     
-    if media_type == "video":
-        extension = ".mp4"
-        subfolder = "videos"
-    else:  # image
-        extension = ".jpg"
-        subfolder = "images"
+    # Downsample once to the output size plus the zoom margin
+    base_w = int(np.ceil(fit_w * ZOOM_START))
+    base_h = int(np.ceil(fit_h * ZOOM_START))
+    if base_w < w:
+        base = cv2.resize(frame, (base_w, base_h), interpolation=cv2.INTER_AREA)
+    else:
+        base, base_w, base_h = frame, w, h
     
-    filename = f"{safe_query}_{timestamp}{extension}"
-    filepath = os.path.join(MEDIA_DIR, subfolder, filename)
+    # Output buffer reused for every frame, the letterbox bars stay black
+    canvas = np.zeros((height, width) + frame.shape[2:], dtype=frame.dtype)
+    target = canvas[y_offset:y_offset+fit_h, x_offset:x_offset+fit_w]
+    # OpenCV can only write in place into contiguous memory
+    scratch = target if target.flags["C_CONTIGUOUS"] else np.empty_like(target)
     
-    # Download the file
-    try:
-        response = requests.get(url, stream=True)
-        response.raise_for_status()
-        
-        with open(filepath, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-        
-        return filepath
-    except Exception as e:
-        raise HTTPException(
-            status_code=500,
-            detail=f"Failed to download {media_type} file: {str(e)}"
+    def zoom_frame(get_frame, t):
+        scale_factor = ZOOM_START - (ZOOM_START - 1.0) * t/duration
+        crop_w = min(base_w, int(round(base_w / scale_factor)))
+        crop_h = min(base_h, int(round(base_h / scale_factor)))
+        start_x = (base_w - crop_w) // 2
+        start_y = (base_h - crop_h) // 2
+        cv2.resize(
+            base[start_y:start_y+crop_h, start_x:start_x+crop_w], (fit_w, fit_h),
+            dst=scratch, interpolation=cv2.INTER_LINEAR
         )
+        if scratch is not target:
+            target[...] = scratch
+        return canvas
+    
+    zoomed = image_clip.fl(zoom_frame)
+    zoomed.size = (width, height)
+    return zoomed
 
-def apply_image_effects(image_clip, duration):
-    """Apply zoom out effect to image clip"""
+def _legacy_zoom(image_clip, duration):
+    """Zoom engine that rescales the full-resolution frame on every frame"""
     # Import here to avoid global import issues
     import cv2
     import numpy as np
@@ -185,93 +176,75 @@ def apply_image_effects(image_clip, duration):
     return image_clip.fl(scale_func)
 
 def standardize_clip_size(clip, width=1920, height=1080):
-    """Resize a clip to standard dimensions while maintaining aspect ratio"""
+    """Resize a clip to standard dimensions while maintaining aspect ratio
+
+    The letterbox geometry is computed once per source frame size and every
+    frame is resized into the same preallocated buffer. Clips that already
+    have the target size are returned unchanged.
+    """
     import cv2
     import numpy as np
     
+    if tuple(clip.size) == (width, height):
+        return clip
+    
+    # Geometry and buffers for the current source frame size
+    layout = {"shape": None}
+    
+    def prepare(frame):
+        h, w = frame.shape[:2]
+        new_w, new_h, x_offset, y_offset = letterbox_geometry(w, h, width, height)
+        
+        # Black background of the target size, only the picture area is ever rewritten
+        canvas = np.zeros((height, width) + frame.shape[2:], dtype=frame.dtype)
+        target = canvas[y_offset:y_offset+new_h, x_offset:x_offset+new_w]
+        layout.update(
+            shape=frame.shape,
+            dtype=frame.dtype,
+            size=(new_w, new_h),
+            canvas=canvas,
+            target=target,
+            # OpenCV can only write in place into contiguous memory
+            scratch=target if target.flags["C_CONTIGUOUS"] else np.empty_like(target)
+        )
+    
     def resize_frame(get_frame, t):
         # Get the original frame
         frame = get_frame(t)
         
-        # Get original dimensions
-        h, w = frame.shape[:2]
+        # Nothing to do if this frame already has the target size
+        if frame.shape[:2] == (height, width):
+            return frame
         
-        # Create a black background of the target size
-        result = np.zeros((height, width, 3), dtype=frame.dtype)
+        if frame.shape != layout["shape"] or frame.dtype != layout["dtype"]:
+            prepare(frame)
         
-        # Calculate aspect ratio
-        aspect = w / h
-        target_aspect = width / height
-        
-        if aspect > target_aspect:
-            # Image is wider than target aspect ratio
-            new_w = width
-            new_h = int(width / aspect)
-            resized = cv2.resize(frame, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
-            
-            # Center vertically
-            y_offset = (height - new_h) // 2
-            result[y_offset:y_offset+new_h, 0:width] = resized
-        else:
-            # Image is taller than target aspect ratio
-            new_h = height
-            new_w = int(height * aspect)
-            resized = cv2.resize(frame, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
-            
-            # Center horizontally
-            x_offset = (width - new_w) // 2
-            result[0:height, x_offset:x_offset+new_w] = resized
-            
-        return result
+        cv2.resize(frame, layout["size"], dst=layout["scratch"], interpolation=cv2.INTER_LINEAR)
+        if layout["scratch"] is not layout["target"]:
+            layout["target"][...] = layout["scratch"]
+        return layout["canvas"]
     
     # Apply the resize function
-    return clip.fl(resize_frame)
+    standardized = clip.fl(resize_frame)
+    standardized.size = (width, height)
+    # The letterboxed frame is opaque, a mask left at the source size (looped
+    # clips get one) would hide everything outside the original frame
+    standardized.mask = None
+    return standardized
 
-def get_random_music_for_fandom(fandom: str) -> str:
-    """Get a random background music file path based on fandom"""
+def get_music_bed(fandom: str, total_duration: float, output_path: str, voice_path: str) -> Optional[str]:
+    """Write the background music for a video next to output_path, already looped, trimmed and leveled
+
+    Returns the WAV path, or None to render with the voiceover only (always
+    when BACKGROUND_MUSIC is off).
+    """
+    if not BACKGROUND_MUSIC:
+        return None
     try:
-        # Map fandom keywords to directory names
-        fandom = fandom.lower() if fandom else ""
-        
-        if "harry potter" in fandom or "wizarding" in fandom:
-            music_folder = "Harry Potter"
-        elif "star wars" in fandom:
-            music_folder = "Star Wars"
-        elif "marvel" in fandom or "avengers" in fandom or "iron man" in fandom:
-            music_folder = "Marvel Avengers"
-        else:
-            # Default to Harry Potter if fandom not recognized
-            music_folder = "Harry Potter"
-        
-        # Get the full path to the music folder
-        music_path = os.path.join(MUSIC_DIR, music_folder)
-        
-        # Check if the folder exists
-        if not os.path.exists(music_path):
-            logger.warning(f"Music folder not found: {music_path}")
-            return None
-        
-        # Get all mp3 files in the folder
-        music_files = [f for f in os.listdir(music_path) if f.endswith('.mp3')]
-        
-        if not music_files:
-            logger.warning(f"No music files found in {music_path}")
-            return None
-        
-        # Select a random file
-        random_music = random.choice(music_files)
-        logger.info(f"Selected background music: {random_music}")
-        
-        # Check if the file exists and is readable
-        music_file_path = os.path.join(music_path, random_music)
-        if not os.path.exists(music_file_path) or not os.access(music_file_path, os.R_OK):
-            logger.warning(f"Selected music file is not accessible: {music_file_path}")
-            return None
-            
-        # Return the full path to the music file
-        return music_file_path
+        bed_path = os.path.splitext(output_path)[0] + ".music.wav"
+        return write_music_bed(fandom, total_duration, bed_path, voice_path)
     except Exception as e:
-        logger.error(f"Error selecting background music: {str(e)}")
+        logger.error(f"Error preparing background music: {str(e)}")
         return None
 
 def cleanup_temp_files(file_paths):
@@ -293,6 +266,195 @@ def cleanup_temp_dir(directory):
     except Exception as e:
         logger.warning(f"Failed to delete temporary directory {directory}: {str(e)}")
 
+def build_scene_clips(segments, width=1920, height=1080):
+    """Build the MoviePy clips for every segment of a render timeline"""
+    video_clips = []
+    
+    for segment in segments:
+        scene_number = segment["sceneNumber"]
+        start_time = segment["start"]
+        duration = segment["duration"]
+        
+        if segment["kind"] == "blank":
+            # Nothing to draw, the composite background shows through
+            continue
+        
+        logger.info(f"Generating {segment['kind']} for scene {scene_number} with duration {duration:.2f}s")
+        clip_started = time.perf_counter()
+        
+        try:
+            if segment["kind"] == "video":
+                try:
+                    video_clip = VideoFileClip(segment["path"])
+                    logger.info(f"Loaded video clip, duration: {video_clip.duration}s")
+                except Exception as e:
+                    logger.error(f"Failed to load video clip: {str(e)}")
+                    raise HTTPException(status_code=500, detail=f"Failed to load video clip: {str(e)}")
+                
+                # If video is longer than needed, take only the part we need
+                if video_clip.duration > duration:
+                    video_clip = video_clip.subclip(0, duration)
+                else:
+                    # If video is shorter, loop it to match the needed duration
+                    loops_needed = int(duration / video_clip.duration) + 1
+                    repeated_clips = [video_clip] * loops_needed
+                    video_clip = concatenate_videoclips(repeated_clips, method="compose")
+                    video_clip = video_clip.subclip(0, duration)
+                
+                # Set the start time for this segment
+                video_clip = video_clip.set_start(start_time)
+                
+                # Standardize clip size before adding
+                video_clip = standardize_clip_size(video_clip, width, height)
+                
+                video_clips.append(video_clip)
+            else:
+                # Image with zoom out effect (also standardizes the clip size)
+                image_clip = apply_image_effects(ImageClip(segment["path"]), duration, width, height)
+                
+                # Set duration and start time
+                image_clip = image_clip.set_duration(duration)
+                image_clip = image_clip.set_start(start_time)
+                
+                video_clips.append(image_clip)
+                
+        except Exception as e:
+            logger.error(f"Error processing scene {scene_number}: {str(e)}\n{traceback.format_exc()}")
+            raise HTTPException(
+                status_code=500,
+                detail=f"Error processing scene {scene_number}: {str(e)}"
+            )
+        CLIP_DECODE_LATENCY.labels(kind=segment["kind"]).observe(time.perf_counter() - clip_started)
+    
+    return video_clips
+
+def render_with_moviepy(segments, audio_path, output_path, total_duration, bg_music_path=None,
+                        width=1920, height=1080, fps=30, preset="ultrafast", crf=23):
+    """Composite the timeline with MoviePy and write it to output_path"""
+    video_clips = build_scene_clips(segments, width, height)
+    
+    # Combine all video clips
+    final_video = CompositeVideoClip(video_clips, size=(width, height))
+    
+    # Print the combined duration of clips versus total duration
+    total_clip_duration = sum(clip.duration for clip in video_clips)
+    logger.info(f"Total clip durations: {total_clip_duration:.2f}s, Audio duration: {total_duration:.2f}s")
+    
+    # Add audio with background music
+    audio_clip = None
+    try:
+        audio_clip = AudioFileClip(audio_path)
+        
+        if bg_music_path:
+            try:
+                # The bed is already the length of the video and at its mixing level
+                bg_music = AudioFileClip(bg_music_path)
+                
+                # Mix the voiceover and background music
+                final_audio = audio_clip.audio_fadein(1).audio_fadeout(1)
+                final_audio = final_audio.audio_fadeout(2)
+                mixed_audio = CompositeAudioClip([final_audio, bg_music])
+                
+                # Apply the mixed audio to the video
+                final_video = final_video.set_audio(mixed_audio)
+                logger.info(f"Added background music from {bg_music_path}")
+            except Exception as e:
+                logger.error(f"Error adding background music: {str(e)}")
+                logger.info("Falling back to voiceover only")
+                # Fallback to just the voiceover audio if music fails
+                final_video = final_video.set_audio(audio_clip)
+        else:
+            # Use just the voiceover audio if no music available
+            logger.info("No background music available, using voiceover only")
+            final_video = final_video.set_audio(audio_clip)
+    except Exception as e:
+        logger.error(f"Error setting audio for video: {str(e)}")
+        # Continue without audio if there's an audio error
+        logger.warning("Continuing with video without audio due to error")
+    
+    # Set video duration to match audio exactly
+    final_video = final_video.set_duration(total_duration)
+    
+    try:
+        # Process video with safer settings
+        final_video.write_videofile(
+            output_path,
+            codec="libx264",
+            audio_codec="aac",
+            fps=fps,
+            threads=2,  # Reduced thread count for better stability
+            preset=preset,  # Faster encoding for reliability
+            ffmpeg_params=["-crf", str(crf)],
+            logger=None,  # Use our own logging
+            verbose=False
+        )
+    except Exception as e:
+        logger.error(f"Error writing video file: {str(e)}\n{traceback.format_exc()}")
+        # Try a simpler fallback method if the first attempt failed
+        logger.info("Attempting fallback video writing method...")
+        final_video.write_videofile(
+            output_path,
+            codec="libx264",
+            audio_codec="aac",
+            fps=min(fps, 24),
+            threads=1,
+            preset=preset,
+            verbose=False,
+            logger=None
+        )
+        logger.info(f"Fallback video writing successful to: {output_path}")
+    finally:
+        # Clean up
+        final_video.close()
+        if audio_clip:
+            audio_clip.close()
+        for clip in video_clips:
+            clip.close()
+
+def audio_duration(audio_path):
+    """Duration in seconds, WAV files are measured from their header without decoding"""
+    if audio_path.lower().endswith(".wav"):
+        with wave.open(audio_path, "rb") as wav:
+            return wav.getnframes() / wav.getframerate()
+    audio_clip = AudioFileClip(audio_path)
+    try:
+        return audio_clip.duration
+    finally:
+        audio_clip.close()
+
+def temp_video_path(output_path):
+    """Path a video is written to before being renamed to output_path
+
+    The extension stays last so ffmpeg can still infer the container.
+    """
+    root, extension = os.path.splitext(output_path)
+    return f"{root}.temp{extension}"
+
+def render_request_key(voiceover_data, options, engine, streamed):
+    """Render cache key of a request, the voiceover's audio must exist"""
+    audio_path = voiceover_data.get("audio_pcm_path")
+    if not audio_path or not os.path.exists(audio_path):
+        audio_path = voiceover_data["audio_path"]
+    return render_cache_key(
+        audio_path, voiceover_data["timestamps"], voiceover_data.get("chosenFandom", ""),
+        dict(options, engine="ffmpeg" if streamed else engine)
+    )
+
+def find_cached_render(payload):
+    """The cached response a render request would get, None if it has to be rendered
+
+    Lets the job queue know up front that a request won't stream.
+    """
+    voiceover_data = payload.get("voiceover_data") or {}
+    audio_path = voiceover_data.get("audio_path")
+    if payload.get("bypass_cache") or not audio_path or not os.path.exists(audio_path):
+        return None
+    options = encoder_options(get_quality_profile(payload.get("quality") or "full"))
+    engine = payload.get("engine") or RENDER_ENGINE
+    streamed = bool(payload.get("stream_id") or payload.get("stream"))
+    return get_cached_render(render_request_key(voiceover_data, options, engine, streamed))
+
+@profiled("generate_video")
 async def generate_video(request: VideoRequest):
     """Generate a video based on voiceover data with stock videos and images from Pexels
     
@@ -306,12 +468,23 @@ async def generate_video(request: VideoRequest):
             logger.error("Valid voiceover data with timestamps is required")
             raise HTTPException(status_code=400, detail="Valid voiceover data with timestamps is required")
         
+        engine = request.engine or RENDER_ENGINE
+        if engine not in RENDER_ENGINES:
+            raise HTTPException(status_code=400, detail=f"Unknown render engine: {engine}")
+        quality = request.quality or "full"
+        options = encoder_options(get_quality_profile(quality))
+        stream_id = request.stream_id or (uuid.uuid4().hex if request.stream else None)
+        if stream_id and not STREAM_ID_PATTERN.match(stream_id):
+            raise HTTPException(status_code=400, detail=f"Invalid stream id: {stream_id}")
+        
         # Log the received data structure
         logger.info(f"Received voiceover data keys: {request.voiceover_data.keys()}")
         
         voiceover_data = request.voiceover_data
         timestamps = voiceover_data["timestamps"]
         audio_path = voiceover_data.get("audio_path")
+        # Lossless copy of the voiceover, saves a decode and an encoding generation when present
+        audio_pcm_path = voiceover_data.get("audio_pcm_path")
         
         # Get fandom for background music selection
         fandom = voiceover_data.get("chosenFandom", "")
@@ -325,9 +498,13 @@ async def generate_video(request: VideoRequest):
             logger.error(f"Audio file not found at path: {audio_path}")
             raise HTTPException(status_code=404, detail=f"Audio file not found at path: {audio_path}")
         
+        if audio_pcm_path and os.path.exists(audio_pcm_path):
+            audio_path = audio_pcm_path
+        
         # Generate unique filename for the output video
-        timestamp = int(time.time())
-        output_filename = f"video_{timestamp}.mp4"
+        # Unique suffix so renders starting in the same second don't write to the same file
+        timestamp = f"{int(time.time())}_{uuid.uuid4().hex[:8]}"
+        output_filename = f"video_{timestamp}.mp4" if quality == "full" else f"video_{timestamp}_{quality}.mp4"
         output_path = os.path.join(VIDEO_DIR, output_filename)
         
         # Check if PEXELS_API_KEY is set
@@ -337,8 +514,7 @@ async def generate_video(request: VideoRequest):
             
         # Load audio file
         try:
-            audio_clip = AudioFileClip(audio_path)
-            total_duration = audio_clip.duration
+            total_duration = audio_duration(audio_path)
             logger.info(f"Loaded audio file: {audio_path}, duration: {total_duration}s")
         except Exception as e:
             logger.error(f"Failed to load audio file: {str(e)}")
@@ -347,6 +523,14 @@ async def generate_video(request: VideoRequest):
         # Sort timestamps by start time to ensure proper sequence
         timestamps = sorted(timestamps, key=lambda x: x.get("startTime", 0))
         
+        # An identical request (same audio, scenes, music and settings) reuses the earlier video
+        cache_key = render_request_key(voiceover_data, options, engine, bool(stream_id))
+        if not request.bypass_cache:
+            cached = get_cached_render(cache_key)
+            if cached is not None:
+                cached["video_data"].update(cached=True, stream_id=None)
+                return cached
+        
         # Validate if timestamps cover the entire duration
         if timestamps:
             last_timestamp = timestamps[-1]
@@ -371,356 +555,59 @@ async def generate_video(request: VideoRequest):
                     "imageQuery": image_query
                 })
         
-        # Prepare list for video clips
-        video_clips = []
+        # Resolve every scene's stock media concurrently before building any clips
+        manifest = await resolve_scene_assets(timestamps, temp_files, quality)
         
-        for scene in timestamps:
-            scene_number = scene["sceneNumber"]
-            start_time = scene["startTime"]
-            end_time = scene["endTime"]
-            scene_duration = end_time - start_time
-            text = scene["text"]
-            
-            # Get appropriate prompt from the scene
-            video_prompt = scene.get("videoPrompt", "")
-            # If videoPrompt is not available, use the keys from test2.py
-            if not video_prompt:
-                image_query = scene.get("imageQuery", text)
-                video_query = scene.get("videoQuery", text)
-            else:
-                # Use the same prompt for both
-                image_query = video_prompt
-                video_query = video_prompt
-            
-            logger.info(f"Generating scene {scene_number} with duration {scene_duration:.2f}s")
-            logger.info(f"Image query: {image_query}")
-            logger.info(f"Video query: {video_query}")
-            
-            try:
-                # For scenes ≤ 5 seconds: use only stock video
-                if scene_duration <= 5.0:
-                    logger.info(f"Scene {scene_number} is ≤ 5 seconds, using only video")
-                    
-                    # Search for stock video
-                    videos = search_pexels_videos(video_query)
-                    if not videos:
-                        logger.error(f"No videos found for scene {scene_number}")
-                        raise HTTPException(status_code=404, detail=f"No videos found for scene {scene_number}")
-                    
-                    # Get the video URL (prefer HD or SD)
-                    video_files = videos[0]["video_files"]
-                    video_url = None
-                    
-                    for file in video_files:
-                        if file["quality"] == "hd" and file["width"] >= 1280:
-                            video_url = file["link"]
-                            break
-                    
-                    # If no HD, get SD
-                    if not video_url:
-                        for file in video_files:
-                            if file["quality"] == "sd" and file["width"] >= 640:
-                                video_url = file["link"]
-                                break
-                    
-                    # If still no URL, get any format
-                    if not video_url and video_files:
-                        video_url = video_files[0]["link"]
-                    
-                    if not video_url:
-                        logger.error(f"No usable video format found for scene {scene_number}")
-                        raise HTTPException(status_code=404, detail=f"No usable video format found for scene {scene_number}")
-                    
-                    # Download and load the video
-                    video_path = download_media_file(video_url, "video", video_query)
-                    temp_files.append(video_path)  # Add to cleanup list
-                    logger.info(f"Downloaded video to: {video_path}")
-                    
-                    try:
-                        video_clip = VideoFileClip(video_path)
-                        logger.info(f"Loaded video clip, duration: {video_clip.duration}s")
-                    except Exception as e:
-                        logger.error(f"Failed to load video clip: {str(e)}")
-                        raise HTTPException(status_code=500, detail=f"Failed to load video clip: {str(e)}")
-                    
-                    # If video is longer than needed, take only the part we need
-                    if video_clip.duration > scene_duration:
-                        video_clip = video_clip.subclip(0, scene_duration)
-                    else:
-                        # If video is shorter, loop it to match the needed duration
-                        loops_needed = int(scene_duration / video_clip.duration) + 1
-                        repeated_clips = [video_clip] * loops_needed
-                        video_clip = concatenate_videoclips(repeated_clips, method="compose")
-                        video_clip = video_clip.subclip(0, scene_duration)
-                    
-                    # Set the start time for this segment
-                    video_clip = video_clip.set_start(start_time)
-                    
-                    # Standardize clip size before adding
-                    video_clip = standardize_clip_size(video_clip)
-                    
-                    # Add clip to the list
-                    video_clips.append(video_clip)
-                    
-                else:
-                    # For scenes > 5 seconds: use stock video for 4 seconds + stock image for the rest
-                    logger.info(f"Scene {scene_number} is > 5 seconds, using video + image")
-                    
-                    # Search for stock video
-                    videos = search_pexels_videos(video_query)
-                    if not videos:
-                        logger.error(f"No videos found for scene {scene_number}")
-                        raise HTTPException(status_code=404, detail=f"No videos found for scene {scene_number}")
-                    
-                    # Get the video URL
-                    video_files = videos[0]["video_files"]
-                    video_url = None
-                    
-                    for file in video_files:
-                        if file["quality"] == "hd" and file["width"] >= 1280:
-                            video_url = file["link"]
-                            break
-                    
-                    if not video_url:
-                        for file in video_files:
-                            if file["quality"] == "sd" and file["width"] >= 640:
-                                video_url = file["link"]
-                                break
-                    
-                    if not video_url and video_files:
-                        video_url = video_files[0]["link"]
-                    
-                    if not video_url:
-                        logger.error(f"No usable video format found for scene {scene_number}")
-                        raise HTTPException(status_code=404, detail=f"No usable video format found for scene {scene_number}")
-                    
-                    # Search for stock image
-                    photos = search_pexels_photos(image_query)
-                    if not photos:
-                        logger.error(f"No images found for scene {scene_number}")
-                        raise HTTPException(status_code=404, detail=f"No images found for scene {scene_number}")
-                    
-                    # Get the image URL
-                    image_url = photos[0]["src"]["original"]
-                    
-                    # Download and load media
-                    video_path = download_media_file(video_url, "video", video_query)
-                    image_path = download_media_file(image_url, "image", image_query)
-                    temp_files.append(video_path)  # Add to cleanup list
-                    temp_files.append(image_path)  # Add to cleanup list
-                    
-                    # First 4 seconds: video
-                    video_clip = VideoFileClip(video_path)
-                    
-                    if video_clip.duration < 4.0:
-                        # Loop video to reach 4 seconds
-                        loops_needed = int(4.0 / video_clip.duration) + 1
-                        repeated_clips = [video_clip] * loops_needed
-                        video_clip = concatenate_videoclips(repeated_clips, method="compose")
-                    
-                    video_clip = video_clip.subclip(0, 4.0)
-                    video_clip = video_clip.set_start(start_time)
-                    
-                    # Rest of the duration: image with zoom effect
-                    image_clip = ImageClip(image_path)
-                    image_duration = scene_duration - 4.0
-                    
-                    # Ensure image is shown for at least 2 seconds
-                    if image_duration < 2.0:
-                        # Reduce video time to ensure image gets at least 2 seconds
-                        required_image_time = 2.0
-                        
-                        # Calculate adjusted video time
-                        adjusted_video_time = scene_duration - required_image_time
-                        
-                        # Ensure video still has some minimal time (at least 1 second)
-                        if adjusted_video_time < 1.0:
-                            # If scene is too short, rebalance
-                            adjusted_video_time = max(1.0, scene_duration * 0.4)  # 40% to video
-                            required_image_time = scene_duration - adjusted_video_time  # 60% to image
-                        
-                        logger.info(f"Scene {scene_number}: Adjusted video time from 4.0s to {adjusted_video_time:.2f}s to give image at least {required_image_time:.2f}s")
-                        
-                        # Update video duration
-                        video_clip = video_clip.subclip(0, adjusted_video_time)
-                        video_clip = video_clip.set_duration(adjusted_video_time)
-                        
-                        # Update image duration and start time
-                        image_duration = required_image_time
-                        image_start = start_time + adjusted_video_time
-                    else:
-                        # Standard case, video is 4s and image gets the rest
-                        image_start = start_time + 4.0
-                    
-                    # Apply zoom out effect
-                    image_clip = apply_image_effects(image_clip, image_duration)
-                    
-                    # Set duration and start time
-                    image_clip = image_clip.set_duration(image_duration)
-                    image_clip = image_clip.set_start(image_start)
-                    
-                    # Standardize clip sizes before adding
-                    video_clip = standardize_clip_size(video_clip)
-                    image_clip = standardize_clip_size(image_clip)
-                    
-                    # Add clips to the list
-                    video_clips.append(video_clip)
-                    video_clips.append(image_clip)
-                    
-            except Exception as e:
-                logger.error(f"Error processing scene {scene_number}: {str(e)}\n{traceback.format_exc()}")
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"Error processing scene {scene_number}: {str(e)}"
-                )
+        # Cut the scenes into the segments every render engine draws
+        segments = plan_timeline(manifest)
+        if segments and segments[-1]["start"] + segments[-1]["duration"] < total_duration - 0.1:
+            logger.warning(f"Warning: Video ends at {segments[-1]['start'] + segments[-1]['duration']:.2f}s but audio is {total_duration:.2f}s")
         
         try:
-            # Combine all video clips
-            final_video = CompositeVideoClip(video_clips, size=(1920, 1080))
-            
-            # Verify that all time ranges are covered
-            covered_times = []
-            for clip in video_clips:
-                covered_times.append((clip.start, clip.start + clip.duration))
-            
-            # Sort by start time
-            covered_times.sort(key=lambda x: x[0])
-            
-            # Check for gaps and log them
-            for i in range(len(covered_times) - 1):
-                current_end = covered_times[i][1]
-                next_start = covered_times[i+1][0]
-                if next_start - current_end > 0.1:  # Gap larger than 0.1s
-                    logger.warning(f"Warning: Gap detected between {current_end:.2f}s and {next_start:.2f}s")
-            
-            # Ensure the video starts at 0 and covers until the end
-            if covered_times[0][0] > 0.1:
-                logger.warning(f"Warning: Video doesn't start at 0 but at {covered_times[0][0]:.2f}s")
-            if covered_times[-1][1] < total_duration - 0.1:
-                logger.warning(f"Warning: Video ends at {covered_times[-1][1]:.2f}s but audio is {total_duration:.2f}s")
-            
-            # Print the combined duration of clips versus total duration
-            total_clip_duration = sum(clip.duration for clip in video_clips)
-            logger.info(f"Total clip durations: {total_clip_duration:.2f}s, Audio duration: {total_duration:.2f}s")
-            
-            # Add audio with background music
-            try:
-                audio_clip = AudioFileClip(audio_path)
-                total_duration = audio_clip.duration
-                
-                # Get background music based on fandom
-                bg_music_path = get_random_music_for_fandom(fandom)
-                
-                if bg_music_path and os.path.exists(bg_music_path):
-                    try:
-                        # Load the background music
-                        bg_music = AudioFileClip(bg_music_path)
-                        
-                        # Loop the music if it's shorter than the video
-                        if bg_music.duration < total_duration:
-                            # Calculate how many loops we need
-                            loops_needed = int(total_duration / bg_music.duration) + 1
-                            # Create a list of music clips to concatenate
-                            music_clips = [bg_music] * loops_needed
-                            # Concatenate the clips
-                            bg_music = concatenate_videoclips(music_clips)
-                        
-                        # Trim the music to match video duration
-                        bg_music = bg_music.subclip(0, total_duration)
-                        
-                        # Lower the volume of the background music (25% of original)
-                        bg_music = bg_music.volumex(0.25)
-                        
-                        # Mix the voiceover and background music
-                        final_audio = audio_clip.audio_fadein(1).audio_fadeout(1)
-                        final_audio = final_audio.audio_fadeout(2)
-                        mixed_audio = CompositeVideoClip([final_audio, bg_music])
-                        
-                        # Apply the mixed audio to the video
-                        final_video = final_video.set_audio(mixed_audio)
-                        logger.info(f"Added background music from {bg_music_path}")
-                    except Exception as e:
-                        logger.error(f"Error adding background music: {str(e)}")
-                        logger.info("Falling back to voiceover only")
-                        # Fallback to just the voiceover audio if music fails
-                        final_video = final_video.set_audio(audio_clip)
-                else:
-                    # Use just the voiceover audio if no music available
-                    logger.info("No background music available, using voiceover only")
-                    final_video = final_video.set_audio(audio_clip)
-                
-                # Set video duration to match audio exactly
-                final_video = final_video.set_duration(total_duration)
-            except Exception as e:
-                logger.error(f"Error setting audio for video: {str(e)}")
-                # Continue without audio if there's an audio error
-                logger.warning("Continuing with video without audio due to error")
-                # Still set a reasonable duration
-                if hasattr(final_video, 'duration') and final_video.duration > 0:
-                    pass  # Keep existing duration
-                else:
-                    # Set a default duration if none is available
-                    final_video = final_video.set_duration(60)  # Default 60 seconds
+            # Get background music based on fandom
+            bg_music_path = get_music_bed(fandom, total_duration, output_path, audio_path)
+            if bg_music_path:
+                temp_files.append(bg_music_path)
             
             # Write video file
-            temp_output_path = f"{output_path}.temp"
+            temp_output_path = temp_video_path(output_path)
             temp_files.append(temp_output_path)  # Add to cleanup list
-            logger.info(f"Writing video to temporary file: {temp_output_path}")
+            logger.info(f"Writing video to temporary file: {temp_output_path} with the {engine} engine")
             
+            segmented = RENDER_SEGMENTED if request.segmented is None else request.segmented
+            if stream_id:
+                # Only the single pass ffmpeg render produces the video in order as it goes
+                engine, segmented = "ffmpeg", False
+            encode_started = time.perf_counter()
             try:
-                # Create a simple test file to verify write permissions
-                with open(temp_output_path, 'wb') as test_file:
-                    test_file.write(b'test')
-                
-                # If test successful, remove the test file
-                os.remove(temp_output_path)
-                logger.info("Write permission test successful")
-                
-                # Process video with safer settings
-                final_video.write_videofile(
-                    temp_output_path,
-                    codec="libx264",
-                    audio_codec="aac",
-                    fps=30,
-                    threads=2,  # Reduced thread count for better stability
-                    preset="ultrafast",  # Faster encoding for reliability
-                    logger=None,  # Use our own logging
-                    verbose=False
-                )
-                
-                # When write is complete, rename to final path for immediate availability
-                if os.path.exists(temp_output_path) and os.path.getsize(temp_output_path) > 0:
-                    logger.info(f"Video file successfully written to: {temp_output_path}, size: {os.path.getsize(temp_output_path)}")
-                    
-                    if os.path.exists(output_path):
-                        os.remove(output_path)
-                    os.rename(temp_output_path, output_path)
-                    logger.info(f"Video file renamed from {temp_output_path} to {output_path}")
-                    
-                    # Remove temp_output_path from cleanup list since it was renamed
-                    if temp_output_path in temp_files:
-                        temp_files.remove(temp_output_path)
+                if stream_id:
+                    await render_stream(
+                        stream_id, segments, audio_path, temp_output_path, total_duration, bg_music_path, **options
+                    )
+                elif segmented:
+                    await render_segmented(
+                        segments, audio_path, temp_output_path, total_duration, bg_music_path, engine=engine, **options
+                    )
+                elif engine == "ffmpeg":
+                    await render_with_ffmpeg(segments, audio_path, temp_output_path, total_duration, bg_music_path, **options)
                 else:
-                    logger.error(f"Video file was not written correctly: {temp_output_path}")
-                    raise Exception("Video file was not written correctly or has zero size")
-                    
+                    render_with_moviepy(segments, audio_path, temp_output_path, total_duration, bg_music_path, **options)
+            except HTTPException:
+                raise
             except Exception as e:
-                logger.error(f"Error writing video file: {str(e)}\n{traceback.format_exc()}")
-                # Try a simpler fallback method if the first attempt failed
-                try:
-                    logger.info("Attempting fallback video writing method...")
-                    # Try writing directly to the final path with simpler settings
-                    final_video.write_videofile(
-                        output_path,
-                        codec="libx264",
-                        audio_codec="aac",
-                        fps=24,
-                        threads=1,
-                        preset="ultrafast",
-                        verbose=False,
-                        logger=None
+                if engine == "moviepy" and not segmented:
+                    logger.error(f"Video writing failed: {str(e)}\n{traceback.format_exc()}")
+                    raise HTTPException(
+                        status_code=500,
+                        detail=f"Failed to write video file: {str(e)}"
                     )
-                    logger.info(f"Fallback video writing successful to: {output_path}")
+                # The single pass MoviePy render stays the fallback for every other mode
+                logger.error(f"{'Segmented ' if segmented else ''}{engine} render failed, falling back to MoviePy: {str(e)}")
+                if stream_id:
+                    logger.warning(f"Stream {stream_id} stays incomplete, the fallback only writes the MP4")
+                engine, segmented, stream_id = "moviepy", False, None
+                try:
+                    render_with_moviepy(segments, audio_path, temp_output_path, total_duration, bg_music_path, **options)
                 except Exception as e2:
                     logger.error(f"Fallback video writing also failed: {str(e2)}\n{traceback.format_exc()}")
                     raise HTTPException(
@@ -728,11 +615,21 @@ async def generate_video(request: VideoRequest):
                         detail=f"Failed to write video file: {str(e2)}"
                     )
             
-            # Clean up
-            final_video.close()
-            audio_clip.close()
-            for clip in video_clips:
-                clip.close()
+            encode_seconds = time.perf_counter() - encode_started
+            ENCODE_DURATION.labels(engine=engine, quality=quality).observe(encode_seconds)
+            RENDER_FPS.labels(engine=engine, quality=quality).observe(total_duration * options["fps"] / encode_seconds)
+            
+            # When write is complete, rename to final path for immediate availability
+            if os.path.exists(temp_output_path) and os.path.getsize(temp_output_path) > 0:
+                logger.info(f"Video file successfully written to: {temp_output_path}, size: {os.path.getsize(temp_output_path)}")
+                os.replace(temp_output_path, output_path)
+                logger.info(f"Video file renamed from {temp_output_path} to {output_path}")
+                
+                # Remove temp_output_path from cleanup list since it was renamed
+                temp_files.remove(temp_output_path)
+            else:
+                logger.error(f"Video file was not written correctly: {temp_output_path}")
+                raise Exception("Video file was not written correctly or has zero size")
             
             # Return video information
             response_data = {
@@ -742,17 +639,26 @@ async def generate_video(request: VideoRequest):
                 "scenes_count": len(timestamps),
                 "video_title": voiceover_data.get("videoTitle", ""),
                 "fandom": voiceover_data.get("chosenFandom", ""),
-                "concept": voiceover_data.get("educationalConcept", "")
+                "concept": voiceover_data.get("educationalConcept", ""),
+                "render_engine": engine,
+                "segmented": segmented,
+                "quality": quality,
+                "stream_id": stream_id,
+                "cached": False
             }
             
             # Clean up all temporary files
             cleanup_temp_files(temp_files)
             
-            return {
+            response = {
                 "video_path": output_path,
                 "video_data": response_data
             }
+            store_render(cache_key, response)
+            return response
             
+        except HTTPException:
+            raise
         except Exception as e:
             # Clean up temporary files even if there's an error
             cleanup_temp_files(temp_files)
@@ -776,8 +682,13 @@ async def generate_video(request: VideoRequest):
             detail=f"Unexpected error in video generation: {str(e)}"
         )
 
-async def download_video(filename):
-    """Download a video file from the generated_videos directory"""
+async def download_video(filename, request_headers=None, method="GET"):
+    """Download a video file from the generated_videos directory
+
+    Supports byte ranges and conditional requests, see file_serving.file_response.
+    """
+    if safe_filename(filename) is None:
+        raise HTTPException(status_code=404, detail=f"Video file {filename} not found")
     file_path = os.path.join(VIDEO_DIR, filename)
     
     # Check if file exists
@@ -785,7 +696,7 @@ async def download_video(filename):
         # Log the error
         logger.error(f"Video file not found: {file_path}")
         # Also check if the file is still being written
-        temp_file_path = f"{file_path}.temp"
+        temp_file_path = temp_video_path(file_path)
         if os.path.exists(temp_file_path):
             logger.info(f"Video is still being generated: {filename}")
             raise HTTPException(status_code=202, 
@@ -801,21 +712,19 @@ async def download_video(filename):
             raise HTTPException(status_code=204, 
                 detail="Video file exists but is empty. It may still be processing.")
         
-        # Set appropriate headers for video streaming
-        headers = {
-            "Accept-Ranges": "bytes",
-            "Cache-Control": "public, max-age=3600",  # Cache for 1 hour
-        }
-        
         # Return the file with video streaming support
-        logger.info(f"Serving video file: {filename}, size: {file_size} bytes")
-        return FileResponse(
-            file_path, 
-            media_type="video/mp4", 
+        logger.info(f"Serving video file: {filename}, size: {file_size} bytes, range: {(request_headers or {}).get('range')}")
+        return file_response(
+            file_path,
+            request_headers or {},
+            method=method,
+            media_type="video/mp4",
             filename=filename,
-            headers=headers
+            cache_control="public, max-age=3600"  # Cache for 1 hour
         )
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error accessing video file {filename}: {str(e)}")
         raise HTTPException(status_code=500, 
-            detail=f"Error accessing video file: {str(e)}") 
\ No newline at end of file
+            detail=f"Error accessing video file: {str(e)}")
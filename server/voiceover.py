@@ -1,42 +1,171 @@
 import os
 import io
 import tempfile
-import requests
-import time
+import json
+import asyncio
+import hashlib
+import httpx
+import numpy as np
 from fastapi import HTTPException
 from pydantic import BaseModel
-from fastapi.responses import FileResponse
+from file_serving import file_response, safe_filename
 from pydub import AudioSegment
 from datetime import datetime
+from http_client import request as http_request, RETRY_STATUSES
+from cache import PersistentCache
+from metrics import TTS_LATENCY, timed, register_upstream
+from profiling import profiled
 
 # Create audio directory if it doesn't exist
 AUDIO_DIR = "generated_audio"
 os.makedirs(AUDIO_DIR, exist_ok=True)
 
-def make_api_request(url, headers, payload, max_retries=3):
+# Maximum number of scenes synthesized at the same time
+TTS_CONCURRENCY = int(os.getenv("TTS_CONCURRENCY", "4"))
+
+# Base URL of the Eleven Labs API, override to go through a proxy or a local stand-in
+ELEVENLABS_API_BASE_URL = os.getenv("ELEVENLABS_API_BASE_URL", "https://api.elevenlabs.io/v1").rstrip("/")
+register_upstream(ELEVENLABS_API_BASE_URL, "elevenlabs")
+
+TTS_MODEL_ID = "eleven_flash_v2"
+TTS_VOICE_SETTINGS = {
+    "stability": 0.5,
+    "similarity_boost": 0.75
+}
+
+# Every scene lasts at least MIN_SCENE_MS, followed by a SCENE_PAUSE_MS pause
+MIN_SCENE_MS = 4500
+SCENE_PAUSE_MS = 500
+
+# Decoded scene audio is cached, so previously seen lines never hit Eleven Labs again
+TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_BYTES", str(512 * 1024 ** 2)))
+tts_cache = PersistentCache("tts_fragments", max_bytes=TTS_CACHE_MAX_BYTES)
+
+async def make_api_request(url, headers, payload, max_retries=3):
     """Make API request with retry logic"""
-    for attempt in range(max_retries):
-        try:
-            response = requests.post(url, json=payload, headers=headers)
-            if response.status_code == 401 and attempt < max_retries - 1:
-                print(f"API key error, retrying in 2 seconds... (Attempt {attempt + 1}/{max_retries})")
-                time.sleep(2)
-                continue
-            response.raise_for_status()
-            return response
-        except requests.exceptions.RequestException as e:
-            if attempt == max_retries - 1:
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"Error communicating with Eleven Labs API after {max_retries} attempts: {str(e)}"
-                )
-            print(f"Request failed, retrying in 2 seconds... (Attempt {attempt + 1}/{max_retries})")
-            time.sleep(2)
+    try:
+        # 401 is retried too, Eleven Labs occasionally rejects valid keys transiently
+        return await http_request(
+            "POST", url, json=payload, headers=headers,
+            retries=max_retries, backoff=2.0, retry_statuses=(401,) + RETRY_STATUSES
+        )
+    except httpx.HTTPError as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error communicating with Eleven Labs API after {max_retries} attempts: {str(e)}"
+        )
+
+def tts_cache_key(voice_id, model_id, voice_settings, text):
+    key_data = json.dumps([voice_id, model_id, voice_settings, text], sort_keys=True)
+    return hashlib.sha256(key_data.encode("utf-8")).hexdigest()
+
+def _decode_mp3(data):
+    return AudioSegment.from_file(io.BytesIO(data), format="mp3")
+
+def _encode_fragment(audio_segment):
+    # Fragments are stored decoded as WAV, which pydub reads back without ffmpeg
+    buffer = io.BytesIO()
+    audio_segment.export(buffer, format="wav")
+    return buffer.getvalue()
+
+def _decode_fragment(data):
+    return AudioSegment.from_wav(io.BytesIO(data))
+
+async def synthesize_scene(narration_text, scene_number, voice_id, api_key, semaphore):
+    """Generate the decoded audio for a single scene, from the fragment cache or Eleven Labs"""
+    cache_key = tts_cache_key(voice_id, TTS_MODEL_ID, TTS_VOICE_SETTINGS, narration_text)
+    # The fragment cache is SQLite, keep its calls off the event loop
+    cached = await asyncio.to_thread(tts_cache.get, cache_key)
+    if cached is not None:
+        print(f"Using cached voiceover for scene {scene_number}")
+        with timed(TTS_LATENCY, source="cache"):
+            return _decode_fragment(cached)
+    
+    url = f"{ELEVENLABS_API_BASE_URL}/text-to-speech/{voice_id}"
+    headers = {
+        "Accept": "audio/mpeg",
+        "Content-Type": "application/json",
+        "xi-api-key": api_key
+    }
+    
+    payload = {
+        "text": narration_text,
+        "model_id": TTS_MODEL_ID,
+        "voice_settings": TTS_VOICE_SETTINGS
+    }
+    
+    async with semaphore:
+        print(f"Generating voiceover for scene {scene_number} with text: {narration_text}")
+        with timed(TTS_LATENCY, source="elevenlabs"):
+            response = await make_api_request(url, headers, payload)
+    
+    print(f"Scene {scene_number} API Response Status: {response.status_code}")
+    print(f"Response Content Type: {response.headers.get('content-type')}")
+    print(f"Response Length: {len(response.content)} bytes")
+    
+    # Check if we got audio data
+    if not response.content:
+        raise HTTPException(
+            status_code=500,
+            detail="Empty response received from Eleven Labs API"
+        )
+    
+    try:
+        # Decoding runs ffmpeg, keep it off the event loop
+        audio_segment = await asyncio.to_thread(_decode_mp3, response.content)
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to process audio data: {str(e)}"
+        )
+    
+    fragment = await asyncio.to_thread(_encode_fragment, audio_segment)
+    await asyncio.to_thread(tts_cache.set, cache_key, fragment)
+    return audio_segment
+
+def scene_layout(durations_ms):
+    """(start_ms, end_ms) of every scene, padded to MIN_SCENE_MS plus the pause"""
+    layout = []
+    position = 0
+    for duration in durations_ms:
+        end = position + max(duration, MIN_SCENE_MS) + SCENE_PAUSE_MS
+        layout.append((position, end))
+        position = end
+    return layout
+
+def assemble_voiceover(fragments, layout):
+    """Place every scene's audio at its offset in one preallocated PCM buffer
+
+    Silence is simply the untouched zeros between fragments, so building the
+    track is linear in its length instead of copying it for every scene.
+    """
+    if not fragments:
+        return AudioSegment.empty()
+
+    # Same target format pydub picks when concatenating
+    frame_rate = max(fragment.frame_rate for fragment in fragments)
+    channels = max(fragment.channels for fragment in fragments)
+    sample_width = max(fragment.sample_width for fragment in fragments)
+    if sample_width == 3:
+        sample_width = 4  # No numpy type for 24 bit samples
+    dtype = {1: np.int8, 2: np.int16, 4: np.int32}[sample_width]
+
+    total_frames = round(layout[-1][1] * frame_rate / 1000)
+    pcm = np.zeros((total_frames, channels), dtype=dtype)
+    for fragment, (start_ms, _) in zip(fragments, layout):
+        fragment = fragment.set_frame_rate(frame_rate).set_channels(channels).set_sample_width(sample_width)
+        samples = np.frombuffer(fragment.raw_data, dtype=dtype).reshape(-1, channels)
+        offset = round(start_ms * frame_rate / 1000)
+        count = min(len(samples), total_frames - offset)
+        pcm[offset:offset + count] = samples[:count]
+
+    return AudioSegment(pcm.tobytes(), frame_rate=frame_rate, sample_width=sample_width, channels=channels)
 
 class VoiceoverRequest(BaseModel):
     script: dict
     voice_id: str = None  # Make voice_id optional, will be determined based on fandom
 
+@profiled("generate_voiceover")
 async def generate_voiceover(request: VoiceoverRequest):
     """Generate voiceovers using Eleven Labs API based on script
     
@@ -64,7 +193,10 @@ async def generate_voiceover(request: VoiceoverRequest):
           },
           // Additional scenes
         ],
-        "totalDuration": 60.0
+        "totalDuration": 60.0,
+        "audio_path": "generated_audio/voiceover_....mp3",
+        "audio_filename": "voiceover_....mp3",
+        "audio_pcm_path": "generated_audio/voiceover_....wav"
       }
     }
     """
@@ -102,123 +234,68 @@ async def generate_voiceover(request: VoiceoverRequest):
     
     scenes = request.script["scenes"]
     
-    # Initialize audio segments and timestamps
-    combined_audio = AudioSegment.empty()
     timestamps = []
-    current_position = 0  # Position in milliseconds
     
     # Generate unique filename with timestamp
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     output_filename = f"voiceover_{timestamp}.mp3"
     output_path = os.path.join(AUDIO_DIR, output_filename)
+    # Lossless copy handed to the video stage, the MP3 is for downloads
+    pcm_path = os.path.join(AUDIO_DIR, f"voiceover_{timestamp}.wav")
     
     # Log selected voice and verify API key
     print(f"Using voice ID: {voice_id} for fandom: {chosen_fandom}")
     print(f"API Key length: {len(ELEVEN_API_KEY)} characters")
     
-    for scene in scenes:
-        if "narrationScript" not in scene:
-            continue
-            
-        narration_text = scene["narrationScript"]
-        scene_number = scene.get("sceneNumber", 0)
-        video_prompt = scene.get("videoPrompt", "")
-        
-        print(f"Generating voiceover for scene {scene_number} with text: {narration_text}")
-        
-        # Call Eleven Labs API to generate voice
-        url = f"https://api.elevenlabs.io/v1/text-to-speech/{voice_id}"
-        headers = {
-            "Accept": "audio/mpeg",
-            "Content-Type": "application/json",
-            "xi-api-key": ELEVEN_API_KEY
-        }
-        
-        payload = {
-            "text": narration_text,
-            "model_id": "eleven_flash_v2",
-            "voice_settings": {
-                "stability": 0.5,
-                "similarity_boost": 0.75
-            }
-        }
-        
-        try:
-            response = make_api_request(url, headers, payload)
-            print(f"API Response Status: {response.status_code}")
-            print(f"Response Content Type: {response.headers.get('content-type')}")
-            print(f"Response Length: {len(response.content)} bytes")
-            
-            # Check if we got audio data
-            if not response.content:
-                raise HTTPException(
-                    status_code=500,
-                    detail="Empty response received from Eleven Labs API"
-                )
-            
-            # Save the audio data to a file
-            with open(output_path, 'wb') as audio_file:
-                audio_file.write(response.content)
-            
-            try:
-                # Load the audio file
-                audio_segment = AudioSegment.from_file(output_path, format="mp3")
-            except Exception as e:
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"Failed to process audio data: {str(e)}"
-                )
-            
-            # Add to timestamp data
-            start_time = current_position / 1000.0  # Convert to seconds
-            
-            # Calculate the duration of current audio segment in seconds
-            
-            # Ensure minimum segment duration of 5 seconds
-            if len(audio_segment) < 4500:  # If less than 4.5 seconds
-                # Calculate silence needed to reach minimum 4.5 seconds + 0.5s pause
-                silence_duration_ms = 4500 - len(audio_segment) + 500
-                silence = AudioSegment.silent(duration=silence_duration_ms)
-                
-                # Add silence to the audio segment
-                audio_segment += silence
-                # Update position for next audio
-                current_position += len(audio_segment)
-            else:
-                # Add a consistent pause after each line (0.5 seconds)
-                pause = AudioSegment.silent(duration=500)
-                audio_segment += pause
-                current_position += len(audio_segment)
-            
-            # Calculate end time after adjustments
-            end_time = current_position / 1000.0
-            
-            # Add to combined audio
-            combined_audio += audio_segment
-            
-            # Store timestamp data including video and image queries
-            timestamps.append({
-                "sceneNumber": scene_number,
-                "startTime": start_time,
-                "endTime": end_time,
-                "text": narration_text,
-                "videoPrompt": video_prompt,
-                "videoQuery": scene.get("videoQuery", ""),
-                "imageQuery": scene.get("imageQuery", "")
-            })
-            
-            time.sleep(0.1)
-            
-        except HTTPException as e:
-            raise e
-        except Exception as e:
-            raise HTTPException(
-                status_code=500,
-                detail=f"Unexpected error: {str(e)}"
-            )
-    
-    # Export combined audio to the final file
-    combined_audio.export(output_path, format="mp3")
+    scenes = [scene for scene in scenes if "narrationScript" in scene]
+    
+    # Synthesize all scenes concurrently, at most TTS_CONCURRENCY at a time
+    semaphore = asyncio.Semaphore(TTS_CONCURRENCY)
+    tasks = [
+        asyncio.ensure_future(synthesize_scene(
+            scene["narrationScript"], scene.get("sceneNumber", 0), voice_id, ELEVEN_API_KEY, semaphore
+        ))
+        for scene in scenes
+    ]
+    try:
+        scene_audio = await asyncio.gather(*tasks)
+    except HTTPException:
+        for task in tasks:
+            task.cancel()
+        raise
+    except Exception as e:
+        for task in tasks:
+            task.cancel()
+        raise HTTPException(
+            status_code=500,
+            detail=f"Unexpected error: {str(e)}"
+        )
+    
+    # Lay the scenes out back to back, then build the track in a single pass
+    layout = scene_layout([len(audio_segment) for audio_segment in scene_audio])
+    for scene, (start_ms, end_ms) in zip(scenes, layout):
+        # Store timestamp data including video and image queries
+        timestamps.append({
+            "sceneNumber": scene.get("sceneNumber", 0),
+            "startTime": start_ms / 1000.0,
+            "endTime": end_ms / 1000.0,
+            "text": scene["narrationScript"],
+            "videoPrompt": scene.get("videoPrompt", ""),
+            "videoQuery": scene.get("videoQuery", ""),
+            "imageQuery": scene.get("imageQuery", "")
+        })
+    total_ms = layout[-1][1] if layout else 0
+    
+    try:
+        # Assemble and encode exactly once, off the event loop
+        combined_audio = await asyncio.to_thread(assemble_voiceover, scene_audio, layout)
+        await asyncio.to_thread(combined_audio.export, output_path, format="mp3")
+        await asyncio.to_thread(combined_audio.export, pcm_path, format="wav")
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Unexpected error: {str(e)}"
+        )
     
     # Return both the audio file and timestamps
     response_data = {
@@ -227,9 +304,10 @@ async def generate_voiceover(request: VoiceoverRequest):
         "chosenFandom": chosen_fandom,
         "videoTitle": video_title,
         "timestamps": timestamps,
-        "totalDuration": current_position / 1000.0,  # Total duration in seconds
+        "totalDuration": total_ms / 1000.0,  # Total duration in seconds
         "audio_path": output_path,  # Full path to the audio file
-        "audio_filename": output_filename  # Just the filename
+        "audio_filename": output_filename,  # Just the filename
+        "audio_pcm_path": pcm_path  # Same audio as uncompressed WAV, used by the video stage
     }
     
     return {
@@ -237,9 +315,12 @@ async def generate_voiceover(request: VoiceoverRequest):
         "voiceover_data": response_data
     }
 
-async def download_audio(filename):
-    """Download an audio file from the generated_audio directory"""
+async def download_audio(filename, request_headers=None, method="GET"):
+    """Download an audio file from the generated_audio directory, with byte range support"""
+    if safe_filename(filename) is None:
+        raise HTTPException(status_code=404, detail=f"Audio file {filename} not found")
     file_path = os.path.join(AUDIO_DIR, filename)
-    if not os.path.exists(file_path):
+    if not os.path.isfile(file_path):
         raise HTTPException(status_code=404, detail=f"Audio file {filename} not found")
-    return FileResponse(file_path, media_type="audio/mpeg", filename=filename) 
\ No newline at end of file
+    media_type = "audio/wav" if filename.endswith(".wav") else "audio/mpeg"
+    return file_response(file_path, request_headers or {}, method=method, media_type=media_type, filename=filename)